@@ -0,0 +1,62 @@
+"""
+Compares the JSON and binary wire protocols on typical chat frames.
+
+For each frame kind it reports the encoded size and the encode and decode
+throughput of both codecs. Run from the repository root:
+
+    python benchmarks/codec_benchmark.py [--iterations N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_packet import BINARY_CODEC, JSON_BACKEND, JSON_CODEC
+from session_registry import ColorAllocator
+
+allocator = ColorAllocator()
+COLORS = [allocator.allocate() for _ in range(200)]
+
+
+def wire_size(frame):
+    return len(frame.encode("utf-8")) if isinstance(frame, str) else len(frame)
+
+def sample_frames():
+    """Returns (name, message) pairs shaped like the frames the server sends."""
+    chat = {"type": "message", "id": "3f9a2c1e-18234", "room": "lobby", "sender_color": COLORS[7], "message": "Sounds good, see you at the standup in ten minutes!", "seq": 48213}
+    return [
+        ("message", chat),
+        ("direct_message", {"type": "direct_message", "id": "3f9a2c1e-18235", "sender_color": COLORS[7], "message": "ping", "recipient_color": COLORS[3], "seq": 12}),
+        ("typing_start", {"type": "typing_start", "room": "lobby", "sender_color": COLORS[7]}),
+        ("presence (5 joined)", {"type": "presence", "room": "lobby", "joined": COLORS[:5], "left": [], "seq": 48214}),
+        ("client_list (200)", {"type": "client_list", "room": "lobby", "clients": [{"color": color} for color in COLORS], "seq": 48214}),
+        ("history (50)", {"type": "history", "room": "lobby", "messages": [dict(chat, id=f"3f9a2c1e-{i}") for i in range(50)]}),
+    ]
+
+def ops_per_second(function, iterations):
+    return iterations / min(timeit.repeat(function, number=iterations, repeat=3))
+
+def main(iterations):
+    print(f"JSON backend: {JSON_BACKEND}")
+    print(f"{'frame':<22}{'json B':>8}{'bin B':>8}{'ratio':>7}{'json enc/s':>13}{'bin enc/s':>12}{'json dec/s':>13}{'bin dec/s':>12}")
+    for name, message in sample_frames():
+        json_frame = JSON_CODEC.encode(message)
+        binary_frame = BINARY_CODEC.encode(message)
+        assert JSON_CODEC.decode(json_frame) == message and BINARY_CODEC.decode(binary_frame) == message
+        count = max(1, iterations // max(1, len(json_frame) // 100)) # Fewer rounds for the big frames
+        print(
+            f"{name:<22}{wire_size(json_frame):>8}{wire_size(binary_frame):>8}"
+            f"{wire_size(binary_frame) / wire_size(json_frame):>7.2f}"
+            f"{ops_per_second(lambda: JSON_CODEC.encode(message), count):>13,.0f}"
+            f"{ops_per_second(lambda: BINARY_CODEC.encode(message), count):>12,.0f}"
+            f"{ops_per_second(lambda: JSON_CODEC.decode(json_frame), count):>13,.0f}"
+            f"{ops_per_second(lambda: BINARY_CODEC.decode(binary_frame), count):>12,.0f}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the JSON and binary chat codecs")
+    parser.add_argument("--iterations", type=int, default=20000, help="encode/decode calls per measurement for small frames")
+    args = parser.parse_args()
+    main(args.iterations)
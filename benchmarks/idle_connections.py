@@ -0,0 +1,191 @@
+"""
+Measures what an idle client costs chat_server.py in memory.
+
+Starts a local server, connects idle clients in steps and samples the
+server's RSS once each step has settled. Clients only answer heartbeat
+pings, so everything measured is per-connection state: the socket and its
+buffers, the websockets protocol object and its tasks, the handler
+coroutine and the session. The result is the RSS per idle client for each
+step, the marginal cost between steps, and how many idle clients that makes
+fit in 1 GiB, compared against IDLE_CLIENT_TARGET_BYTES.
+
+    python benchmarks/idle_connections.py --steps 1000,10000,50000
+    python benchmarks/idle_connections.py --steps 100000 --uvloop --output idle.json
+
+The clients connect from many loopback source addresses (127.0.0.2, .3, ...)
+so more than one address's worth of ephemeral ports can be used; this works
+on Linux. The load generator needs a file descriptor per client too, and a
+lot more memory per client than the server does.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import websockets
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from load_test import ProcessSampler, free_port, git_revision, raise_file_limit, start_server, wait_for_port
+from message_packet import BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL, ColorAssignment, Ping, codec_for, decode_message
+
+# Target cost of one idle client on the server: 8 KiB, i.e. about 130,000 idle clients per GiB of RSS
+IDLE_CLIENT_TARGET_BYTES = 8 * 1024
+CLIENTS_PER_SOURCE_ADDRESS = 20000 # Well below the ~28,000 ephemeral ports Linux uses per address pair
+MAX_CONCURRENT_HANDSHAKES = 256
+WARMUP_CLIENTS = 100 # Connected and dropped before the baseline, so lazily imported code is not counted
+SETTLE_SECONDS = 3.0 # Wait after each step before sampling RSS
+
+
+class IdleClient:
+    """A client that connects, gets its color and then only answers pings."""
+
+    def __init__(self, index):
+        self.source_address = f"127.0.0.{2 + index // CLIENTS_PER_SOURCE_ADDRESS}"
+        self.websocket = None
+        self.codec = None
+        self.ready = asyncio.Event()
+        self._reader = None
+
+    async def connect(self, url, subprotocol):
+        self.websocket = await websockets.connect(
+            url, subprotocols=[subprotocol], ping_interval=None, compression=None, max_queue=4, local_addr=(self.source_address, 0),
+        )
+        self.codec = codec_for(self.websocket.subprotocol)
+        self._reader = asyncio.create_task(self._read())
+        await self.ready.wait()
+
+    async def _read(self):
+        try:
+            async for frame in self.websocket:
+                message = decode_message(frame)
+                if isinstance(message, ColorAssignment):
+                    self.ready.set()
+                elif isinstance(message, Ping):
+                    await self.websocket.send(self.codec.encode({"type": "pong"}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.ready.set()
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self._reader is not None:
+            await self._reader
+
+
+class IdleRun:
+    """Connects idle clients step by step and samples the server's RSS after each step."""
+
+    def __init__(self, url, subprotocol, sampler):
+        self.url = url
+        self.subprotocol = subprotocol
+        self.sampler = sampler
+        self.clients = []
+        self.failures = 0
+        self._handshakes = asyncio.Semaphore(MAX_CONCURRENT_HANDSHAKES)
+
+    async def _connect_one(self, index):
+        client = IdleClient(index)
+        async with self._handshakes:
+            try:
+                await client.connect(self.url, self.subprotocol)
+            except (OSError, websockets.exceptions.WebSocketException, asyncio.TimeoutError):
+                self.failures += 1
+                return None
+        return client
+
+    async def connect(self, count):
+        """Connects count more clients and returns the ones that made it."""
+        first = len(self.clients)
+        clients = await asyncio.gather(*(self._connect_one(first + i) for i in range(count)))
+        connected = [client for client in clients if client is not None]
+        self.clients.extend(connected)
+        return connected
+
+    async def rss(self, settle=SETTLE_SECONDS):
+        await asyncio.sleep(settle)
+        return self.sampler.sample()[1]
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients), return_exceptions=True)
+        self.clients = []
+
+
+def clients_per_gib(cost):
+    return int(2**30 / cost) if cost > 0 else None
+
+async def main(args):
+    raise_file_limit()
+    steps = sorted({int(step) for step in args.steps.split(",")})
+    port = free_port()
+    extra_args = ["--max-connections", str(steps[-1] + WARMUP_CLIENTS), "--handshake-rate", "100000"]
+    if args.uvloop:
+        extra_args.append("--uvloop")
+    server = start_server(port, 1, "", extra_args)
+    url = f"ws://127.0.0.1:{port}"
+    subprotocol = BINARY_SUBPROTOCOL if args.protocol == "binary" else JSON_SUBPROTOCOL
+    run = IdleRun(url, subprotocol, ProcessSampler(server.pid))
+    results = {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {"protocol": args.protocol, "uvloop": args.uvloop, "steps": steps},
+        "target_bytes_per_client": IDLE_CLIENT_TARGET_BYTES,
+        "steps": [],
+    }
+    try:
+        await wait_for_port(port)
+        warmup = await run.connect(WARMUP_CLIENTS)
+        await run.close()
+        baseline = await run.rss()
+        results["baseline_rss_mb"] = round(baseline / 2**20, 1)
+        print(f"baseline rss={baseline / 2**20:.1f}MB (after {len(warmup)} warm-up clients)")
+
+        previous_clients, previous_rss = 0, baseline
+        for step in steps:
+            started = time.monotonic()
+            await run.connect(step - len(run.clients))
+            rss = await run.rss(args.settle)
+            clients = len(run.clients)
+            per_client = (rss - baseline) / clients if clients else 0
+            marginal = (rss - previous_rss) / (clients - previous_clients) if clients > previous_clients else 0
+            result = {
+                "clients": clients,
+                "connect_seconds": round(time.monotonic() - started, 2),
+                "rss_mb": round(rss / 2**20, 1),
+                "bytes_per_client": round(per_client),
+                "marginal_bytes_per_client": round(marginal),
+                "clients_per_gib": clients_per_gib(per_client),
+                "failures": run.failures,
+            }
+            results["steps"].append(result)
+            print(f"clients={clients:<8} rss={result['rss_mb']:<8}MB per client={per_client / 1024:.2f}KiB "
+                  f"marginal={marginal / 1024:.2f}KiB idle clients per GiB={result['clients_per_gib']} failures={run.failures}")
+            previous_clients, previous_rss = clients, rss
+    finally:
+        await run.close()
+        server.terminate()
+        server.wait()
+
+    if results["steps"]:
+        last = results["steps"][-1]
+        # Failed clients leave the server with less to hold than the step asked for, so such a run proves nothing
+        results["meets_target"] = last["failures"] == 0 and 0 < last["bytes_per_client"] <= IDLE_CLIENT_TARGET_BYTES
+        print(f"target {IDLE_CLIENT_TARGET_BYTES / 1024:.0f}KiB per idle client ({clients_per_gib(IDLE_CLIENT_TARGET_BYTES)} per GiB): "
+              + ("met" if results["meets_target"] else "not met" + (f" ({last['failures']} clients failed to connect)" if last["failures"] else "")))
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the server memory cost of idle clients")
+    parser.add_argument("--steps", default="1000,5000,10000", help="comma-separated client counts to measure at")
+    parser.add_argument("--protocol", choices=("json", "binary"), default="binary", help="wire protocol the clients negotiate")
+    parser.add_argument("--uvloop", action="store_true", help="run the server on uvloop")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS, help="seconds to wait after each step before sampling RSS")
+    parser.add_argument("--output", default="idle_connections_results.json", help="where to write the JSON results")
+    asyncio.run(main(parser.parse_args()))
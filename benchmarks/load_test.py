@@ -0,0 +1,450 @@
+"""
+Headless load generator and fan-out latency benchmark for chat_server.py.
+
+Starts a local server (or targets --url), connects simulated asyncio
+WebSocket clients and runs a scenario of phases. Each phase can connect more
+clients at a given rate (join storms) and drive chat messages, direct
+messages and typing indicators at given aggregate rates. Every chat and
+direct message carries its send time, so each delivery gives one end-to-end
+latency sample. The results (latency percentiles, message rates, server CPU
+and RSS) are printed and written as JSON so runs can be compared between
+versions.
+
+    python benchmarks/load_test.py --clients 2000 --chat-rate 50 --duration 20
+    python benchmarks/load_test.py --scenario my_scenario.json --output results.json
+
+A scenario file is a JSON list of phases, e.g.
+
+    [{"name": "join_storm", "clients": 2000, "join_rate": 0, "duration": 5},
+     {"name": "chat", "duration": 30, "chat_rate": 100, "dm_rate": 20, "typing_rate": 50},
+     {"name": "typing_burst", "duration": 5, "typing_rate": 2000}]
+
+where "clients" is the number of new clients to connect (join_rate 0 means
+all at once), rates are events per second across all clients, and "rooms"
+spreads the new clients over that many rooms besides the lobby.
+
+The clients share one process with the measurements, so at very high
+delivery rates the load generator itself becomes the bottleneck; watch its
+reported CPU use and split the load over several runs if it nears 100%.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from message_packet import (
+    BINARY_SUBPROTOCOL, DEFAULT_ROOM, JSON_SUBPROTOCOL, ChatMessage, ColorAssignment, DirectMessage, Ping, codec_for, decode_message,
+)
+
+LATENCY_PREFIX = "lt:" # Message text is LATENCY_PREFIX + send time in perf_counter nanoseconds
+MAX_CONCURRENT_HANDSHAKES = 256 # Connects in flight during a join storm
+CONNECT_ATTEMPTS = 10 # Tries per client when the server's admission control answers 503
+SAMPLE_INTERVAL_SECONDS = 0.5 # How often server CPU and RSS are sampled
+TICK_SECONDS = 0.01 # Granularity of the event schedulers
+TYPING_STOP_DELAY_SECONDS = (0.5, 3.0) # A simulated typer stops after a random delay in this range
+PERCENTILES = (("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("p999", 0.999))
+
+
+def percentile_summary(samples_ns):
+    """Returns latency percentiles in milliseconds for a list of nanosecond samples."""
+    if not samples_ns:
+        return {"count": 0}
+    ordered = sorted(samples_ns)
+    summary = {"count": len(ordered)}
+    for name, fraction in PERCENTILES:
+        summary[name] = ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] / 1e6
+    summary["max"] = ordered[-1] / 1e6
+    summary["mean"] = sum(ordered) / len(ordered) / 1e6
+    return summary
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of a process and its children from /proc (Linux only)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.peak_rss = 0
+        self.start_cpu = None
+        self.start_time = None
+
+    def _process_tree(self):
+        pids = [self.pid]
+        try:
+            for entry in os.listdir("/proc"):
+                if entry.isdigit() and self._read_stat(int(entry))[1] == self.pid:
+                    pids.append(int(entry))
+        except OSError:
+            pass
+        return pids
+
+    def _read_stat(self, pid):
+        """Returns (cpu seconds, parent pid, rss bytes) of one process, or (0, None, 0) if it is gone."""
+        try:
+            with open(f"/proc/{pid}/stat") as stat_file:
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return 0.0, None, 0
+        # Fields after the command name: state ppid ... utime(12) stime(13) ... rss(22)
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks, int(fields[1]), int(fields[21]) * self.page_size
+
+    def sample(self):
+        """Returns (total cpu seconds, total rss bytes) of the process tree and tracks the peak RSS."""
+        cpu = rss = 0
+        for pid in self._process_tree():
+            process_cpu, _, process_rss = self._read_stat(pid)
+            cpu += process_cpu
+            rss += process_rss
+        self.peak_rss = max(self.peak_rss, rss)
+        if self.start_cpu is None:
+            self.start_cpu, self.start_time = cpu, time.monotonic()
+        return cpu, rss
+
+    def summary(self):
+        cpu, rss = self.sample()
+        elapsed = time.monotonic() - self.start_time
+        return {
+            "cpu_seconds": round(cpu - self.start_cpu, 3),
+            "cpu_percent": round(100 * (cpu - self.start_cpu) / elapsed, 1) if elapsed else None,
+            "rss_mb_end": round(rss / 2**20, 1),
+            "rss_mb_peak": round(self.peak_rss / 2**20, 1),
+        }
+
+
+class Stats:
+    """Counters and latency samples of the current phase."""
+
+    def __init__(self):
+        self.latencies = [] # Delivery latencies in nanoseconds
+        self.sent = {"message": 0, "direct_message": 0, "typing": 0}
+        self.received = {} # message type -> count
+        self.connects = [] # Handshake durations in nanoseconds
+        self.connect_failures = 0
+        self.connects_refused = 0 # 503 answers from admission control, retried after Retry-After
+        self.disconnects = 0
+
+
+class SimulatedClient:
+    """One simulated chat client: a connection, a reader task and the room it chats in."""
+
+    def __init__(self, room, run):
+        self.room = room
+        self.run = run
+        self.websocket = None
+        self.codec = None
+        self.color = None
+        self.ready = asyncio.Event()
+        self._reader = None
+
+    async def connect(self, url, subprotocol):
+        started = time.perf_counter_ns()
+        self.websocket = await websockets.connect(url, subprotocols=[subprotocol], max_size=None, ping_interval=None)
+        self.codec = codec_for(self.websocket.subprotocol)
+        self._reader = asyncio.create_task(self._read())
+        await self.ready.wait()
+        self.run.stats.connects.append(time.perf_counter_ns() - started)
+        if self.room != DEFAULT_ROOM:
+            await self.send({"type": "join_room", "room": self.room})
+
+    async def _read(self):
+        try:
+            async for frame in self.websocket:
+                now = time.perf_counter_ns()
+                message = decode_message(frame)
+                received = self.run.stats.received
+                received[message.type] = received.get(message.type, 0) + 1
+                if isinstance(message, (ChatMessage, DirectMessage)):
+                    text = message.message
+                    if isinstance(text, str) and text.startswith(LATENCY_PREFIX):
+                        self.run.stats.latencies.append(now - int(text[len(LATENCY_PREFIX):]))
+                elif isinstance(message, ColorAssignment):
+                    self.color = message.color
+                    self.ready.set()
+                elif isinstance(message, Ping):
+                    self.run._spawn(self.send({"type": "pong"})) # Idle clients would otherwise be reaped
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if not self.run.closing:
+                self.run.stats.disconnects += 1
+            self.ready.set()
+
+    async def send(self, message):
+        try:
+            await self.websocket.send(self.codec.encode(message))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self._reader is not None:
+            await self._reader
+
+
+class LoadRun:
+    """Runs a scenario against a server and collects per-phase results."""
+
+    def __init__(self, url, subprotocol, sampler=None, seed=0):
+        self.url = url
+        self.subprotocol = subprotocol
+        self.sampler = sampler
+        self.random = random.Random(seed)
+        self.clients = []
+        self.stats = Stats()
+        self.closing = False
+        self._handshakes = asyncio.Semaphore(MAX_CONCURRENT_HANDSHAKES)
+        self._background = set() # Fire-and-forget send tasks
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _connect_one(self, room):
+        client = SimulatedClient(room, self)
+        for attempt in range(CONNECT_ATTEMPTS):
+            async with self._handshakes:
+                try:
+                    await client.connect(self.url, self.subprotocol)
+                    break
+                except websockets.exceptions.InvalidStatusCode as e:
+                    if e.status_code != 503 or attempt == CONNECT_ATTEMPTS - 1:
+                        self.stats.connect_failures += 1
+                        return
+                    self.stats.connects_refused += 1
+                    headers = getattr(e, "headers", None) or {}
+                    retry_after = headers.get("Retry-After", "1")
+                except (OSError, websockets.exceptions.WebSocketException, asyncio.TimeoutError):
+                    self.stats.connect_failures += 1
+                    return
+            await asyncio.sleep(float(retry_after) if retry_after.isdigit() else 1.0) # Outside the semaphore
+        self.clients.append(client)
+
+    async def _join(self, count, rate, rooms):
+        first_index = len(self.clients)
+        tasks = []
+        for i in range(count):
+            room = DEFAULT_ROOM if rooms <= 1 else f"room-{(first_index + i) % rooms}"
+            tasks.append(asyncio.create_task(self._connect_one(room)))
+            if rate > 0:
+                await asyncio.sleep(1 / rate)
+        await asyncio.gather(*tasks)
+
+    def _live_clients(self):
+        return [client for client in self.clients if client.color is not None and client.websocket.open]
+
+    def _fire_chat(self, clients):
+        sender = self.random.choice(clients)
+        self.stats.sent["message"] += 1
+        self._spawn(sender.send({"type": "message", "room": sender.room, "message": f"{LATENCY_PREFIX}{time.perf_counter_ns()}"}))
+
+    def _fire_direct(self, clients):
+        sender, recipient = self.random.choice(clients), self.random.choice(clients)
+        self.stats.sent["direct_message"] += 1
+        self._spawn(sender.send({"type": "direct_message", "recipient_color": recipient.color, "message": f"{LATENCY_PREFIX}{time.perf_counter_ns()}"}))
+
+    def _fire_typing(self, clients):
+        typer = self.random.choice(clients)
+        self.stats.sent["typing"] += 1
+        self._spawn(typer.send({"type": "typing_start", "room": typer.room}))
+        delay = self.random.uniform(*TYPING_STOP_DELAY_SECONDS)
+        asyncio.get_running_loop().call_later(delay, lambda: self._spawn(typer.send({"type": "typing_stop", "room": typer.room})))
+
+    async def _drive(self, rate, fire, duration):
+        """Calls fire(clients) rate times per second, in batches every TICK_SECONDS, for duration seconds."""
+        if rate <= 0:
+            return
+        started = last = time.monotonic()
+        owed = 0.0
+        while True:
+            await asyncio.sleep(TICK_SECONDS)
+            now = time.monotonic()
+            if now - started >= duration:
+                return
+            owed += (now - last) * rate
+            last = now
+            clients = self._live_clients()
+            while owed >= 1 and clients:
+                fire(clients)
+                owed -= 1
+
+    async def _sample_server(self):
+        while True:
+            self.sampler.sample()
+            await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
+
+    async def run_phase(self, phase):
+        """Runs one phase and returns its results."""
+        self.stats = Stats()
+        name = phase.get("name", "phase")
+        duration = phase.get("duration", 10)
+        server_sampler = ProcessSampler(self.sampler.pid) if self.sampler is not None else None
+        own_sampler = ProcessSampler(os.getpid())
+        for sampler in (server_sampler, own_sampler):
+            if sampler is not None:
+                sampler.sample()
+        sampling = asyncio.create_task(self._sample_server()) if self.sampler is not None else None
+        started = time.monotonic()
+
+        await asyncio.gather(
+            self._join(phase.get("clients", 0), phase.get("join_rate", 0), phase.get("rooms", 1)),
+            self._drive(phase.get("chat_rate", 0), self._fire_chat, duration),
+            self._drive(phase.get("dm_rate", 0), self._fire_direct, duration),
+            self._drive(phase.get("typing_rate", 0), self._fire_typing, duration),
+        )
+        remaining = duration - (time.monotonic() - started)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        await asyncio.sleep(phase.get("drain", 1.0)) # Let in-flight deliveries arrive
+        elapsed = time.monotonic() - started
+        if sampling is not None:
+            sampling.cancel()
+
+        stats = self.stats
+        deliveries = len(stats.latencies)
+        result = {
+            "name": name,
+            "elapsed_seconds": round(elapsed, 3),
+            "connected_clients": len(self._live_clients()),
+            "new_connections": len(stats.connects),
+            "connect_failures": stats.connect_failures,
+            "connects_refused": stats.connects_refused,
+            "disconnects": stats.disconnects,
+            "connect_ms": percentile_summary(stats.connects),
+            "sent": dict(stats.sent),
+            "sent_per_second": {kind: round(count / elapsed, 1) for kind, count in stats.sent.items()},
+            "received": dict(stats.received),
+            "deliveries": deliveries,
+            "deliveries_per_second": round(deliveries / elapsed, 1),
+            "latency_ms": percentile_summary(stats.latencies),
+            "load_generator": own_sampler.summary(),
+        }
+        if server_sampler is not None:
+            server_sampler.peak_rss = max(server_sampler.peak_rss, self.sampler.peak_rss)
+            result["server"] = server_sampler.summary()
+        return result
+
+    async def close(self):
+        self.closing = True
+        await asyncio.gather(*(client.close() for client in self.clients), return_exceptions=True)
+
+
+def raise_file_limit():
+    """Raises the open file limit as far as allowed; every simulated client needs a socket."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+async def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+def start_server(port, workers, log_dir, extra_args=()):
+    """Starts chat_server.py on a local port with its output discarded. extra_args are passed on to it."""
+    command = [sys.executable, os.path.join(REPO_ROOT, "chat_server.py"), "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-dir", log_dir, *extra_args]
+    return subprocess.Popen(command, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def build_scenario(args):
+    if args.scenario:
+        with open(args.scenario) as scenario_file:
+            return json.load(scenario_file)
+    return [
+        {"name": "join", "clients": args.clients, "join_rate": args.join_rate, "rooms": args.rooms, "duration": 0},
+        {"name": "steady", "duration": args.duration, "chat_rate": args.chat_rate, "dm_rate": args.dm_rate, "typing_rate": args.typing_rate},
+    ]
+
+def print_phase(result):
+    latency = result["latency_ms"]
+    line = f"{result['name']:<14} clients={result['connected_clients']:<6} deliveries/s={result['deliveries_per_second']:<10}"
+    if latency["count"]:
+        line += f" p50={latency['p50']:.2f}ms p99={latency['p99']:.2f}ms p999={latency['p999']:.2f}ms"
+    if "server" in result:
+        line += f" server cpu={result['server']['cpu_percent']}% rss={result['server']['rss_mb_peak']}MB"
+    line += f" loadgen cpu={result['load_generator']['cpu_percent']}%"
+    print(line)
+
+async def main(args):
+    raise_file_limit()
+    scenario = build_scenario(args)
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        server = start_server(port, args.workers, args.log_dir)
+        url = f"ws://127.0.0.1:{port}"
+        await wait_for_port(port)
+
+    subprotocol = BINARY_SUBPROTOCOL if args.protocol == "binary" else JSON_SUBPROTOCOL
+    run = LoadRun(url, subprotocol, ProcessSampler(server.pid) if server is not None else None, args.seed)
+    results = {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "url": url if server is None else None,
+        "config": {"protocol": args.protocol, "workers": args.workers if server is not None else None, "log_dir": args.log_dir, "seed": args.seed},
+        "scenario": scenario,
+        "phases": [],
+    }
+    try:
+        for phase in scenario:
+            result = await run.run_phase(phase)
+            results["phases"].append(result)
+            print_phase(result)
+    finally:
+        await run.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test chat_server.py with simulated clients")
+    parser.add_argument("--url", help="server to test (default: start a local chat_server.py)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the local server")
+    parser.add_argument("--log-dir", default="", help="message log directory of the local server (default: no history)")
+    parser.add_argument("--protocol", choices=("json", "binary"), default="json", help="wire protocol the clients negotiate")
+    parser.add_argument("--scenario", help="JSON file with a list of phases (overrides the options below)")
+    parser.add_argument("--clients", type=int, default=500, help="clients to connect")
+    parser.add_argument("--join-rate", type=float, default=0, help="clients connected per second (0: all at once)")
+    parser.add_argument("--rooms", type=int, default=1, help="spread clients over this many rooms besides the lobby")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of steady traffic")
+    parser.add_argument("--chat-rate", type=float, default=20, help="chat messages per second across all clients")
+    parser.add_argument("--dm-rate", type=float, default=10, help="direct messages per second across all clients")
+    parser.add_argument("--typing-rate", type=float, default=20, help="typing bursts per second across all clients")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for picking senders")
+    parser.add_argument("--output", default="load_test_results.json", help="where to write the JSON results")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,222 @@
+"""
+Replays traffic recorded with `chat_server.py --capture FILE` against a server.
+
+Connections are opened, fed their frames and closed in exactly the recorded
+order, at the recorded pace (--speed 1), N times faster (--speed N) or as
+fast as the server accepts them (--speed 0). Each replayed connection is
+opened with the subprotocol it originally negotiated and waits for its
+color_assignment before the next event, so the server sees the same
+interleaving of connections as in the capture. Direct messages are
+re-addressed from the recorded recipient colors to the colors handed out
+during the replay. Resume parameters are dropped from the connection URLs,
+so a client that resumed in the capture starts a new session in the replay.
+
+    python benchmarks/replay_capture.py capture.bin --speed 4
+    python benchmarks/replay_capture.py capture.bin.worker-0 capture.bin.worker-1 --speed 0 --output replay.json
+
+Without --url a local chat_server.py is started, as in load_test.py. The
+report gives how late events were sent relative to their schedule, frames
+sent and received per second and the server's CPU and RSS.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+import websockets
+
+from load_test import ProcessSampler, free_port, git_revision, percentile_summary, raise_file_limit, start_server, wait_for_port
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from message_packet import codec_for, decode_frame
+from traffic_capture import BINARY_FRAME, CLOSED, OPENED, TEXT_FRAME, merge_captures
+
+RESUME_PARAMETERS = ("resume", "since", "direct")
+
+
+class ReplayedConnection:
+    """A connection opened for a captured one, and the reader task draining what the server sends it."""
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.websocket = None
+        self.codec = None
+        self.color = None
+        self.assigned = asyncio.Event()
+        self._reader = None
+
+    async def open(self, url, subprotocol):
+        self.websocket = await websockets.connect(url, subprotocols=[subprotocol] if subprotocol else None, max_size=None, ping_interval=None)
+        self.codec = codec_for(self.websocket.subprotocol)
+        self._reader = asyncio.create_task(self._read())
+        await self.assigned.wait()
+
+    async def _read(self):
+        try:
+            async for frame in self.websocket:
+                self.replay.received += 1
+                if self.color is None:
+                    try:
+                        message = decode_frame(frame)
+                    except ValueError: # Not ours to judge; the color assignment is still to come
+                        continue
+                    if isinstance(message, dict) and message.get("type") == "color_assignment":
+                        self.color = message["color"]
+                        self.assigned.set()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.assigned.set()
+
+    async def close(self, code=1000):
+        if code not in (1000, 1001):
+            self.websocket.transport.abort() # Dropped in the capture, so drop it here too and let the session linger
+        else:
+            await self.websocket.close(code)
+        await self._reader
+
+
+class Replay:
+    """Plays a stream of capture events against a server."""
+
+    def __init__(self, url, speed):
+        self.url = url
+        self.speed = speed
+        self.connections = {} # captured connection -> ReplayedConnection
+        self.colors = {} # color in the capture -> color in the replay
+        self.lateness = [] # Nanoseconds each event was sent after its scheduled time
+        self.opened = 0
+        self.sent = 0
+        self.received = 0
+        self.failures = 0
+
+    def connection_url(self, path):
+        """Joins a captured request path to the server URL, minus its resume parameters."""
+        query = [(name, value) for name, value in urllib.parse.parse_qsl(urllib.parse.urlsplit(path or "/").query) if name not in RESUME_PARAMETERS]
+        return self.url.rstrip("/") + "/" + (f"?{urllib.parse.urlencode(query)}" if query else "")
+
+    def readdress(self, connection, frame):
+        """Maps a direct message's recipient to the color that client got in this replay. Other frames are sent unchanged."""
+        try:
+            message = decode_frame(frame)
+        except ValueError: # A malformed frame was captured as sent, so replay it as sent
+            return frame
+        if not isinstance(message, dict) or message.get("type") != "direct_message" or not isinstance(message.get("recipient_color"), str):
+            return frame
+        if message["recipient_color"] not in self.colors:
+            return frame
+        return connection.codec.encode(dict(message, recipient_color=self.colors[message["recipient_color"]]))
+
+    async def apply(self, event):
+        connection = self.connections.get(event.connection)
+        if event.kind == OPENED:
+            connection = ReplayedConnection(self)
+            try:
+                await connection.open(self.connection_url(event.data["path"]), event.data["subprotocol"])
+            except (OSError, websockets.exceptions.WebSocketException):
+                self.failures += 1
+                return
+            self.connections[event.connection] = connection
+            self.opened += 1
+            if connection.color is not None:
+                self.colors[event.data["color"]] = connection.color
+        elif connection is None:
+            return # Opened before the capture started, or its connect failed
+        elif event.kind in (TEXT_FRAME, BINARY_FRAME):
+            try:
+                await connection.websocket.send(self.readdress(connection, event.data))
+                self.sent += 1
+            except websockets.exceptions.ConnectionClosed:
+                pass
+        elif event.kind == CLOSED:
+            del self.connections[event.connection]
+            await connection.close(event.data)
+
+    async def run(self, events):
+        """Replays events in order, holding each one back until its scaled time has come."""
+        started = time.perf_counter_ns()
+        first_event = None
+        for event in events:
+            if first_event is None:
+                first_event = event.time_ns
+            if self.speed > 0:
+                due = started + (event.time_ns - first_event) / self.speed
+                wait = due - time.perf_counter_ns()
+                if wait > 0:
+                    await asyncio.sleep(wait / 1e9)
+                self.lateness.append(max(0, time.perf_counter_ns() - due))
+            await self.apply(event)
+
+    async def close(self):
+        """Closes the connections still open at the end of the capture."""
+        await asyncio.gather(*(connection.close() for connection in self.connections.values()), return_exceptions=True)
+        self.connections.clear()
+
+async def main(args):
+    raise_file_limit()
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        server = start_server(port, args.workers, args.log_dir)
+        url = f"ws://127.0.0.1:{port}"
+        await wait_for_port(port)
+
+    replay = Replay(url, args.speed)
+    sampler = ProcessSampler(server.pid) if server is not None else None
+    if sampler is not None:
+        sampler.sample()
+    started = time.monotonic()
+    try:
+        await replay.run(merge_captures(args.captures))
+        await asyncio.sleep(args.drain) # Let the server's last frames arrive
+    finally:
+        await replay.close()
+        elapsed = time.monotonic() - started
+        server_summary = sampler.summary() if sampler is not None else None
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "captures": args.captures,
+        "url": url if server is None else None,
+        "config": {"speed": args.speed, "workers": args.workers if server is not None else None, "log_dir": args.log_dir},
+        "elapsed_seconds": round(elapsed, 3),
+        "connections": replay.opened,
+        "connect_failures": replay.failures,
+        "frames_sent": replay.sent,
+        "frames_received": replay.received,
+        "sent_per_second": round(replay.sent / elapsed, 1),
+        "received_per_second": round(replay.received / elapsed, 1),
+        "lateness_ms": percentile_summary(replay.lateness),
+    }
+    if server_summary is not None:
+        results["server"] = server_summary
+    print(
+        f"replayed {replay.sent} frames on {replay.opened} connections in {elapsed:.2f}s, "
+        f"received {replay.received} ({results['received_per_second']}/s)"
+        + (f", server cpu={server_summary['cpu_percent']}% rss={server_summary['rss_mb_peak']}MB" if server_summary else "")
+    )
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured chat_server.py traffic")
+    parser.add_argument("captures", nargs="+", help="capture files; several (e.g. one per worker) are merged by time")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor (0: as fast as possible)")
+    parser.add_argument("--url", help="server to replay against (default: start a local chat_server.py)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the local server")
+    parser.add_argument("--log-dir", default="", help="message log directory of the local server (default: no history)")
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to keep reading after the last event")
+    parser.add_argument("--output", help="where to write the JSON results")
+    asyncio.run(main(parser.parse_args()))
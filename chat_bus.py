@@ -0,0 +1,178 @@
+import asyncio
+import os
+import struct
+from message_packet import json_dumpb, json_loads
+
+# Every bus frame is a 4-byte big-endian length followed by a JSON envelope
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_envelope(envelope):
+    """Encodes an envelope as a length-prefixed bus frame."""
+    body = json_dumpb(envelope)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+async def read_envelope(reader):
+    """
+    Reads one envelope from a bus stream.
+
+    Returns:
+        dict: The decoded envelope, or None once the stream is closed.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Bus frame of {length} bytes is too large.")
+        return json_loads(await reader.readexactly(length))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+class BusBroker:
+    """
+    Relays envelopes between chat server workers over a Unix socket.
+
+    Workers introduce themselves with {"kind": "hello", "worker": id}. After
+    that, an envelope with a "to" worker id is forwarded to that worker only,
+    and any other envelope is forwarded to every worker except its sender.
+    The broker also tells the remaining workers when a worker joins ("sync",
+    so they can send it their clients) and when one goes away ("worker_down",
+    so they can forget its clients).
+
+    The broker is a small in-process asyncio server, so a supervisor and its
+    workers can run on a single machine without any external message broker.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Filesystem path of the Unix socket to listen on.
+        """
+        self.path = path
+        self.workers = {} # worker id -> StreamWriter
+        self._server = None
+        self._handlers = set() # Tasks serving connected workers
+
+    async def start(self):
+        """Starts listening for workers."""
+        if os.path.exists(self.path):
+            os.unlink(self.path) # Left over from a previous run
+        self._server = await asyncio.start_unix_server(self._handle_worker, path=self.path)
+
+    async def close(self):
+        """Stops the broker and disconnects all workers."""
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self.workers.values()):
+            writer.close()
+        if self._handlers:
+            await asyncio.wait(self._handlers) # Let each handler notice its closed connection and finish
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _send(self, worker, envelope):
+        writer = self.workers.get(worker)
+        if writer is not None and not writer.is_closing():
+            writer.write(encode_envelope(envelope)) # Local socket; workers drain it continuously
+
+    def _send_to_others(self, sender, envelope):
+        frame = encode_envelope(envelope) # Encode once for every worker
+        for worker, writer in self.workers.items():
+            if worker != sender and not writer.is_closing():
+                writer.write(frame)
+
+    async def _handle_worker(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            await self._serve_worker(reader, writer)
+        finally:
+            self._handlers.discard(task)
+
+    async def _serve_worker(self, reader, writer):
+        hello = await read_envelope(reader)
+        if not hello or hello.get("kind") != "hello":
+            writer.close()
+            return
+        worker = hello["worker"]
+        self.workers[worker] = writer
+        self._send_to_others(worker, {"kind": "sync", "worker": worker})
+
+        try:
+            while True:
+                envelope = await read_envelope(reader)
+                if envelope is None:
+                    break
+                envelope["from"] = worker
+                target = envelope.get("to")
+                if target is None:
+                    self._send_to_others(worker, envelope)
+                else:
+                    self._send(target, envelope)
+        finally:
+            if self.workers.get(worker) is writer:
+                del self.workers[worker]
+                self._send_to_others(worker, {"kind": "worker_down", "worker": worker})
+            writer.close()
+
+
+class BusClient:
+    """
+    A worker's connection to the BusBroker.
+
+    publish() never waits, so relaying to other workers adds no latency to
+    the local broadcast. Incoming envelopes are handed to on_envelope from
+    the run() task.
+    """
+
+    def __init__(self, path, worker, on_envelope):
+        """
+        Args:
+            path (str): Filesystem path of the broker's Unix socket.
+            worker (int): This worker's id.
+            on_envelope (callable): Called with every envelope received from other workers.
+        """
+        self.path = path
+        self.worker = worker
+        self.on_envelope = on_envelope
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        """Connects to the broker and introduces this worker."""
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._writer.write(encode_envelope({"kind": "hello", "worker": self.worker}))
+        await self._writer.drain()
+
+    def publish(self, envelope, to=None):
+        """
+        Sends an envelope to one worker, or to all other workers if to is None.
+
+        Returns:
+            bool: True if the envelope was written to the bus.
+        """
+        if self._writer is None or self._writer.is_closing():
+            return False
+        if to is not None:
+            envelope = dict(envelope, to=to)
+        self._writer.write(encode_envelope(envelope))
+        return True
+
+    async def run(self):
+        """Dispatches incoming envelopes until the broker goes away."""
+        while True:
+            envelope = await read_envelope(self._reader)
+            if envelope is None:
+                break
+            try:
+                self.on_envelope(envelope)
+            except Exception as e:
+                print(f"Error handling bus envelope: {e}")
+
+    def close(self):
+        """Closes the connection to the broker."""
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,241 @@
+import bisect
+from PySide6.QtCore import QAbstractListModel, QModelIndex, Qt, QTimer
+from PySide6.QtGui import QBrush, QColor
+
+CHAT_LOG_ROWS = 5000 # Rows kept in the model, whether or not the view follows the newest messages
+CHAT_LOG_ARCHIVE_ROWS = 100000 # Rows kept (as plain tuples) above the model for scrolling back, and at most as many below it
+CHAT_LOG_PAGE_ROWS = 500 # Rows brought back into the model each time the view reaches the top or bottom
+CHAT_LOG_FLUSH_MS = 16 # Incoming rows are inserted at most once per frame
+
+
+class ChatLogModel(QAbstractListModel):
+    """
+    A list model of chat log lines that stays cheap however busy the room is.
+
+    append() only queues a line; a single-shot timer inserts everything
+    queued since the last frame with one beginInsertRows/endInsertRows, so
+    the view lays out and repaints once per frame instead of once per
+    message. The model never holds more than max_rows lines. While the view
+    follows the newest messages, older ones are moved to a bounded archive
+    of plain (sender color, text) tuples and brought back a page at a time
+    by load_older() when the user scrolls to the top. While the user is
+    scrolled up, lines arriving beyond the cap wait in a bounded buffer below
+    the model and are paged in by load_newer() when the view reaches the
+    bottom; paging either way moves as many lines out at the other end.
+    """
+
+    def __init__(self, parent=None, max_rows=CHAT_LOG_ROWS, archive_rows=CHAT_LOG_ARCHIVE_ROWS, flush_ms=CHAT_LOG_FLUSH_MS):
+        super().__init__(parent)
+        self.max_rows = max_rows
+        self.archive_rows = archive_rows
+        self.rows = [] # (sender color or None for status lines, displayed line)
+        self.archive = [] # Rows trimmed from the top, oldest first
+        self.newer = [] # Rows below the model while the view is scrolled up, oldest first
+        self.following = True # The view shows the newest rows, so the top may be trimmed
+        self._pending = []
+        self._colors = {} # color code -> QColor, shared by every row of that sender
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(flush_ms)
+        self._flush_timer.timeout.connect(self.flush)
+
+    def append(self, text, sender_color=None):
+        """Queues a line for the next batched insert. A sender color adds a color swatch in front of it."""
+        self._pending.append((sender_color, text))
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def flush(self):
+        """
+        Inserts every queued line with one row insert. If the view is
+        following the model is then trimmed from the top; otherwise lines
+        that do not fit under max_rows are kept below the model instead.
+        """
+        self._flush_timer.stop()
+        if self._pending:
+            rows, self._pending = self._pending, []
+            if self.newer or not self.following:
+                room = 0 if self.newer else max(self.max_rows - len(self.rows), 0)
+                self.newer.extend(rows[room:])
+                rows = rows[:room]
+                if len(self.newer) > self.archive_rows: # Scrolled up for a long time in a busy room
+                    del self.newer[:len(self.newer) - self.archive_rows]
+            self._insert(len(self.rows), rows)
+        if self.following:
+            self.trim()
+
+    def _insert(self, first, rows):
+        if rows:
+            self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+            self.rows[first:first] = rows
+            self.endInsertRows()
+
+    def trim(self):
+        """
+        Moves rows beyond max_rows from the top of the model to the archive.
+
+        Returns:
+            int: The number of rows removed.
+        """
+        excess = len(self.rows) - self.max_rows
+        if excess <= 0:
+            return 0
+        self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+        self.archive.extend(self.rows[:excess])
+        del self.rows[:excess]
+        self.endRemoveRows()
+        if len(self.archive) > self.archive_rows:
+            del self.archive[:len(self.archive) - self.archive_rows]
+        return excess
+
+    def _trim_bottom(self):
+        """Moves rows beyond max_rows from the bottom of the model back to the rows below it."""
+        excess = len(self.rows) - self.max_rows
+        if excess <= 0:
+            return
+        first = len(self.rows) - excess
+        self.beginRemoveRows(QModelIndex(), first, len(self.rows) - 1)
+        self.newer[:0] = self.rows[first:]
+        del self.rows[first:]
+        self.endRemoveRows()
+
+    def has_older(self):
+        return bool(self.archive)
+
+    def has_newer(self):
+        return bool(self.newer)
+
+    def load_older(self, count=CHAT_LOG_PAGE_ROWS):
+        """
+        Moves up to count archived rows back to the top of the model.
+
+        Returns:
+            int: The number of rows inserted.
+        """
+        count = min(count, len(self.archive))
+        if not count:
+            return 0
+        self._insert(0, self.archive[-count:])
+        del self.archive[-count:]
+        self._trim_bottom()
+        return count
+
+    def load_newer(self, count=CHAT_LOG_PAGE_ROWS):
+        """
+        Moves up to count of the rows waiting below the model to its bottom,
+        and as many rows from its top to the archive.
+
+        Returns:
+            int: The number of rows removed from the top.
+        """
+        rows = self.newer[:count]
+        del self.newer[:count]
+        self._insert(len(self.rows), rows)
+        return self.trim()
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.archive = []
+        self.newer = []
+        self._pending = []
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        sender_color, text = self.rows[index.row()]
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.ToolTipRole): # The tooltip shows lines the view elides
+            return text
+        if role == Qt.ItemDataRole.DecorationRole and sender_color is not None:
+            return self._color(sender_color)
+        return None
+
+    def _color(self, code):
+        color = self._colors.get(code)
+        if color is None:
+            color = self._colors[code] = QColor(code)
+        return color
+
+
+class UserListModel(QAbstractListModel):
+    """
+    A list model of a room's users, keyed by color and kept sorted by it.
+
+    Presence deltas are applied as row inserts and removals, so a join or a
+    leave touches only its own row and the view keeps its scroll position and
+    selection. Colors are kept in a sorted list, which makes finding a user's
+    row a binary search. Users joining or leaving together that end up next
+    to each other are inserted or removed as one range. Foreground brushes
+    are cached per color. Filter the model through a QSortFilterProxyModel
+    to search it.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.colors = [] # Sorted
+        self._brushes = {} # color -> QBrush
+
+    def set_users(self, clients):
+        """Replaces every user, e.g. with a room snapshot."""
+        self.beginResetModel()
+        self.colors = sorted({client["color"] for client in clients if client.get("color")})
+        self.endResetModel()
+
+    def _row(self, color):
+        row = bisect.bisect_left(self.colors, color)
+        return row if row < len(self.colors) and self.colors[row] == color else None
+
+    def add_users(self, clients):
+        """Inserts the users that are not listed yet."""
+        new = sorted({client["color"] for client in clients if client.get("color") and self._row(client["color"]) is None})
+        # Walk backwards so inserting a run never shifts the rows of the runs still to be inserted
+        end = len(new)
+        while end:
+            row = bisect.bisect_left(self.colors, new[end - 1])
+            start = end - 1
+            while start and bisect.bisect_left(self.colors, new[start - 1]) == row:
+                start -= 1
+            self.beginInsertRows(QModelIndex(), row, row + end - start - 1)
+            self.colors[row:row] = new[start:end]
+            self.endInsertRows()
+            end = start
+
+    def remove_users(self, clients):
+        """Removes the listed users."""
+        rows = sorted({row for row in (self._row(client["color"]) for client in clients if client.get("color")) if row is not None})
+        # Remove runs of adjacent rows from the bottom up, so earlier rows keep their numbers
+        end = len(rows)
+        while end:
+            start = end - 1
+            while start and rows[start - 1] == rows[start] - 1:
+                start -= 1
+            first, last = rows[start], rows[end - 1]
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.colors[first:last + 1]
+            self.endRemoveRows()
+            end = start
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.colors)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        color = self.colors[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"User: {color}"
+        if role == Qt.ItemDataRole.ForegroundRole:
+            return self._brush(color)
+        if role == Qt.ItemDataRole.UserRole:
+            return color
+        return None
+
+    def _brush(self, color):
+        brush = self._brushes.get(color)
+        if brush is None:
+            brush = self._brushes[color] = QBrush(QColor(color))
+        return brush
@@ -1,121 +1,939 @@
+import argparse
 import asyncio
+import collections
+import concurrent.futures
+import http
+import itertools
+import math
+import multiprocessing
+import os
+import secrets
+import signal
+import tempfile
+import urllib.parse
 import websockets
-import json
-import secrets  # For generating random colors and potentially client IDs in the future
-import random
-
-connected_clients = set()
-client_colors = {}
-typing_clients = set()
-
-async def get_client_list_message():
-    """Generates a client list message payload."""
-    client_list = [{"color": client_colors[client]} for client in connected_clients if client in client_colors] # Ensure client is still in client_colors
-    return {"type": "client_list", "clients": client_list}
-
-async def broadcast_client_list():
-    """Broadcasts the updated client list to all connected clients."""
-    message = await get_client_list_message()
-    if connected_clients: # Avoid error if no clients are connected during server start/shutdown
-        # Create tasks for each send operation
-        send_tasks = [
-            asyncio.create_task(client.send(json.dumps(message)))
-            for client in connected_clients if client.open
-        ]
-        if send_tasks: # Only await if there are tasks to wait for
-            await asyncio.wait(send_tasks)
-
-def generate_unique_color():
-    """Generates a random pastel hex color code."""
-    return f"#{random.randint(128, 255):02x}{random.randint(128, 255):02x}{random.randint(128, 255):02x}"
-
-async def send_direct_message(sender, recipient_color, message_text):
-    """Sends a direct message to a specific client."""
-    recipient_client = None
-    for client, color in client_colors.items():
-        if color == recipient_color:
-            recipient_client = client
-            break
-    if recipient_client and recipient_client in connected_clients and recipient_client.open: # Check if recipient is connected and open
-        message = {
-            "type": "direct_message",
-            "sender_color": client_colors[sender],
-            "message": message_text,
-            "recipient_color": recipient_color
-        }
-        await recipient_client.send(json.dumps(message))
+import time
+
+try:
+    import resource
+except ImportError: # Not on Windows
+    resource = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+from chat_bus import BusBroker, BusClient
+from heartbeat import HeartbeatMonitor
+from message_log import FSYNC_INTERVAL_SECONDS, MessageStore
+from message_packet import (
+    BINARY_SUBPROTOCOL, DEFAULT_ROOM, JSON_SUBPROTOCOL, MAX_MESSAGE_LENGTH, ChatMessage, DirectMessage, EncodeCache, EncodedMessage, JoinRoom, LeaveRoom, Ping, Pong,
+    Search, TypingStart, TypingStop, UnknownMessage, codec_for, decode_message,
+)
+from outbound_queue import DROP_EPHEMERAL, PRIORITY_CHAT, PRIORITY_PRESENCE, PRIORITY_TYPING, OutboundQueue, OutboundStats
+from rate_limit import HANDSHAKE_BURST, HANDSHAKE_RATE, MAX_CONNECTIONS, AdmissionControl
+from search_index import SEARCH_PAGE_SIZE, SearchIndex
+from server_metrics import MetricsRegistry, MetricsServer
+from session_registry import ColorAllocator, SessionRegistry
+from timer_wheel import TimerWheel
+from traffic_capture import TrafficCapture
+
+PRESENCE_COALESCE_SECONDS = 0.05 # Joins and leaves inside this window are sent as a single presence frame
+TYPING_TIMEOUT_SECONDS = 5.0 # A typer that has not refreshed typing_start for this long is considered stopped
+TYPING_MIN_INTERVAL_SECONDS = 1.0 # Minimum gap between two typing transitions broadcast for the same sender
+TYPING_TICK_SECONDS = 0.25 # Resolution of the typing timer wheel
+OUTBOUND_QUEUE_SIZE = 256 # Frames that may wait for a single slow client
+OUTBOUND_OVERFLOW_POLICY = DROP_EPHEMERAL # What to do when a client's queue is full (see outbound_queue.py)
+OUTBOUND_STATS_INTERVAL_SECONDS = 60 # How often queue depth and eviction counts are printed
+WORKER_RESTART_DELAY_SECONDS = 1.0 # How long the supervisor waits before restarting a dead worker
+MAX_ROOM_NAME_LENGTH = 64
+MAX_ROOMS_PER_SESSION = 32 # Rooms one client may be in at once
+HISTORY_ON_JOIN = 50 # Number of recent room messages sent to a client joining a room
+HISTORY_CACHE_SIZE = 256 # Encoded history frames kept for rooms that are joined often
+ROOM_RING_SIZE = 512 # Sequenced frames each room keeps in memory for resuming clients
+RESUME_GRACE_SECONDS = 30.0 # How long the session of a dropped connection waits to be resumed
+SEARCH_THREADS = 2 # Threads running search queries, off the event loop
+MAX_PENDING_SEARCHES = 64 # Searches queued or running at once; more are refused with an error
+SEARCH_REINDEX_MESSAGES = 100000 # Stored messages per room indexed again when the server starts
+RATE_LIMIT_CLOSE_CODE = 1008 # Policy violation; sent to a client exceeding its overall frame budget
+# websockets connection settings, sized for many mostly idle clients sending small frames
+MAX_FRAME_BYTES = 64 * 1024 # Largest frame a client may send (library default 1 MiB); far above any MAX_MESSAGE_LENGTH message
+INCOMING_QUEUE_FRAMES = 8 # Received frames buffered ahead of handle_client (default 32)
+READ_LIMIT_BYTES = 16 * 1024 # High-water mark of the receive buffer (default 64 KiB)
+WRITE_LIMIT_BYTES = 16 * 1024 # High-water mark of the send buffer (default 64 KiB)
+RESERVED_FILE_DESCRIPTORS = 1024 # Kept out of the connection cap for room logs, the bus, metrics and captures
+
+# Outbound priority class of each message type; anything not listed is sent as chat
+FRAME_PRIORITIES = {
+    "client_list": PRIORITY_PRESENCE,
+    "presence": PRIORITY_PRESENCE,
+    "typing_start": PRIORITY_TYPING,
+    "typing_stop": PRIORITY_TYPING,
+}
+
+# Room frames that are numbered and kept for resuming clients; typing indicators are not worth replaying. Presence
+# deltas are not numbered either: queued in a lower priority class, they can be overtaken by later chat frames, so
+# they cannot share the chat sequence. A resuming client gets a fresh client_list snapshot instead.
+SEQUENCED_TYPES = ("message",)
+
+registry = SessionRegistry() # Sessions of connected (and recently dropped) clients
+outbound_stats = OutboundStats()
+bus = None # BusClient connecting this worker to the others, when running with several workers
+remote_clients = {} # color -> id of the worker the client is connected to, for clients on other workers
+rooms = {} # room name -> Room, for every room with at least one member anywhere
+message_store = None # MessageStore persisting room messages, when a log directory is configured
+message_id_prefix = "0" # Unique per worker process, so message ids never collide across workers
+message_ids = itertools.count(1)
+history_cache = EncodeCache(HISTORY_CACHE_SIZE) # (room name, log position) -> encoded history frame
+capture = None # TrafficCapture recording inbound traffic, when a capture file is configured
+connection_ids = itertools.count(1) # Identifies connections in the capture
+search_index = SearchIndex() # Inverted index of every room message this worker has recorded
+search_executor = concurrent.futures.ThreadPoolExecutor(SEARCH_THREADS, thread_name_prefix="search")
+search_tasks = set() # Searches in progress; also keeps their tasks referenced until they finish
+admission = AdmissionControl() # Caps open connections and the handshake rate of this worker
+PING = EncodedMessage({"type": "ping"}) # Heartbeat frame, encoded once per protocol for every idle connection
+NO_HEADERS = websockets.Headers() # Shared by every connection once its handshake is done
+# websockets 10 reads a connection's handshake headers only during the handshake, so dropping them afterwards saves
+# about 4.8 KiB per idle client (see README). Other versions are not known to leave them alone, so they keep them.
+DROP_HANDSHAKE_HEADERS = websockets.version.version.split(".")[0] == "10"
+
+metrics = MetricsRegistry()
+frames_received = metrics.counter("chat_frames_received_total", "Frames received from clients, by message type (\"unknown\" for types the server does not know).", "type")
+bytes_received = metrics.counter("chat_received_bytes_total", "Payload bytes of frames received from clients.")
+frame_handler_seconds = metrics.histogram("chat_frame_handler_seconds", "Time spent handling one received frame.")
+broadcasts = metrics.counter("chat_broadcasts_total", "Room broadcasts fanned out on this worker, by message type.", "type")
+fanout_seconds = metrics.histogram("chat_fanout_seconds", "Time spent encoding and queueing one broadcast for its room.")
+fanout_frames = metrics.counter("chat_fanout_frames_total", "Frames queued to local clients by broadcasts.")
+connections_opened = metrics.counter("chat_connections_opened_total", "WebSocket connections accepted, by whether they resumed a session.", "resumed")
+search_seconds = metrics.histogram("chat_search_seconds", "Time from accepting a search to having its results, including the wait for a search thread.")
+rate_limited_frames = metrics.counter("chat_rate_limited_frames_total", "Frames refused by a per-connection rate limit, by message type (\"all\" for the overall budget).", "type")
+searches_refused = metrics.counter("chat_searches_refused_total", "Searches refused because too many were pending.")
+
+async def get_client_list_message(room):
+    """Generates a client list message payload for a room, as of its last presence flush."""
+    client_list = [{"color": color} for color in room.announced_colors()]
+    return {"type": "client_list", "room": room.name, "clients": client_list, "seq": room.seq}
+
+def next_message_id():
+    """Returns a new id for a message or direct message, which clients use to drop duplicates."""
+    return f"{message_id_prefix}-{next(message_ids)}"
+
+def frame_class(message):
+    """
+    Returns the outbound (priority, key) of a message.
+
+    Queued frames with the same key supersede each other: a newer client_list
+    snapshot replaces an unsent one, and a sender's latest typing state replaces
+    its previous one.
+    """
+    message_type = message.get("type")
+    priority = FRAME_PRIORITIES.get(message_type, PRIORITY_CHAT)
+    if message_type == "client_list":
+        return priority, ("client_list", message.get("room"))
+    if priority == PRIORITY_TYPING:
+        return priority, ("typing", message.get("room"), message.get("sender_color"))
+    return priority, None
+
+def send_to(session, message):
+    """
+    Queues a message for a single client without waiting on its socket.
+
+    Returns:
+        bool: True if the message was queued, False if the session is detached.
+    """
+    if session.queue is None:
+        return False
+    return session.queue.put(session.codec.encode(message), *frame_class(message))
+
+def send_encoded(session, encoded):
+    """
+    Queues an EncodedMessage for a single client, reusing its frame if it was already encoded in the client's protocol.
+
+    Returns:
+        bool: True if the message was queued, False if the session is detached.
+    """
+    if session.queue is None:
+        return False
+    return session.queue.put(encoded.frame(session.codec), *frame_class(encoded.message))
+
+def deliver_direct(session, message):
+    """
+    Numbers a direct message for a session, remembers it for resuming and queues it.
+
+    A detached session still gets the message buffered, so it is delivered
+    when the client resumes.
+    """
+    session.direct_seq += 1
+    encoded = EncodedMessage(dict(message, seq=session.direct_seq))
+    session.buffer_direct(session.direct_seq, encoded)
+    send_encoded(session, encoded)
+
+def broadcast(message, exclude=None, relay=True):
+    """
+    Encodes a message once per wire protocol and queues the same frame for every member of its room.
+
+    The room is taken from the message's "room" field, and only that room's
+    membership index is walked, so the cost depends on the room's size rather
+    than the number of clients on the server. Each client's writer task sends
+    the frame at that client's own pace, so no task is created per recipient
+    and a slow client never holds up the caller. When running with several
+    workers the message is also relayed over the bus, so room members
+    connected to other workers receive it too.
+
+    Chat messages are stamped with the room's next sequence number and kept
+    in the room's ring buffer, so a client that reconnects can be sent just
+    the messages it missed.
+
+    Args:
+        message (dict): The message payload to broadcast. Must have a "room" field.
+        exclude (Session, optional): A session that should not receive the message.
+        relay (bool, optional): Whether to relay the message to other workers. Defaults to True.
+
+    Returns:
+        int: The number of local clients the frame was queued for.
+    """
+    if relay and bus is not None:
+        bus.publish({"kind": "relay", "message": message}) # Unnumbered; every worker numbers its own copy
+    room = rooms.get(message["room"])
+    if room is None:
+        return 0
+    started = time.perf_counter()
+    priority, key = frame_class(message)
+    sequenced = message.get("type") in SEQUENCED_TYPES
+    if sequenced:
+        room.seq += 1
+        message = dict(message, seq=room.seq)
+    encoded = EncodedMessage(message) # Serialized once per protocol for the whole fan-out
+    if sequenced:
+        room.ring.append((room.seq, encoded, priority, exclude.color if exclude is not None else None)) # Replays reuse the frames
+    sent = 0
+    for session in room.members:
+        if session is not exclude and session.queue is not None and session.queue.put(encoded.frame(session.codec), priority, key):
+            sent += 1
+    fanout_seconds.observe(time.perf_counter() - started)
+    broadcasts.inc(label=message.get("type"))
+    fanout_frames.inc(sent)
+    return sent
+
+def register_gauges():
+    """Adds the metrics that are read from server state when metrics are scraped."""
+    def outbound(name):
+        return lambda: get_outbound_stats()[name]
+    metrics.gauge("chat_connections", "Open client connections.", outbound("connections"))
+    metrics.gauge("chat_detached_sessions", "Sessions waiting for their client to resume.", outbound("detached_sessions"))
+    metrics.gauge("chat_rooms", "Rooms with at least one member on any worker.", lambda: len(rooms))
+    metrics.gauge("chat_outbound_queued_frames", "Frames waiting in outbound queues.", outbound("queued_frames"))
+    metrics.gauge("chat_outbound_max_queue_depth", "Frames waiting in the fullest outbound queue.", outbound("max_queue_depth"))
+    metrics.function_counter("chat_outbound_dropped_frames_total", "Frames discarded because a queue was full.", lambda: outbound_stats.dropped_frames)
+    metrics.function_counter("chat_outbound_superseded_frames_total", "Queued frames replaced by a newer one.", lambda: outbound_stats.superseded_frames)
+    metrics.function_counter("chat_outbound_evicted_clients_total", "Connections closed because their queue was full.", lambda: outbound_stats.evicted_clients)
+    metrics.function_counter("chat_sent_frames_total", "Frames written to client sockets.", lambda: outbound_stats.sent_frames)
+    metrics.function_counter("chat_sent_bytes_total", "Payload bytes of frames written to client sockets.", lambda: outbound_stats.sent_bytes)
+    metrics.function_counter("chat_connections_refused_total", "Handshakes refused by admission control.", lambda: admission.refused)
+    metrics.function_counter("chat_heartbeat_pings_total", "Heartbeat pings sent to silent connections.", lambda: heartbeat.pings_sent)
+    metrics.function_counter("chat_reaped_sessions_total", "Sessions ended because their client stopped answering heartbeats.", lambda: heartbeat.reaped)
+    metrics.gauge("chat_search_indexed_messages", "Room messages in the search index.", lambda: search_index.document_count)
+
+def get_outbound_stats():
+    """Returns current outbound queue depths and drop/eviction counters."""
+    depths = [len(session.queue) for session in registry.sessions() if session.queue is not None]
+    return {
+        "connections": len(depths),
+        "detached_sessions": len(registry) - len(depths),
+        "queued_frames": sum(depths),
+        "max_queue_depth": max(depths, default=0),
+        "dropped_frames": outbound_stats.dropped_frames,
+        "superseded_frames": outbound_stats.superseded_frames,
+        "evicted_clients": outbound_stats.evicted_clients,
+    }
+
+async def report_outbound_stats(interval=OUTBOUND_STATS_INTERVAL_SECONDS):
+    """Periodically prints outbound queue statistics."""
+    while True:
+        await asyncio.sleep(interval)
+        print(f"Outbound queues: {get_outbound_stats()}")
+
+class PresenceBatcher:
+    """
+    Collects a room's join and leave events and broadcasts them as presence deltas.
+
+    A client joining the room gets one full client_list snapshot; the other
+    members only receive {"type": "presence", "room": ..., "joined": [...],
+    "left": [...]} frames. Events arriving within the coalescing window are
+    merged into one frame, so a reconnect storm costs one broadcast per window
+    instead of one full client list per join.
+
+    Snapshots list the membership as of the last flush (see announced()), so
+    a client that joins inside a window receives the pending delta like
+    everyone else, and a join and leave that cancel out were never shown to it.
+    """
+
+    def __init__(self, room_name, window=PRESENCE_COALESCE_SECONDS):
+        self.room_name = room_name
+        self.window = window
+        self.joined = {} # Insertion-ordered set of colors that joined since the last flush
+        self.left = {} # Insertion-ordered set of colors that left since the last flush
+        self._flush_handle = None
+
+    def client_joined(self, color):
+        """Records that a client joined."""
+        self.joined[color] = None
+        self._schedule_flush()
+
+    def client_left(self, color):
+        """Records that a client left. A join and leave in the same window cancel out."""
+        if color in self.joined:
+            del self.joined[color]
+        else:
+            self.left[color] = None
+        self._schedule_flush()
+
+    def announced(self, colors):
+        """Returns the membership the room was last told about, given its current member colors."""
+        return [color for color in colors if color not in self.joined] + list(self.left)
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        """Broadcasts pending deltas. Returns the number of sends."""
+        self._flush_handle = None
+        if not self.joined and not self.left:
+            return 0
+        # Receivers apply "left" before "joined", so a color that was freed and
+        # handed to a new client within the same window ends up present
+        message = {"type": "presence", "room": self.room_name, "joined": list(self.joined), "left": list(self.left)}
+        self.joined.clear()
+        self.left.clear()
+        return broadcast(message)
+
+class Room:
+    """
+    A chat room and its membership indices.
+
+    Local members are indexed by session (for fan-out), members connected to
+    other workers by color (for snapshots), and each room batches its own
+    presence deltas. The last ROOM_RING_SIZE sequenced messages are kept as
+    (seq, EncodedMessage, priority, excluded color) for resuming clients.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {} # local session -> color
+        self.remote_members = {} # color -> worker id, for members connected to other workers
+        self.presence = PresenceBatcher(name)
+        self.seq = 0 # Sequence number of the last sequenced frame broadcast to the room
+        self.ring = collections.deque(maxlen=ROOM_RING_SIZE)
+
+    def frames_since(self, seq):
+        """
+        Returns the ring entries numbered after seq, or None if some of them are no longer kept.
+        """
+        if seq > self.seq:
+            return None # Numbered by an earlier incarnation of the room
+        if seq < self.seq and (not self.ring or self.ring[0][0] > seq + 1):
+            return None
+        return [entry for entry in self.ring if entry[0] > seq]
+
+    def colors(self):
+        """Returns the colors of every member, local or remote."""
+        return list(self.members.values()) + list(self.remote_members)
+
+    def announced_colors(self):
+        """Returns the colors of every member as of the last presence flush; pending deltas will follow."""
+        return self.presence.announced(self.colors())
+
+    def is_empty(self):
+        return not self.members and not self.remote_members
+
+def get_room(name):
+    """Returns the room with the given name, creating it if needed."""
+    room = rooms.get(name)
+    if room is None:
+        room = rooms[name] = Room(name)
+    return room
+
+def discard_room_if_empty(room):
+    """Forgets a room once nobody, on any worker, is in it."""
+    if room.is_empty() and rooms.get(room.name) is room:
+        del rooms[room.name] # A pending presence flush still goes out; it holds its own reference
+        if message_store is not None:
+            message_store.release(room.name)
+
+class TypingState:
+    """Typing state of one sender in one room as tracked by TypingTracker."""
+
+    def __init__(self, color, room_name):
+        self.color = color
+        self.room_name = room_name
+        self.wanted = False # What the sender last told us
+        self.announced = False # What peers were last told
+        self.last_transition = float("-inf") # When a transition was last broadcast
+
+class TypingTracker:
+    """
+    Coalesces typing indicators before they are fanned out.
+
+    State is tracked per sender and room. Only changes of state are broadcast:
+    repeated typing_start frames just push the sender's expiry deadline back.
+    Transitions for one sender are rate limited to one per TYPING_MIN_INTERVAL_SECONDS; a change that arrives too
+    early is settled when the interval ends, so peers always converge on the
+    sender's latest state. Typers that go quiet are expired by the server
+    itself. All deadlines live on one timer wheel, which only ticks while it
+    has something scheduled.
+    """
+
+    def __init__(self, timeout=TYPING_TIMEOUT_SECONDS, min_interval=TYPING_MIN_INTERVAL_SECONDS, tick=TYPING_TICK_SECONDS, clock=time.monotonic):
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.clock = clock
+        self.wheel = TimerWheel(tick, clock=clock)
+        self.states = {} # (session, room name) -> TypingState
+        self._tick_handle = None
+
+    def start(self, session, room_name):
+        """Handles a typing_start frame from a client."""
+        typer = (session, room_name)
+        state = self.states.get(typer)
+        if state is None:
+            state = self.states[typer] = TypingState(session.color, room_name)
+        state.wanted = True
+        self.wheel.schedule(("expire", typer), self.timeout)
+        self._settle(typer, state)
+
+    def stop(self, session, room_name):
+        """Handles a typing_stop frame from a client."""
+        typer = (session, room_name)
+        state = self.states.get(typer)
+        if state is None:
+            return
+        state.wanted = False
+        self.wheel.cancel(("expire", typer))
+        self._settle(typer, state)
+
+    def forget(self, session, room_name):
+        """Drops the typing state of a client leaving a room or disconnecting."""
+        typer = (session, room_name)
+        state = self.states.pop(typer, None)
+        if state is None:
+            return
+        self.wheel.cancel(("expire", typer))
+        self.wheel.cancel(("settle", typer))
+        if state.announced:
+            broadcast({"type": "typing_stop", "room": room_name, "sender_color": state.color}, exclude=session)
+
+    def _settle(self, typer, state):
+        """Broadcasts the sender's wanted state if it differs from what peers have and the rate limit allows it."""
+        if state.wanted == state.announced:
+            self.wheel.cancel(("settle", typer)) # Nothing to tell peers, e.g. a duplicate start
+        else:
+            wait = state.last_transition + self.min_interval - self.clock()
+            if wait > 0:
+                self.wheel.schedule(("settle", typer), wait)
+            else:
+                state.announced = state.wanted
+                state.last_transition = self.clock()
+                message_type = "typing_start" if state.wanted else "typing_stop"
+                broadcast({"type": message_type, "room": state.room_name, "sender_color": state.color}, exclude=typer[0])
+        self._ensure_ticking()
+
+    def _ensure_ticking(self):
+        if self._tick_handle is None and len(self.wheel):
+            self._tick_handle = asyncio.get_running_loop().call_later(self.wheel.tick_seconds, self._on_tick)
+
+    def _on_tick(self):
+        self._tick_handle = None
+        for kind, typer in self.wheel.advance():
+            state = self.states.get(typer)
+            if state is None:
+                continue
+            if kind == "expire":
+                state.wanted = False # The sender went quiet without saying so
+            self._settle(typer, state)
+        self._ensure_ticking()
+
+typing_tracker = TypingTracker()
+
+def recipient_not_found_message(recipient_color):
+    """Generates the error sent back when a direct message cannot be delivered."""
+    return {"type": "error", "message": f"Recipient with color {recipient_color} not found or offline."}
+
+def send_direct_message(sender, recipient_color, message_text, received_us=None):
+    """
+    Sends a direct message to a specific client, which may be connected to another worker.
+
+    Returns:
+        dict: The message as sent, or None if the recipient is not online.
+    """
+    message = {
+        "type": "direct_message",
+        "id": next_message_id(),
+        "sender_color": sender.color,
+        "message": message_text,
+        "recipient_color": recipient_color,
+        "server_received_us": received_us,
+        "server_sent_us": time.time_ns() // 1000,
+    }
+    recipient = registry.by_color(recipient_color)
+    if recipient: # Check if recipient has a session on this worker, connected or waiting to resume
+        deliver_direct(recipient, message)
+    elif recipient_color in remote_clients and bus is not None:
+        envelope = {"kind": "deliver", "color": recipient_color, "message": message, "reply_to": sender.color}
+        bus.publish(envelope, to=remote_clients[recipient_color])
     else:
         # Optionally, inform the sender if the recipient is not found/offline
-        error_message = {"type": "error", "message": f"Recipient with color {recipient_color} not found or offline."}
-        await sender.send(json.dumps(error_message))
+        send_to(sender, recipient_not_found_message(recipient_color))
+        return None
+    return message
+
+def acknowledge(session, message, relayed=None):
+    """
+    Acks a chat or direct message that carries a client_id or client_sent_us, echoing both.
+
+    Every such message gets exactly one ack once it has been handled, even
+    if it was rejected, so the client can stop holding it for a resend. If
+    the message was relayed the ack also carries the server's receive and
+    send stamps, so the client can measure the round trip on its own clock
+    and estimate its clock offset from the server. The ack is remembered by
+    client_id, and a resend of the same message only gets it again.
+    """
+    if message.client_id is None and message.client_sent_us is None:
+        return
+    ack = {"type": "ack", "client_id": message.client_id, "client_sent_us": message.client_sent_us}
+    if relayed is not None:
+        ack.update(id=relayed["id"], server_received_us=relayed["server_received_us"], server_sent_us=relayed["server_sent_us"])
+    ack = {name: value for name, value in ack.items() if value is not None}
+    send_to(session, ack)
+    if message.client_id is not None:
+        session.remember_ack(message.client_id, ack)
+
+def is_valid_room_name(name):
+    return isinstance(name, str) and 0 < len(name) <= MAX_ROOM_NAME_LENGTH
+
+def is_valid_message_text(text):
+    return isinstance(text, str) and len(text) <= MAX_MESSAGE_LENGTH
+
+async def send_room_snapshot(session, room, history_since_us=None):
+    """
+    Sends a session a room's member list and recent history.
 
+    A client that keeps its own copy of the history passes the server
+    receive time of the newest message it has, and only gets the recent
+    messages after it.
+    """
+    send_to(session, await get_client_list_message(room))
+    if message_store is not None:
+        log = message_store.log_for(room.name, create=False) # Joining a room that has no messages opens nothing
+        if log is None or log.next_seq <= log.first_seq:
+            return
+        if history_since_us is None:
+            # Every join of a quiet room gets the same history frame, so it is only read and encoded once
+            history = history_cache.get((room.name, log.next_seq), lambda: {"type": "history", "room": room.name, "messages": log.tail(HISTORY_ON_JOIN)})
+            send_encoded(session, history)
+        else:
+            messages = [message for message in log.tail(HISTORY_ON_JOIN) if message.get("server_received_us", 0) > history_since_us]
+            if messages:
+                send_to(session, {"type": "history", "room": room.name, "messages": messages})
 
-async def handle_client(websocket, path):
+async def join_room(session, room_name, history_since_us=None):
+    """Adds a client to a room, sends it the room's snapshot and announces it to the other members."""
+    room = get_room(room_name)
+    if session in room.members:
+        send_to(session, await get_client_list_message(room)) # Already a member, just resend the snapshot
+        return
+    room.members[session] = session.color
+    session.rooms.add(room_name)
+    await send_room_snapshot(session, room, history_since_us)
+    room.presence.client_joined(session.color)
+
+def record_message(message):
+    """
+    Appends a room message to the durable log and the search index. Only
+    buffers; syncing to disk happens in the background.
+    """
+    if message_store is not None:
+        message_store.append(message["room"], message)
+    search_index.add(message)
+
+def index_stored_history(limit=SEARCH_REINDEX_MESSAGES):
+    """Indexes the most recent stored messages of every room, so search survives a restart. Blocks, so only use it on startup."""
+    count = 0
+    for room_name in message_store.stored_rooms():
+        for message in message_store.recent(room_name, limit):
+            search_index.add(message)
+            count += 1
+    if count:
+        print(f"Indexed {count} stored messages for search")
+
+async def run_search(session, message):
+    """
+    Answers a search request with one page of results.
+
+    The query runs on a search thread, so a slow query never holds up the
+    broadcast loop; the index tolerates messages being added meanwhile.
+    """
+    started = time.perf_counter()
+    limit = message.limit if isinstance(message.limit, int) and 0 < message.limit <= SEARCH_PAGE_SIZE else SEARCH_PAGE_SIZE
+    cursor = message.cursor if isinstance(message.cursor, str) else None
+    results, next_cursor = await asyncio.get_running_loop().run_in_executor(
+        search_executor, search_index.search, message.room, str(message.query), cursor, limit
+    )
+    search_seconds.observe(time.perf_counter() - started)
+    response = {"type": "search_results", "room": message.room, "query": message.query, "messages": results, "cursor": next_cursor, "request_id": message.request_id}
+    send_to(session, {name: value for name, value in response.items() if value is not None})
+
+def start_search(session, message):
+    """Starts a search without waiting for it, so the client's other frames keep being handled."""
+    if len(search_tasks) >= MAX_PENDING_SEARCHES:
+        searches_refused.inc()
+        send_to(session, {"type": "error", "message": "The server is busy, search again shortly."})
+        return
+    task = asyncio.create_task(run_search(session, message))
+    search_tasks.add(task)
+    task.add_done_callback(search_tasks.discard)
+
+def leave_room(session, room_name):
+    """Removes a client from a room and announces it to the remaining members."""
+    room = rooms.get(room_name)
+    if room is None or room.members.pop(session, None) is None:
+        return False
+    session.rooms.discard(room_name)
+    typing_tracker.forget(session, room_name)
+    room.presence.client_left(session.color)
+    discard_room_if_empty(room)
+    return True
+
+def publish_directory(joined=(), left=()):
+    """Tells other workers which clients connected to or disconnected from this worker."""
+    if bus is not None:
+        bus.publish({"kind": "directory", "joined": list(joined), "left": list(left)})
+
+def handle_bus_envelope(envelope):
+    """
+    Applies an envelope received from another worker.
+
+    Relayed broadcasts are fanned out to the local members of their room
+    (presence deltas also update the room's remote membership), targeted
+    deliveries go to a single local client, directory updates track which
+    worker every client is on, and sync/worker_down notices from the broker
+    keep all of this in step as workers come and go.
+    """
+    kind = envelope.get("kind")
+    if kind == "relay":
+        message = envelope["message"]
+        if message.get("type") == "presence":
+            room = get_room(message["room"])
+            for color in message["left"]:
+                room.remote_members.pop(color, None)
+            for color in message["joined"]:
+                room.remote_members[color] = envelope["from"]
+            broadcast(message, relay=False)
+            discard_room_if_empty(room)
+        else:
+            broadcast(message, relay=False)
+            if message.get("type") == "message":
+                record_message(message) # Every worker keeps a full copy of the history
+
+    elif kind == "directory":
+        for color in envelope["left"]:
+            remote_clients.pop(color, None)
+        for color in envelope["joined"]:
+            remote_clients[color] = envelope["from"]
+
+    elif kind == "deliver":
+        session = registry.by_color(envelope["color"])
+        if session and envelope["message"].get("type") == "direct_message":
+            deliver_direct(session, envelope["message"])
+        elif session:
+            send_to(session, envelope["message"])
+        elif envelope.get("reply_to"): # Recipient left in the meantime, tell the sender on its own worker
+            error_envelope = {"kind": "deliver", "color": envelope["reply_to"], "message": recipient_not_found_message(envelope["color"])}
+            bus.publish(error_envelope, to=envelope["from"])
+
+    elif kind == "sync": # A worker (re)joined the bus and needs to know about our clients and rooms
+        worker = envelope["worker"]
+        bus.publish({"kind": "directory", "joined": list(registry.colors()), "left": []}, to=worker)
+        for room in rooms.values():
+            if room.members:
+                presence_message = {"type": "presence", "room": room.name, "joined": list(room.members.values()), "left": []}
+                bus.publish({"kind": "relay", "message": presence_message}, to=worker)
+
+    elif kind == "worker_down": # Every client of that worker is gone
+        worker = envelope["worker"]
+        for color in [color for color, owner in remote_clients.items() if owner == worker]:
+            del remote_clients[color]
+        for room in list(rooms.values()):
+            gone = [color for color, owner in room.remote_members.items() if owner == worker]
+            for color in gone:
+                del room.remote_members[color]
+            if gone:
+                broadcast({"type": "presence", "room": room.name, "joined": [], "left": gone}, relay=False)
+                discard_room_if_empty(room)
+
+    else:
+        print(f"Unknown bus envelope kind: {kind}")
+
+
+def send_ping(session):
+    send_encoded(session, PING)
+
+def reap_dead_sessions(sessions):
+    """
+    Ends the sessions whose clients stopped answering heartbeats.
+
+    The whole batch leaves with a single directory update, and each room's
+    PresenceBatcher folds the leaves into one presence frame. The dead
+    connections are aborted rather than closed, since nobody would answer a
+    closing handshake.
+    """
+    colors = []
+    for session in sessions:
+        websocket = session.websocket
+        if end_session(session, publish=False):
+            colors.append(session.color)
+        if websocket is not None:
+            websocket.transport.abort() # Its handler sees the connection drop and finds the session already ended
+    if colors:
+        publish_directory(left=colors)
+        print(f"Reaped {len(colors)} unresponsive clients")
+
+heartbeat = HeartbeatMonitor(send_ping, reap_dead_sessions)
+
+def parse_resume_request(path):
+    """
+    Reads the resume parameters a reconnecting client puts in its connection URL.
+
+    The query looks like ?resume=TOKEN&since=lobby:42&since=games:7&direct=3:
+    the session's resume token, the last sequence number seen in each room
+    and the last direct message sequence number seen.
+
+    Returns:
+        tuple: (token or None, dict of room name -> seq, direct seq).
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+    token = query.get("resume", [None])[0]
+    since = {}
+    for value in query.get("since", []):
+        room_name, _, seq = value.rpartition(":") # Room names may themselves contain colons
+        if room_name and seq.isdigit():
+            since[room_name] = int(seq)
+    direct = query.get("direct", ["0"])[0]
+    return token, since, int(direct) if direct.isdigit() else 0
+
+def parse_history_since(path):
+    """
+    Reads ?history_since=US from a connection URL: the server receive time of
+    the newest default room message the client already has, if it keeps a copy.
+    """
+    value = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query).get("history_since", [""])[0]
+    return int(value) if value.isdigit() else None
+
+def attach_session(session, websocket):
+    """Connects a session to a WebSocket, taking it over from a previous connection if needed."""
+    if session.expiry is not None:
+        session.expiry.cancel()
+        session.expiry = None
+    if session.attached: # The old connection is half-open or the client reconnected twice
+        session.queue.close()
+        asyncio.ensure_future(session.websocket.close())
+    session.websocket = websocket
+    session.codec = codec_for(websocket.subprotocol)
+    session.queue = OutboundQueue(websocket, OUTBOUND_QUEUE_SIZE, OUTBOUND_OVERFLOW_POLICY, outbound_stats)
+    heartbeat.watch(session)
+
+def detach_session(session):
+    """Disconnects a session from its WebSocket and gives the client RESUME_GRACE_SECONDS to come back."""
+    session.queue.close()
+    session.websocket = None
+    session.queue = None
+    heartbeat.unwatch(session)
+    for room_name in session.rooms:
+        typing_tracker.forget(session, room_name)
+    session.expiry = asyncio.get_running_loop().call_later(RESUME_GRACE_SECONDS, end_session, session)
+
+def end_session(session, publish=True):
+    """
+    Removes a session from all its rooms and frees its color.
+
+    Args:
+        session (Session): The session to end.
+        publish (bool, optional): Whether to tell other workers the client left. Defaults to True; batch callers publish once.
+
+    Returns:
+        bool: False if the session had already ended.
+    """
+    heartbeat.unwatch(session)
+    if session.expiry is not None:
+        session.expiry.cancel()
+        session.expiry = None
+    if session.queue is not None:
+        session.queue.close()
+        session.websocket = None
+        session.queue = None
+    for room_name in list(session.rooms):
+        leave_room(session, room_name) # Updates each room's client list for everyone
+    if not registry.remove(session): # Frees the color
+        return False
+    if publish:
+        publish_directory(left=[session.color])
+    return True
+
+async def resume_session(session, since, direct_since):
+    """
+    Sends a resumed session what it missed while it was disconnected.
+
+    For each of its rooms the client gets the current member list and the
+    chat messages after the last one it saw, or a full snapshot with
+    history if those messages have already left the room's ring buffer.
+    Rooms the client thinks it is in but no longer is get a room_left, and
+    buffered direct messages after direct_since are sent again.
+    """
+    for room_name in since:
+        if room_name not in session.rooms:
+            send_to(session, {"type": "room_left", "room": room_name})
+    for room_name in session.rooms:
+        room = rooms[room_name]
+        frames = room.frames_since(since[room_name]) if room_name in since else None
+        if frames is None:
+            await send_room_snapshot(session, room)
+            continue
+        send_to(session, await get_client_list_message(room)) # Presence deltas are not replayed
+        for seq, encoded, priority, excluded_color in frames:
+            if excluded_color != session.color: # The client's own messages were never sent back to it
+                session.queue.put(encoded.frame(session.codec), priority)
+    for seq, encoded in session.direct_buffer or ():
+        if seq > direct_since:
+            send_encoded(session, encoded)
+
+async def admit_connection(path, request_headers):
+    """
+    Refuses a handshake with 503 and a Retry-After header while the worker is
+    full or handshakes arrive too fast, before any WebSocket state is set up.
+    """
+    retry_after = admission.admit()
+    if retry_after:
+        return http.HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", str(math.ceil(retry_after)))], b"Server busy, try again later.\n"
+    return None
+
+def rate_limit(session, message):
+    """
+    Takes a token from the session's budget for the message's type.
+
+    Returns:
+        bool: True if the message may be handled. Otherwise the client is told
+        (once per wait) how long to wait, and the message is dropped unacked
+        so the client sends it again.
+    """
+    retry_after = session.limiter.check(message.type)
+    if not retry_after:
+        return True
+    rate_limited_frames.inc(label=message.type)
+    if session.limiter.should_report(message.type, retry_after):
+        send_to(session, {"type": "error", "message": f"Too many {message.type} frames, slow down.", "retry_after_ms": math.ceil(retry_after * 1000)})
+    return False
+
+async def handle_client(websocket):
     """Handles each client connection."""
-    client_color = generate_unique_color()
-    connected_clients.add(websocket)
-    client_colors[websocket] = client_color
+    path = websocket.path
+    if DROP_HANDSHAKE_HEADERS: # Nothing reads them again, and they would be kept for the life of the connection
+        websocket.request_headers = websocket.response_headers = NO_HEADERS
+    token, since, direct_since = parse_resume_request(path)
+    session = registry.by_token(token) if token else None
+    resumed = session is not None
+    if not resumed:
+        session = registry.create()
+        if token: # The session to resume has ended; its acks still answer the messages the client sends again
+            session.acks = registry.take_ended_acks(token)
+    attach_session(session, websocket)
+    connection_id = next(connection_ids)
+    connections_opened.inc(label="true" if resumed else "false")
+    if capture is not None:
+        capture.connection_opened(connection_id, path, websocket.subprotocol, session.color)
+    admission.connection_opened()
 
     try:
         # Send initial messages to the new client
-        await websocket.send(json.dumps({"type": "color_assignment", "color": client_color}))
-        await websocket.send(json.dumps(await get_client_list_message())) # Send initial client list
+        send_to(session, {"type": "color_assignment", "color": session.color, "resume_token": session.token, "resumed": resumed})
+        if resumed:
+            await resume_session(session, since, direct_since)
+        else:
+            publish_directory(joined=[session.color])
+            await join_room(session, DEFAULT_ROOM, parse_history_since(path)) # Sends the initial client list snapshot and informs the room
 
-        await broadcast_client_list() # Inform other clients about the new connection
+        async for frame in websocket:
+            started = time.perf_counter()
+            received_us = time.time_ns() // 1000 # Wall clock, so clients can relate it to their own
+            if capture is not None:
+                capture.frame_received(connection_id, frame)
+            bytes_received.inc(len(frame) if isinstance(frame, bytes) else len(frame.encode("utf-8")))
+            heartbeat.seen(session)
+            if not session.limiter.allow_frame(): # Flooding; cut it off before spending anything on decoding
+                rate_limited_frames.inc(label="all")
+                await websocket.close(RATE_LIMIT_CLOSE_CODE, "Rate limit exceeded")
+                break
+            try:
+                message = decode_message(frame)
+            except ValueError: # Malformed or mistyped; refuse this frame but keep the connection
+                frames_received.inc(label="malformed")
+                send_to(session, {"type": "error", "message": "Malformed frame."}) # The reason may quote the whole frame
+                continue
+            frames_received.inc(label="unknown" if isinstance(message, UnknownMessage) else message.type) # Client-chosen types would add a series each
 
-        async for message in websocket:
-            data = json.loads(message)
-            message_type = data.get("type")
+            if not rate_limit(session, message):
+                continue
 
-            if message_type == "message":
+            if isinstance(message, (ChatMessage, DirectMessage)) and session.ack_for(message.client_id) is not None:
+                send_to(session, session.ack_for(message.client_id)) # Sent again after a reconnect, but already handled
+
+            elif isinstance(message, (ChatMessage, TypingStart, TypingStop, Search)) and message.room not in session.rooms:
+                send_to(session, {"type": "error", "message": f"You are not in room {message.room}."})
+                if isinstance(message, ChatMessage):
+                    acknowledge(session, message)
+
+            elif isinstance(message, (ChatMessage, DirectMessage)) and not is_valid_message_text(message.message):
+                send_to(session, {"type": "error", "message": f"Messages are limited to {MAX_MESSAGE_LENGTH} characters."})
+                acknowledge(session, message) # Handled, so the client stops resending it
+
+            elif isinstance(message, ChatMessage):
                 broadcast_message = {
                     "type": "message",
-                    "sender_color": client_color,
-                    "message": data["message"]
-                }
-                # Create tasks for each send operation
-                send_tasks = [
-                    asyncio.create_task(client.send(json.dumps(broadcast_message)))
-                    for client in connected_clients
-                    if client != websocket and client.open
-                ]
-                if send_tasks: # Only await if there are tasks to wait for
-                    await asyncio.wait(send_tasks)
-
-            elif message_type == "direct_message":
-                await send_direct_message(websocket, data["recipient_color"], data["message"])
-            elif message_type == "typing_start":
-                typing_clients.add(websocket)
-                typing_indicator = {
-                    "type": "typing_start",
-                    "sender_color": client_color
+                    "id": next_message_id(),
+                    "room": message.room,
+                    "sender_color": session.color,
+                    "message": message.message,
+                    "server_received_us": received_us,
+                    "server_sent_us": time.time_ns() // 1000, # Stamped once for the whole fan-out
                 }
-                # Create tasks for each send operation
-                send_tasks = [
-                    asyncio.create_task(client.send(json.dumps(typing_indicator)))
-                    for client in connected_clients
-                    if client != websocket and client.open
-                ]
-                if send_tasks: # Only await if there are tasks to wait for
-                    await asyncio.wait(send_tasks)
-
-            elif message_type == "typing_stop":
-                if websocket in typing_clients:
-                    typing_clients.remove(websocket)
-                    typing_indicator = {
-                        "type": "typing_stop",
-                        "sender_color": client_color
-                    }
-                    # Create tasks for each send operation
-                    send_tasks = [
-                        asyncio.create_task(client.send(json.dumps(typing_indicator)))
-                        for client in connected_clients
-                        if client != websocket and client.open
-                    ]
-                    if send_tasks: # Only await if there are tasks to wait for
-                        await asyncio.wait(send_tasks)
+                broadcast(broadcast_message, exclude=session)
+                record_message(broadcast_message)
+                acknowledge(session, message, broadcast_message)
+
+            elif isinstance(message, DirectMessage):
+                acknowledge(session, message, send_direct_message(session, message.recipient_color, message.message, received_us))
+            elif isinstance(message, TypingStart):
+                typing_tracker.start(session, message.room)
+            elif isinstance(message, TypingStop):
+                typing_tracker.stop(session, message.room)
+            elif isinstance(message, JoinRoom):
+                if len(session.rooms) >= MAX_ROOMS_PER_SESSION and message.room not in session.rooms:
+                    send_to(session, {"type": "error", "message": f"You cannot be in more than {MAX_ROOMS_PER_SESSION} rooms."})
+                elif is_valid_room_name(message.room):
+                    history_since_us = message.history_since_us if isinstance(message.history_since_us, int) else None
+                    await join_room(session, message.room, history_since_us)
+                else:
+                    send_to(session, {"type": "error", "message": f"Invalid room name: {message.room!r}."})
+            elif isinstance(message, LeaveRoom):
+                if leave_room(session, message.room):
+                    send_to(session, {"type": "room_left", "room": message.room})
+            elif isinstance(message, Search):
+                start_search(session, message)
+            elif isinstance(message, Ping):
+                send_to(session, {"type": "pong"})
+            elif isinstance(message, Pong):
+                pass # Receiving it was all the heartbeat needed
             else:
-                print(f"Unknown message type: {message_type}")
+                print(f"Unknown message type: {message.type}")
+            frame_handler_seconds.observe(time.perf_counter() - started)
 
     except websockets.exceptions.ConnectionClosedOK:
         print(f"Client disconnected cleanly.") # Expected disconnection
@@ -124,20 +942,206 @@ async def handle_client(websocket, path):
     except Exception as e:
         print(f"Error handling client connection: {e}")
     finally:
-        if websocket in connected_clients: # Ensure client is still in connected_clients (might have been removed due to error)
-            connected_clients.remove(websocket)
-        if websocket in client_colors: # Ensure client is still in client_colors
-            del client_colors[websocket]
-        if websocket in typing_clients: # Ensure client is still in typing_clients
-            typing_clients.remove(websocket)
-        await broadcast_client_list() # Update client list for everyone on disconnect
+        admission.connection_closed()
+        if capture is not None:
+            capture.connection_closed(connection_id, websocket.close_code)
+        if session.websocket is websocket: # Otherwise a newer connection has taken the session over
+            if websocket.close_code in (1000, 1001):
+                end_session(session) # The client said goodbye, nothing to resume
+            else:
+                detach_session(session)
+
+
+async def main(host="0.0.0.0", port=8765, worker_index=0, worker_count=1, bus_path=None, log_dir=None, fsync_interval=FSYNC_INTERVAL_SECONDS, capture_path=None, metrics_port=None, max_connections=MAX_CONNECTIONS, handshake_rate=HANDSHAKE_RATE,
+               prefer_protocol="binary"):
+    """
+    Starts the WebSocket server.
 
+    Args:
+        host (str, optional): Interface to listen on. Defaults to all interfaces.
+        port (int, optional): Port to listen on. Defaults to 8765.
+        worker_index (int, optional): Index of this worker when running several. Defaults to 0.
+        worker_count (int, optional): Total number of workers sharing the port. Defaults to 1.
+        bus_path (str, optional): Unix socket of the bus broker relaying between workers.
+        log_dir (str, optional): Directory for the durable message log. History is disabled if None.
+        fsync_interval (float, optional): Seconds between batched fsyncs of the message log.
+        capture_path (str, optional): File to record inbound traffic to for replay. Nothing is recorded if None.
+        metrics_port (int, optional): Local port of the metrics and profiling endpoint, offset by the worker index. Disabled if None.
+        max_connections (int, optional): Open connections this worker accepts. Defaults to MAX_CONNECTIONS.
+        handshake_rate (float, optional): New connections this worker accepts per second. Defaults to HANDSHAKE_RATE.
+        prefer_protocol (str, optional): Key of PROTOCOL_PREFERENCES naming the protocol given to clients that offer both.
+    """
+    global bus, message_store, message_id_prefix, capture, admission
+    message_id_prefix = secrets.token_hex(4)
+    admission = AdmissionControl(fit_file_limit(max_connections), handshake_rate, max(HANDSHAKE_BURST, handshake_rate))
+    bus_task = None
+    store_task = None
+    if log_dir:
+        # Each worker sees every room message through the bus, so each keeps its own complete log
+        store_root = os.path.join(log_dir, f"worker-{worker_index}") if worker_count > 1 else log_dir
+        message_store = MessageStore(store_root, fsync_interval)
+        index_stored_history()
+        store_task = asyncio.create_task(message_store.run())
+    capture_task = None
+    if capture_path:
+        # Connection ids are per worker, so each worker records its own file; the replayer merges them
+        capture = TrafficCapture(f"{capture_path}.worker-{worker_index}" if worker_count > 1 else capture_path)
+        capture_task = asyncio.create_task(capture.run())
+    metrics_server = None
+    if metrics_port is not None:
+        register_gauges()
+        metrics_server = MetricsServer(metrics, "127.0.0.1", metrics_port + worker_index) # Every worker serves its own metrics
+        await metrics_server.start()
+
+    if bus_path is not None:
+        registry.allocator = ColorAllocator(offset=worker_index, stride=worker_count) # Colors stay unique across workers
+        bus = BusClient(bus_path, worker_index, handle_bus_envelope)
+        await bus.connect()
+        bus_task = asyncio.create_task(bus.run())
+
+    # With several workers every process binds the same port and the kernel spreads connections between them
+    # Clients that offer both subprotocols get the preferred one; clients that offer one get it, everyone else speaks JSON
+    # Liveness is checked by the application heartbeat on one timer wheel instead of a keepalive task per connection.
+    # handle_client takes only the connection, so websockets does not wrap every call in an adapter coroutine.
+    # Compression is off: permessage-deflate keeps a compressor and a decompressor per connection, which would
+    # cost more memory than everything else an idle client holds, and chat frames are small anyway.
+    server = await websockets.serve(
+        handle_client, host, port, subprotocols=PROTOCOL_PREFERENCES[prefer_protocol], select_subprotocol=select_subprotocol, reuse_port=worker_count > 1, process_request=admit_connection, ping_interval=None,
+        compression=None, max_size=MAX_FRAME_BYTES, max_queue=INCOMING_QUEUE_FRAMES, read_limit=READ_LIMIT_BYTES, write_limit=WRITE_LIMIT_BYTES,
+    )
+    print(f"WebSocket server started at ws://{host}:{port}" + (f" (worker {worker_index})" if worker_count > 1 else ""))
+    if bus_task is not None:
+        bus_task.add_done_callback(lambda _: server.close()) # Without the broker this worker would split the chat, so stop
+    stats_task = asyncio.create_task(report_outbound_stats())
+    heartbeat_task = asyncio.create_task(heartbeat.run())
+    try:
+        await server.wait_closed()
+    finally:
+        stats_task.cancel()
+        heartbeat_task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        if bus_task is not None:
+            bus_task.cancel()
+            bus.close()
+        if store_task is not None:
+            store_task.cancel()
+            message_store.close() # Syncs whatever is still buffered
+        if capture_task is not None:
+            capture_task.cancel()
+            capture.close()
+        search_executor.shutdown(wait=False, cancel_futures=True)
 
-async def main():
-    """Starts the WebSocket server."""
-    server = await websockets.serve(handle_client, "0.0.0.0", 8765) # Listen on all interfaces, port 8765
-    print("WebSocket server started at ws://0.0.0.0:8765")
-    await server.wait_closed()
+# --prefer-protocol choice -> subprotocols in the order the server picks them. Binary frames are 2-7x smaller but
+# the pure-Python codec costs 3-18x the CPU of orjson (see README), so a CPU-bound server may prefer JSON
+PROTOCOL_PREFERENCES = {
+    "binary": [BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL],
+    "json": [JSON_SUBPROTOCOL, BINARY_SUBPROTOCOL],
+}
+
+def select_subprotocol(client_subprotocols, server_subprotocols):
+    """Picks the first of the server's subprotocols the client offers, so the server's preference decides rather than the client's order."""
+    return next((subprotocol for subprotocol in server_subprotocols if subprotocol in client_subprotocols), None)
+
+def fit_file_limit(max_connections):
+    """
+    Raises the open file limit so max_connections sockets fit beside the
+    reserved descriptors, as far as the hard limit allows.
+
+    Returns:
+        int: The connections that fit, which is less than max_connections if the hard limit is too low.
+    """
+    if resource is None:
+        return max_connections
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = max_connections + RESERVED_FILE_DESCRIPTORS
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return max_connections
+    fitting = max(soft - RESERVED_FILE_DESCRIPTORS, 0)
+    print(f"Open file limit is {soft}: accepting {fitting} connections instead of {max_connections} (raise the hard limit, e.g. ulimit -Hn)")
+    return fitting
+
+def run(coroutine, use_uvloop=False):
+    """Runs a coroutine on a new event loop, a uvloop one if asked (lighter per connection and faster than asyncio's own)."""
+    if use_uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(coroutine)
+
+def run_worker(host, port, worker_index, worker_count, bus_path, log_dir, fsync_interval, capture_path, metrics_port, max_connections, handshake_rate, prefer_protocol, use_uvloop):
+    """Entry point of a worker process."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # Don't inherit the supervisor's graceful-shutdown handler
+    try:
+        run(main(host, port, worker_index, worker_count, bus_path, log_dir, fsync_interval, capture_path, metrics_port, max_connections, handshake_rate, prefer_protocol), use_uvloop)
+    except KeyboardInterrupt:
+        pass
+
+async def serve_workers(host, port, worker_count, log_dir=None, fsync_interval=FSYNC_INTERVAL_SECONDS, capture_path=None, metrics_port=None, max_connections=MAX_CONNECTIONS,
+                        handshake_rate=HANDSHAKE_RATE, prefer_protocol="binary", use_uvloop=False):
+    """
+    Runs worker_count server processes sharing one port via SO_REUSEPORT.
+
+    The supervisor hosts the bus broker that relays broadcasts, direct
+    messages, typing and presence between workers, and restarts any worker
+    that dies.
+    """
+    bus_path = os.path.join(tempfile.gettempdir(), f"chat_bus_{os.getpid()}.sock")
+    broker = BusBroker(bus_path)
+    await broker.start()
+
+    def start_worker(worker_index):
+        process = multiprocessing.Process(target=run_worker, args=(host, port, worker_index, worker_count, bus_path, log_dir, fsync_interval, capture_path, metrics_port, max_connections, handshake_rate, prefer_protocol, use_uvloop), daemon=True)
+        process.start()
+        return process
+
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+
+    workers = [start_worker(worker_index) for worker_index in range(worker_count)]
+    try:
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), WORKER_RESTART_DELAY_SECONDS)
+                break
+            except asyncio.TimeoutError:
+                pass
+            for worker_index, process in enumerate(workers):
+                if not process.is_alive():
+                    print(f"Worker {worker_index} exited with code {process.exitcode}, restarting")
+                    workers[worker_index] = start_worker(worker_index)
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+        await broker.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Chat WebSocket server")
+    parser.add_argument("--host", default="0.0.0.0", help="interface to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes sharing the port")
+    parser.add_argument("--log-dir", default="chat_log", help="directory for the durable message log (empty to disable history)")
+    parser.add_argument("--fsync-interval", type=float, default=FSYNC_INTERVAL_SECONDS, help="seconds between batched fsyncs of the message log")
+    parser.add_argument("--capture", help="record inbound traffic to this file for benchmarks/replay_capture.py (one file per worker)")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics and a sampling profiler on this local port (worker N uses port + N)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="open connections each worker accepts; further handshakes get 503 with Retry-After")
+    parser.add_argument("--handshake-rate", type=float, default=HANDSHAKE_RATE, help="new connections each worker accepts per second")
+    parser.add_argument("--prefer-protocol", choices=PROTOCOL_PREFERENCES, default="binary",
+                        help="protocol for clients that offer both: binary frames are smaller, JSON costs less CPU to encode and decode")
+    parser.add_argument("--uvloop", action="store_true", help="run on the uvloop event loop (pip install uvloop)")
+    args = parser.parse_args()
+    if args.uvloop and uvloop is None:
+        parser.error("--uvloop needs the uvloop package")
+
+    try:
+        if args.workers > 1:
+            run(serve_workers(args.host, args.port, args.workers, args.log_dir, args.fsync_interval, args.capture, args.metrics_port,
+                              args.max_connections, args.handshake_rate, args.prefer_protocol, args.uvloop), args.uvloop)
+        else:
+            run(main(args.host, args.port, log_dir=args.log_dir, fsync_interval=args.fsync_interval, capture_path=args.capture, metrics_port=args.metrics_port,
+                     max_connections=args.max_connections, handshake_rate=args.handshake_rate, prefer_protocol=args.prefer_protocol), args.uvloop)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,93 @@
+import asyncio
+import math
+import time
+from timer_wheel import TimerWheel
+
+HEARTBEAT_INTERVAL_SECONDS = 30.0 # A connection silent for this long is sent a ping
+HEARTBEAT_TIMEOUT_SECONDS = 15.0 # A pinged connection still silent after this long is dead
+HEARTBEAT_TICK_SECONDS = 1.0 # Resolution of the liveness wheel
+
+
+class HeartbeatMonitor:
+    """
+    Finds connections whose peer has gone away without closing them.
+
+    Every watched session has one key on a timer wheel. Receiving a frame
+    only stamps session.last_seen; the wheel is not touched. When a key
+    expires the session is checked: one heard from in the meantime is simply
+    rescheduled for the rest of its interval, a silent one is sent a ping and
+    given timeout seconds to answer, and one that stayed silent after its
+    ping is dead. The wheel has a slot for every tick of the longest wait, so
+    a slot only ever holds keys that are due, and each check costs O(expired)
+    however many connections are watched. The dead found by one check are
+    handed to reap() together, so they can be removed as one batch.
+    """
+
+    def __init__(self, send_ping, reap, interval=HEARTBEAT_INTERVAL_SECONDS, timeout=HEARTBEAT_TIMEOUT_SECONDS, tick=HEARTBEAT_TICK_SECONDS, clock=time.monotonic):
+        """
+        Args:
+            send_ping (callable): Called with a session to send it a ping frame.
+            reap (callable): Called with a list of dead sessions.
+            interval (float, optional): Silence before a ping. Defaults to HEARTBEAT_INTERVAL_SECONDS.
+            timeout (float, optional): Time to answer a ping; at most interval. Defaults to HEARTBEAT_TIMEOUT_SECONDS.
+            tick (float, optional): Resolution of the wheel. Defaults to HEARTBEAT_TICK_SECONDS.
+            clock (callable, optional): Monotonic clock returning seconds. Defaults to time.monotonic.
+        """
+        if timeout > interval:
+            raise ValueError("The heartbeat timeout cannot be longer than its interval.")
+        self.send_ping = send_ping
+        self.reap = reap
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+        self.wheel = TimerWheel(tick, max(64, math.ceil(interval / tick) + 2), clock)
+        self.pings_sent = 0
+        self.reaped = 0
+
+    def watch(self, session):
+        """Starts watching a session whose connection was just opened."""
+        session.last_seen = self.clock()
+        session.awaiting_pong = False
+        self.wheel.schedule(session, self.interval)
+
+    def unwatch(self, session):
+        self.wheel.cancel(session)
+
+    def seen(self, session):
+        """Notes a frame received from the session's client."""
+        session.last_seen = self.clock()
+
+    def check(self):
+        """
+        Handles the keys that expired since the last check.
+
+        Returns:
+            int: The number of dead sessions reaped.
+        """
+        now = self.clock()
+        dead = []
+        for session in self.wheel.advance():
+            idle = now - session.last_seen
+            if idle < self.interval: # Heard from since the key was scheduled; a pong answers within timeout <= interval
+                session.awaiting_pong = False
+                self.wheel.schedule(session, self.interval - idle)
+            elif not session.awaiting_pong:
+                session.awaiting_pong = True
+                self.pings_sent += 1
+                self.send_ping(session)
+                self.wheel.schedule(session, self.timeout)
+            else:
+                dead.append(session)
+        if dead:
+            self.reaped += len(dead)
+            self.reap(dead)
+        return len(dead)
+
+    async def run(self):
+        """Checks every tick until cancelled."""
+        while True:
+            await asyncio.sleep(self.wheel.tick_seconds)
+            self.check()
+
+    def __len__(self):
+        return len(self.wheel)
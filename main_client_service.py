@@ -1,6 +1,124 @@
-from PySide6.QtCore import QObject, Signal, Slot
-from PySide6.QtWebSockets import QWebSocket
-import json
+from PySide6.QtCore import QByteArray, QObject, QThread, QTimer, QUrl, Signal, Slot
+from PySide6.QtNetwork import QAbstractSocket
+from PySide6.QtWebSockets import QWebSocket, QWebSocketHandshakeOptions
+import collections
+import itertools
+import math
+import time
+import urllib.parse
+from message_cache import own_message_record
+from message_packet import (
+    BINARY_SUBPROTOCOL, DEFAULT_ROOM, MAX_MESSAGE_LENGTH, SUBPROTOCOLS, Ack, ChatMessage, ClientList, ColorAssignment, DirectMessage, Error,
+    History, Ping, Presence, RoomLeft, SearchResults, TypingStart, TypingStop, codec_for, decode_message,
+)
+from rate_limit import MESSAGE_RATE_LIMITS, TokenBucket
+
+TYPING_IDLE_MS = 2000  # Send typing_stop after this long without a keystroke
+TYPING_REFRESH_SECONDS = 3.0  # Re-send typing_start this often while typing, so the server does not expire us
+RECONNECT_MIN_MS = 500  # First reconnect attempt after an unexpected disconnect
+RECONNECT_MAX_MS = 30000  # Reconnect backoff doubles up to this delay
+SEEN_MESSAGE_IDS = 1024  # Message ids remembered for dropping duplicates
+CLOCK_SAMPLES = 32  # Recent acks considered when estimating the offset between our clock and the server's
+DECODE_BATCH_MS = 16  # In threaded mode decoded frames are handed to the GUI thread at most once per frame...
+DECODE_BATCH_SIZE = 512  # ...or as soon as this many are waiting
+SHUTDOWN_TIMEOUT_MS = 2000  # How long shutdown() waits for the server to answer our close frame
+OUTBOX_LIMIT = 10000  # Frames kept while offline; chat and direct messages beyond it are refused, other frames drop the oldest
+SEND_RATE, SEND_BURST = MESSAGE_RATE_LIMITS["message"]  # Outbox pacing, within the server's per-connection limits
+
+class SocketWorker(QObject):
+    """
+    Owns the QWebSocket of a threaded WebSocketClient and decodes frames on its own thread.
+
+    Decoded messages are collected and handed over in one frames_decoded
+    signal per batch, so a burst of frames (or a large client_list) costs the
+    GUI thread a single queued event and no parsing.
+    """
+
+    connected = Signal(str)  # negotiated subprotocol
+    disconnected = Signal()
+    frames_decoded = Signal(list)  # [(receive time in microseconds, typed message), ...]
+
+    def __init__(self):
+        super().__init__()
+        self.websocket = None
+        self._batch = []
+        self._flush_timer = None
+
+    @Slot()
+    def start(self):
+        """Creates the socket and batch timer. Runs on the worker thread as soon as it starts."""
+        self.websocket = QWebSocket(parent=self)
+        self.websocket.connected.connect(self._on_connected)
+        self.websocket.disconnected.connect(self._on_disconnected)
+        self.websocket.textMessageReceived.connect(self._on_frame)
+        self.websocket.binaryMessageReceived.connect(lambda message: self._on_frame(message.data()))
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(DECODE_BATCH_MS)
+        self._flush_timer.timeout.connect(self.flush)
+
+    @Slot(str, list)
+    def open(self, url, subprotocols):
+        options = QWebSocketHandshakeOptions()
+        options.setSubprotocols(subprotocols)
+        self.websocket.open(QUrl(url), options)
+
+    @Slot(str)
+    def send_text(self, frame):
+        self.websocket.sendTextMessage(frame)
+
+    @Slot(bytes)
+    def send_binary(self, frame):
+        self.websocket.sendBinaryMessage(QByteArray(frame))
+
+    @Slot()
+    def close(self):
+        self.websocket.close()
+
+    @Slot()
+    def shutdown(self):
+        """
+        Closes the socket and stops the worker thread once the close handshake
+        is done, or after SHUTDOWN_TIMEOUT_MS if the server does not answer.
+        """
+        if self.websocket.state() == QAbstractSocket.SocketState.UnconnectedState:
+            self._quit_thread()
+            return
+        self.websocket.disconnected.connect(self._quit_thread)
+        QTimer.singleShot(SHUTDOWN_TIMEOUT_MS, self, self._quit_thread)
+        self.websocket.close()
+
+    @Slot()
+    def _quit_thread(self):
+        # Called here rather than connected to QThread.quit, which would be queued to the GUI thread blocked in wait()
+        self.thread().quit()
+
+    def _on_connected(self):
+        self.connected.emit(self.websocket.subprotocol())
+
+    def _on_disconnected(self):
+        self.flush()  # Frames received before the close are handled before it
+        self.disconnected.emit()
+
+    def _on_frame(self, frame):
+        received_us = time.time_ns() // 1000
+        try:
+            message = decode_message(frame)
+        except ValueError as e:
+            print(f"Failed to decode message: {e}")
+            return
+        self._batch.append((received_us, message))
+        if len(self._batch) >= DECODE_BATCH_SIZE:
+            self.flush()
+        elif not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    @Slot()
+    def flush(self):
+        self._flush_timer.stop()
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self.frames_decoded.emit(batch)
 
 class WebSocketClient(QObject):
     """
@@ -10,6 +128,43 @@ class WebSocketClient(QObject):
     and provides signals to notify about various events like connection status,
     received messages, client list updates, and typing indicators.
 
+    The client can be a member of several rooms at once. Room-aware signals
+    (room_*, clients_joined, clients_left) carry the room name; the original
+    signals (message_received, client_list_updated, typing_*) keep working and
+    refer to the default room.
+
+    If the connection drops unexpectedly the client reconnects by itself and
+    resumes its session: it keeps its color and rooms, and the server sends
+    only the frames numbered after the last ones it saw. Frames that arrive
+    twice are dropped by sequence number and message id.
+
+    The client offers the compact binary protocol (see message_packet.py)
+    when connecting and falls back to JSON if the server does not accept it.
+
+    With latency tracking on, sent messages are stamped so the server acks
+    them, and 'latency_measured' reports the round trip of each ack and the
+    delivery time (from the server receiving a message to this client
+    receiving it) of each chat and direct message. Delivery times are
+    corrected by a clock offset estimated from the acks with the shortest
+    round trips; until the first ack arrives the clocks are assumed to agree.
+
+    In threaded mode the socket lives on a worker thread that also decodes
+    the frames (see SocketWorker); decoded messages reach this object in
+    batches. Either way, every chat message and direct message of a batch is
+    also reported by one messages_received / direct_messages_received
+    signal, which lets a UI update once per batch instead of once per message.
+    The per-message signals are emitted as before.
+
+    Everything sent goes through an outbox. It is flushed in order once per
+    event loop turn while the session is up, and kept while the client is
+    disconnected or reconnecting. Typing indicators are ephemeral: a newer
+    one replaces an unsent one, and they are dropped rather than kept
+    offline. Chat and direct messages carry a client_id and are held after
+    sending until the server acks that id ('message_acknowledged'); after a
+    reconnect anything still unacked is sent again ahead of the outbox, and
+    the server answers a resend it already handled with the same ack instead
+    of relaying it twice.
+
     No GUI elements are included in this class, focusing solely on the logic
     to interact with the WebSocket server.
     """
@@ -17,42 +172,182 @@ class WebSocketClient(QObject):
     # Signals to communicate events to external UI components
     connected = Signal()
     disconnected = Signal()
-    message_received = Signal(str, str)  # message, sender_color (for room messages)
+    message_received = Signal(str, str)  # message, sender_color (for default room messages)
+    room_message_received = Signal(str, str, str)  # room, message, sender_color
+    history_received = Signal(str, list)  # room, recent message dictionaries (oldest first) sent on joining it
     direct_message_received = Signal(str, str, str)  # message, sender_color, recipient_color
-    client_list_updated = Signal(list)  # list of client dictionaries [{'color': color}]
-    typing_started = Signal(str)  # sender_color
-    typing_stopped = Signal(str)  # sender_color
+    client_list_updated = Signal(list)  # list of client dictionaries [{'color': color}] in the default room
+    room_client_list_received = Signal(str, list)  # room, full member snapshot received on joining it
+    clients_joined = Signal(str, list)  # room, list of client dictionaries that joined since the last update
+    clients_left = Signal(str, list)  # room, list of client dictionaries that left since the last update
+    room_joined = Signal(str)  # room
+    room_left = Signal(str)  # room
+    typing_started = Signal(str)  # sender_color (default room)
+    typing_stopped = Signal(str)  # sender_color (default room)
+    room_typing_started = Signal(str, str)  # room, sender_color
+    room_typing_stopped = Signal(str, str)  # room, sender_color
     error_received = Signal(str)  # error message
     color_assigned = Signal(str) # assigned color for this client
-
-    def __init__(self, server_url, parent=None):
+    latency_measured = Signal(str, float)  # kind ("round_trip" or "delivery"), milliseconds
+    messages_received = Signal(list)  # [(room, message, sender_color), ...] of the chat messages in one batch
+    direct_messages_received = Signal(list)  # [(message, sender_color, recipient_color), ...] of one batch
+    message_acknowledged = Signal(str)  # client_id returned by send_chat_message / send_direct_message
+    message_records_received = Signal(list)  # dictionaries of the chat and direct messages of one batch, our own once acked, e.g. for a local cache
+    search_results_received = Signal(str, str, list, str)  # request_id, room, message dictionaries (newest first), cursor of the next page ("" on the last)
+
+    # Requests to the SocketWorker in threaded mode, delivered as queued calls on its thread
+    _open_requested = Signal(str, list)
+    _send_text_requested = Signal(str)
+    _send_binary_requested = Signal(bytes)
+    _close_requested = Signal()
+    _shutdown_requested = Signal()
+
+    def __init__(self, server_url, parent=None, threaded=False):
         """
         Initializes the WebSocketClient.
 
         Args:
             server_url (str): The WebSocket server URL (e.g., "ws://localhost:8765").
             parent (QObject, optional): Parent object for Qt object hierarchy. Defaults to None.
+            threaded (bool, optional): Run the socket and frame decoding on a worker thread. Defaults to False.
         """
         super().__init__(parent)
         self.server_url = server_url
-        self.websocket = QWebSocket()
-        self.websocket.connected.connect(self._on_connected)
-        self.websocket.disconnected.connect(self._on_disconnected)
-        self.websocket.textMessageReceived.connect(self._on_text_message_received)
+        self.threaded = threaded
+        self._socket_open = False  # Connection state as last reported by the worker, in threaded mode
+        if threaded:
+            self.websocket = None
+            self._thread = QThread(self)
+            self._worker = SocketWorker()
+            self._worker.moveToThread(self._thread)
+            self._thread.started.connect(self._worker.start)
+            self._thread.finished.connect(self._worker.deleteLater)
+            self._open_requested.connect(self._worker.open)
+            self._send_text_requested.connect(self._worker.send_text)
+            self._send_binary_requested.connect(self._worker.send_binary)
+            self._close_requested.connect(self._worker.close)
+            self._shutdown_requested.connect(self._worker.shutdown)
+            self._worker.connected.connect(self._on_worker_connected)
+            self._worker.disconnected.connect(self._on_disconnected)
+            self._worker.frames_decoded.connect(self._on_frames_decoded)
+            self._thread.start()
+        else:
+            self.websocket = QWebSocket()
+            self.websocket.connected.connect(self._on_connected)
+            self.websocket.disconnected.connect(self._on_disconnected)
+            self.websocket.textMessageReceived.connect(self._on_text_message_received)
+            self.websocket.binaryMessageReceived.connect(self._on_binary_message_received)
+        self._batched_messages = []  # Chat messages dispatched since the batch signals were last emitted
+        self._batched_direct_messages = []
+        self._batched_records = []
+        self.history_since = {}  # room -> server receive time (us) of the newest message we have; the server only sends newer history
+        self._session_ready = False  # Connected and assigned a color, so the outbox may be flushed
+        self._outbox = collections.OrderedDict()  # key -> payload waiting to be sent, in send order
+        self._outbox_keys = itertools.count()  # Keys of frames that are never coalesced
+        self._unacked = collections.OrderedDict()  # client_id -> payload sent but not acked yet
+        self._client_ids = itertools.count(1)
+        self._search_ids = itertools.count(1)
+        self._send_budget = TokenBucket(SEND_RATE, SEND_BURST, time.monotonic())
+        self._throttled_until = 0.0  # Monotonic time before which the server asked us not to send
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(0)  # Everything queued in one event loop turn goes out together
+        self._flush_timer.timeout.connect(self._flush_outbox)
+        self.codec = codec_for(None)  # Wire protocol negotiated with the server, JSON until connected
         self.client_color = None  # Assigned color from the server
-        self.connected_clients = []  # List of connected clients (updated by server)
+        self.room_members = {}  # room -> members keyed by color (snapshot from the server, then presence deltas)
+        self.connected_clients = {}  # Members of the default room keyed by color
+        self._typing_room = None  # Room the server was last told we are typing in, if any
+        self._last_typing_start = 0.0
+        self._typing_idle_timer = QTimer(self)
+        self._typing_idle_timer.setSingleShot(True)
+        self._typing_idle_timer.setInterval(TYPING_IDLE_MS)
+        self._typing_idle_timer.timeout.connect(self.stop_typing)
+        self._resume_token = None  # Token of the server-side session, for resuming it after a drop
+        self._room_seq = {}  # room -> sequence number of the last chat message received
+        self._direct_seq = 0  # Sequence number of the last direct message received
+        self._seen_id_order = collections.deque(maxlen=SEEN_MESSAGE_IDS)
+        self._seen_ids = set()
+        self._closing = False  # Set when the user disconnects, so no reconnect is attempted
+        self._reconnect_delay = RECONNECT_MIN_MS
+        self._reconnect_timer = QTimer(self)
+        self._reconnect_timer.setSingleShot(True)
+        self._reconnect_timer.timeout.connect(self._reconnect)
+        self.latency_tracking = False  # Stamp sent messages and report latencies
+        self._clock_samples = collections.deque(maxlen=CLOCK_SAMPLES)  # (round trip, server clock - our clock) in microseconds
+        self._clock_offset_us = 0
 
     def connect_to_server(self):
         """
         Initiates the WebSocket connection to the server.
         """
-        self.websocket.open(self.server_url)
+        self._closing = False
+        self._open()
 
     def disconnect_from_server(self):
         """
-        Closes the WebSocket connection to the server.
+        Closes the WebSocket connection to the server. The session ends and is not resumed.
         """
-        self.websocket.close()
+        self._closing = True
+        self._reconnect_timer.stop()
+        if self.threaded:
+            self._close_requested.emit()
+        else:
+            self.websocket.close()
+
+    def shutdown(self):
+        """
+        Closes the connection and, in threaded mode, stops the worker thread. Call before the application exits.
+
+        In threaded mode this blocks until the worker has finished the close
+        handshake (at most SHUTDOWN_TIMEOUT_MS), so the thread is not stopped
+        before the close frame has gone out and the server has answered it.
+        """
+        if not self.threaded:
+            self.disconnect_from_server()
+            return
+        self._closing = True
+        self._reconnect_timer.stop()
+        self._shutdown_requested.emit()  # The worker quits its own thread once the socket is closed
+        self._thread.wait()
+
+    def _connection_url(self):
+        """
+        Returns the URL to connect to, carrying the resume token and last seen
+        sequence numbers if there is a session to resume.
+        """
+        if self._resume_token is None:
+            if DEFAULT_ROOM not in self.history_since:
+                return self.server_url
+            query = [("history_since", self.history_since[DEFAULT_ROOM])]  # The server joins us to the default room itself
+        else:
+            query = [("resume", self._resume_token), ("direct", self._direct_seq)]
+            query += [("since", f"{room}:{seq}") for room, seq in self._room_seq.items()]
+        url = urllib.parse.urlsplit(self.server_url)
+        return urllib.parse.urlunsplit(url._replace(path=url.path or "/", query=urllib.parse.urlencode(query)))
+
+    def _open(self):
+        """Opens the connection, offering the supported subprotocols."""
+        if self.threaded:
+            self._open_requested.emit(self._connection_url(), SUBPROTOCOLS)
+            return
+        options = QWebSocketHandshakeOptions()
+        options.setSubprotocols(SUBPROTOCOLS)
+        self.websocket.open(QUrl(self._connection_url()), options)
+
+    @Slot()
+    def _reconnect(self):
+        print(f"Reconnecting to {self.server_url}")
+        self._open()
+
+    def _reset_session(self):
+        """Forgets everything tied to the server-side session."""
+        self.room_members = {}
+        self.connected_clients = {}
+        self._room_seq = {}
+        self._direct_seq = 0
+        self._seen_id_order.clear()
+        self._seen_ids.clear()
 
     @Slot()
     def _on_connected(self):
@@ -60,83 +355,369 @@ class WebSocketClient(QObject):
         Slot called when the WebSocket connection is successfully established.
         Emits the 'connected' signal.
         """
+        self._on_worker_connected(self.websocket.subprotocol())
+
+    @Slot(str)
+    def _on_worker_connected(self, subprotocol):
+        """
+        Handles an established connection, given the negotiated subprotocol.
+        """
+        self._socket_open = True
+        self._reconnect_delay = RECONNECT_MIN_MS
+        self.codec = codec_for(subprotocol)
         self.connected.emit()
-        print("WebSocket connected")
+        print(f"WebSocket connected ({self.codec.subprotocol})")
 
     @Slot()
     def _on_disconnected(self):
         """
         Slot called when the WebSocket connection is closed.
         Emits the 'disconnected' signal and resets client color.
+
+        Unless the user asked to disconnect, a reconnect is scheduled with
+        exponential backoff. Room state is kept until the server tells us
+        whether the session was resumed.
         """
+        self._socket_open = False
+        self._session_ready = False
+        self._drop_ephemeral()
         self.disconnected.emit()
         self.client_color = None # Reset color on disconnect
-        print("WebSocket disconnected")
+        self._typing_idle_timer.stop()
+        self._typing_room = None
+        if self._closing:
+            self._resume_token = None
+            self._reset_session()
+            print("WebSocket disconnected")
+        else:
+            print(f"WebSocket disconnected, reconnecting in {self._reconnect_delay} ms")
+            self._reconnect_timer.start(self._reconnect_delay)
+            self._reconnect_delay = min(self._reconnect_delay * 2, RECONNECT_MAX_MS)
 
     @Slot(str)
     def _on_text_message_received(self, message):
         """
         Slot called when a text message is received from the WebSocket server.
-        Parses the JSON message and emits appropriate signals based on the 'type' field.
+        Decodes the JSON message and handles it.
 
         Args:
             message (str): The received JSON message as a string.
         """
+        self._handle_frame(message)
+
+    @Slot(QByteArray)
+    def _on_binary_message_received(self, message):
+        """
+        Slot called when a binary frame is received from the WebSocket server.
+        Decodes the frame and handles it.
+
+        Args:
+            message (QByteArray): The received binary frame.
+        """
+        self._handle_frame(message.data())
+
+    def _handle_frame(self, frame):
+        """
+        Decodes a received frame into a typed message and emits appropriate signals based on its type.
+
+        Args:
+            frame (str or bytes): The received frame, text for JSON and bytes for binary.
+        """
+        received_us = time.time_ns() // 1000
         try:
-            data = json.loads(message)
-            message_type = data.get("type")
+            message = decode_message(frame)
+        except ValueError as e:
+            print(f"Failed to decode message: {e}")
+            return
+        self._dispatch(message, received_us)
+        self._emit_batches()
+
+    @Slot(list)
+    def _on_frames_decoded(self, batch):
+        """
+        Handles a batch of messages decoded by the worker thread.
+
+        Args:
+            batch (list): (receive time in microseconds, typed message) pairs in arrival order.
+        """
+        for received_us, message in batch:
+            self._dispatch(message, received_us)
+        self._emit_batches()
+
+    def _emit_batches(self):
+        """Emits the batch signals for the chat and direct messages dispatched since the last call."""
+        if self._batched_messages:
+            batch, self._batched_messages = self._batched_messages, []
+            self.messages_received.emit(batch)
+        if self._batched_direct_messages:
+            batch, self._batched_direct_messages = self._batched_direct_messages, []
+            self.direct_messages_received.emit(batch)
+        if self._batched_records:
+            batch, self._batched_records = self._batched_records, []
+            self.message_records_received.emit(batch)
+
+    def _dispatch(self, message, received_us):
+        """
+        Applies a decoded message and emits the per-message signals for it.
 
-            if message_type == "color_assignment":
-                self.client_color = data.get("color")
+        Args:
+            message: The typed message (see message_packet.py).
+            received_us (int): When its frame arrived, in wall-clock microseconds.
+        """
+        try:
+            if not self._is_new_frame(message):
+                return  # Already received before a reconnect
+
+            if isinstance(message, ColorAssignment):
+                if not message.resumed:
+                    self._reset_session()  # A new session; the old one, if any, is gone
+                self._resume_token = message.resume_token
+                self.client_color = message.color
                 self.color_assigned.emit(self.client_color)
                 print(f"Color assigned: {self.client_color}")
+                self._on_session_ready()
+
+            elif isinstance(message, ClientList):
+                room = message.room
+                clients = list(message.clients)
+                newly_joined = room not in self.room_members
+                members = {client["color"]: client for client in clients} # Replace with the full snapshot
+                self.room_members[room] = members
+                # Chat frames may overtake a snapshot in the server's queue, so it never moves the sequence back
+                self._room_seq[room] = max(self._room_seq.get(room, 0), message.seq)
+                if room == DEFAULT_ROOM:
+                    self.connected_clients = members
+                    self.client_list_updated.emit(clients)
+                self.room_client_list_received.emit(room, clients)
+                if newly_joined:
+                    self.room_joined.emit(room)
+
+            elif isinstance(message, Presence):
+                self._apply_presence(message.room, message.joined, message.left)
+
+            elif isinstance(message, RoomLeft):
+                room = message.room
+                self._room_seq.pop(room, None)
+                if self.room_members.pop(room, None) is not None:
+                    if room == DEFAULT_ROOM:
+                        self.connected_clients = {}
+                        self.client_list_updated.emit([])
+                    self.room_left.emit(room)
+
+            elif isinstance(message, Ack):
+                payload = self._unacked.pop(message.client_id, None) if message.client_id is not None else None
+                if message.client_id is None or payload is not None:
+                    self._record_round_trip(message, received_us)  # Not for a repeated ack of a resend
+                if message.client_id is not None:
+                    requeued = self._outbox.pop(("message", message.client_id), None)  # Requeued by a throttle but handled after all
+                    payload = payload or requeued
+                    if payload is not None and message.id is not None:  # Relayed; now it has the server's id and time
+                        self._batched_records.append(own_message_record(payload, message, self.client_color))
+                    self.message_acknowledged.emit(message.client_id)
+
+            elif isinstance(message, ChatMessage):
+                self._record_delivery(message, received_us)
+                self._batched_messages.append((message.room, message.message, message.sender_color))
+                self._batched_records.append(dict(message._asdict(), type=message.type))
+                self._note_history(message.room, message.server_received_us)
+                self.room_message_received.emit(message.room, message.message, message.sender_color)
+                if message.room == DEFAULT_ROOM:
+                    self.message_received.emit(message.message, message.sender_color)
+
+            elif isinstance(message, History):
+                for entry in message.messages:
+                    self._note_history(message.room, entry.get("server_received_us"))
+                self.history_received.emit(message.room, list(message.messages))
+
+            elif isinstance(message, DirectMessage):
+                self._record_delivery(message, received_us)
+                self._batched_direct_messages.append((message.message, message.sender_color, message.recipient_color))
+                self._batched_records.append(dict(message._asdict(), type=message.type))
+                self.direct_message_received.emit(message.message, message.sender_color, message.recipient_color)
+
+            elif isinstance(message, TypingStart):
+                self.room_typing_started.emit(message.room, message.sender_color)
+                if message.room == DEFAULT_ROOM:
+                    self.typing_started.emit(message.sender_color)
+
+            elif isinstance(message, TypingStop):
+                self.room_typing_stopped.emit(message.room, message.sender_color)
+                if message.room == DEFAULT_ROOM:
+                    self.typing_stopped.emit(message.sender_color)
+
+            elif isinstance(message, Ping):
+                self._write_frame({"type": "pong"})  # Not paced like the outbox: the server drops connections that answer late
+
+            elif isinstance(message, SearchResults):
+                self.search_results_received.emit(message.request_id or "", message.room, list(message.messages), message.cursor or "")
+
+            elif isinstance(message, Error):
+                if message.retry_after_ms is not None:
+                    self._throttle(message.retry_after_ms)
+                self.error_received.emit(message.message)
+                print(f"Server Error: {message.message}")
 
-            elif message_type == "client_list":
-                clients = data.get("clients", [])
-                self.connected_clients = clients # Update internal client list
-                self.client_list_updated.emit(clients)
+            else:
+                print(f"Received unknown message type: {message.type}")
 
-            elif message_type == "message":
-                sender_color = data.get("sender_color")
-                message_text = data.get("message")
-                self.message_received.emit(message_text, sender_color)
+        except Exception as e:
+            print(f"Error processing received message: {e}")
 
-            elif message_type == "direct_message":
-                sender_color = data.get("sender_color")
-                recipient_color = data.get("recipient_color")
-                message_text = data.get("message")
-                self.direct_message_received.emit(message_text, sender_color, recipient_color)
+    def _is_new_frame(self, message):
+        """
+        Records the sequence number and message id of a received message.
 
-            elif message_type == "typing_start":
-                sender_color = data.get("sender_color")
-                self.typing_started.emit(sender_color)
+        Returns:
+            bool: False if the message was already received and should be dropped.
+        """
+        message_id = getattr(message, "id", None)
+        if message_id is not None:
+            if message_id in self._seen_ids:
+                return False
+            if len(self._seen_id_order) == self._seen_id_order.maxlen:
+                self._seen_ids.discard(self._seen_id_order[0])
+            self._seen_id_order.append(message_id)
+            self._seen_ids.add(message_id)
+
+        seq = getattr(message, "seq", None)
+        if seq is None or isinstance(message, ClientList):
+            return True
+        if isinstance(message, DirectMessage):
+            if seq <= self._direct_seq:
+                return False
+            self._direct_seq = seq
+        else:
+            if seq <= self._room_seq.get(message.room, 0):
+                return False
+            self._room_seq[message.room] = seq
+        return True
 
-            elif message_type == "typing_stop":
-                sender_color = data.get("sender_color")
-                self.typing_stopped.emit(sender_color)
+    def _note_history(self, room, server_received_us):
+        """Remembers the newest server receive time seen in a room, so rejoining it only fetches newer history."""
+        if server_received_us is not None and server_received_us > self.history_since.get(room, 0):
+            self.history_since[room] = server_received_us
 
-            elif message_type == "error":
-                error_message = data.get("message", "Unknown error")
-                self.error_received.emit(error_message)
-                print(f"Server Error: {error_message}")
+    def set_latency_tracking(self, enabled):
+        """
+        Turns latency measurement on or off.
 
-            else:
-                print(f"Received unknown message type: {message_type}")
+        Args:
+            enabled (bool): Whether to stamp sent messages and emit 'latency_measured'.
+        """
+        self.latency_tracking = enabled
+
+    def _record_round_trip(self, ack, received_us):
+        """Emits the round trip of an acked message and refines the clock offset estimate."""
+        if not self.latency_tracking or ack.client_sent_us is None:
+            return
+        round_trip = received_us - ack.client_sent_us
+        if ack.server_received_us is not None and ack.server_sent_us is not None:
+            # NTP-style: the server stamps sit halfway between our send and receive, less the time the server held the message
+            offset = ((ack.server_received_us - ack.client_sent_us) + (ack.server_sent_us - received_us)) // 2
+            self._clock_samples.append((round_trip, offset))
+            self._clock_offset_us = min(self._clock_samples)[1]  # The shortest round trip has the least queueing noise
+        self.latency_measured.emit("round_trip", round_trip / 1000)
+
+    def _record_delivery(self, message, received_us):
+        """Emits how long a relayed message took from reaching the server to reaching us."""
+        if self.latency_tracking and message.server_received_us is not None:
+            delivery = received_us + self._clock_offset_us - message.server_received_us
+            self.latency_measured.emit("delivery", delivery / 1000)
+
+    def _send_tracked(self, payload):
+        """
+        Gives a chat or direct message a client_id, stamps its send time when latency tracking is on, and queues it.
 
-        except json.JSONDecodeError:
-            print(f"Failed to decode JSON message: {message}")
-        except Exception as e:
-            print(f"Error processing received message: {e}")
+        Text longer than the server accepts is refused here with an
+        'error_received', since the server would never relay it. So is a
+        message that would take the outbox past OUTBOX_LIMIT (e.g. after a
+        long time offline): queued messages are never dropped to make room.
 
-    def send_chat_message(self, message_text):
+        Returns:
+            str: The client_id the server will ack, or None if the message was refused.
         """
-        Sends a chat message to the room (broadcast to all connected clients).
+        if len(payload["message"]) > MAX_MESSAGE_LENGTH:
+            self.error_received.emit(f"Messages are limited to {MAX_MESSAGE_LENGTH} characters.")
+            return None
+        if len(self._outbox) + len(self._unacked) >= OUTBOX_LIMIT:
+            self.error_received.emit(f"{OUTBOX_LIMIT} messages are already waiting to be sent; try again once they are.")
+            return None
+        client_id = str(next(self._client_ids))
+        payload["client_id"] = client_id
+        if self.latency_tracking:
+            payload["client_sent_us"] = time.time_ns() // 1000
+        self._send_message(payload, ("message", client_id))
+        return client_id
+
+    def _apply_presence(self, room, joined_colors, left_colors):
+        """
+        Applies a presence delta to a room's member list.
+
+        Leaves are applied before joins, and both are idempotent, so deltas that
+        overlap the initial snapshot are harmless.
+
+        Args:
+            room (str): The room the delta is for.
+            joined_colors (list): Colors of clients that joined.
+            left_colors (list): Colors of clients that left.
+        """
+        members = self.room_members.get(room)
+        if members is None:
+            return  # Not (or no longer) a member of this room
+
+        left = [members.pop(color) for color in left_colors if color in members]
+        joined = []
+        for color in joined_colors:
+            if color not in members:
+                client = {"color": color}
+                members[color] = client
+                joined.append(client)
+
+        if left:
+            self.clients_left.emit(room, left)
+        if joined:
+            self.clients_joined.emit(room, joined)
+        if room == DEFAULT_ROOM and (left or joined):
+            self.client_list_updated.emit(self.get_connected_clients())
+
+    def join_room(self, room):
+        """
+        Joins a room. 'room_joined' is emitted once the server has sent the room's member list.
+
+        Args:
+            room (str): The room name.
+        """
+        message_payload = {"type": "join_room", "room": room}
+        if room in self.history_since:
+            message_payload["history_since_us"] = self.history_since[room]
+        self._send_message(message_payload)
+
+    def leave_room(self, room):
+        """
+        Leaves a room. 'room_left' is emitted once the server confirms.
+
+        Args:
+            room (str): The room name.
+        """
+        if self._typing_room == room:
+            self.stop_typing()
+        self._send_message({"type": "leave_room", "room": room})
+
+    def send_chat_message(self, message_text, room=DEFAULT_ROOM):
+        """
+        Sends a chat message to a room (broadcast to all of its members).
 
         Args:
             message_text (str): The message text to send.
+            room (str, optional): The room to send to. Defaults to the default room.
+
+        Returns:
+            str: The client_id that 'message_acknowledged' reports once the server has handled the message,
+                or None if the text is longer than MAX_MESSAGE_LENGTH.
         """
-        message_payload = {"type": "message", "message": message_text}
-        self._send_message_json(message_payload)
+        self.stop_typing()  # Sending ends the typing state
+        message_payload = {"type": "message", "room": room, "message": message_text}
+        return self._send_tracked(message_payload)
 
     def send_direct_message(self, recipient_color, message_text):
         """
@@ -145,35 +726,178 @@ class WebSocketClient(QObject):
         Args:
             recipient_color (str): The color of the recipient client.
             message_text (str): The message text to send.
+
+        Returns:
+            str: The client_id that 'message_acknowledged' reports once the server has handled the message,
+                or None if the text is longer than MAX_MESSAGE_LENGTH.
         """
         message_payload = {"type": "direct_message", "recipient_color": recipient_color, "message": message_text}
-        self._send_message_json(message_payload)
+        return self._send_tracked(message_payload)
+
+    def search(self, text, room=DEFAULT_ROOM, cursor=None):
+        """
+        Searches the server's history of a room the client is in. Results arrive through 'search_results_received'.
+
+        Args:
+            text (str): Words the messages must all contain.
+            room (str, optional): The room to search. Defaults to the default room.
+            cursor (str, optional): Cursor of the previous page, to get the next one. Defaults to the first page.
+
+        Returns:
+            str: The request_id the results will carry.
+        """
+        request_id = str(next(self._search_ids))
+        message_payload = {"type": "search", "room": room, "query": text, "request_id": request_id}
+        if cursor:
+            message_payload["cursor"] = cursor
+        self._send_message(message_payload)
+        return request_id
+
+    def notify_typing(self, room=DEFAULT_ROOM):
+        """
+        Debounced typing notification, meant to be called on every keystroke.
+
+        Sends 'typing_start' only when the typing state changes (or as a periodic
+        keep-alive while typing continues) and 'typing_stop' once the user has been
+        idle for TYPING_IDLE_MS. Typing in a different room ends typing in the previous one.
+
+        Args:
+            room (str, optional): The room being typed in. Defaults to the default room.
+        """
+        if self._typing_room is not None and self._typing_room != room:
+            self.stop_typing()
+        now = time.monotonic()
+        if self._typing_room is None or now - self._last_typing_start >= TYPING_REFRESH_SECONDS:
+            self._typing_room = room
+            self._last_typing_start = now
+            self.send_typing_start(room)
+        self._typing_idle_timer.start()  # Restart the idle countdown
+
+    @Slot()
+    def stop_typing(self):
+        """
+        Ends the typing state, sending 'typing_stop' only if 'typing_start' was sent.
+        """
+        self._typing_idle_timer.stop()
+        if self._typing_room is not None:
+            room, self._typing_room = self._typing_room, None
+            self.send_typing_stop(room)
 
-    def send_typing_start(self):
+    def send_typing_start(self, room=DEFAULT_ROOM):
         """
         Sends a 'typing_start' indicator to the server.
+
+        Args:
+            room (str, optional): The room being typed in. Defaults to the default room.
         """
-        message_payload = {"type": "typing_start"}
-        self._send_message_json(message_payload)
+        message_payload = {"type": "typing_start", "room": room}
+        self._send_message(message_payload, ("typing",))
 
-    def send_typing_stop(self):
+    def send_typing_stop(self, room=DEFAULT_ROOM):
         """
         Sends a 'typing_stop' indicator to the server.
+
+        Args:
+            room (str, optional): The room that was being typed in. Defaults to the default room.
         """
-        message_payload = {"type": "typing_stop"}
-        self._send_message_json(message_payload)
+        message_payload = {"type": "typing_stop", "room": room}
+        self._send_message(message_payload, ("typing",))
 
-    def _send_message_json(self, payload):
+    def _is_socket_valid(self):
+        """Whether the connection can take a frame. In threaded mode the worker reports it through signals."""
+        return self._socket_open if self.threaded else self.websocket.isValid()
+
+    def _send_message(self, payload, key=None):
         """
-        Internal helper function to send a JSON payload over the WebSocket connection.
+        Internal helper function to queue a payload for the WebSocket connection.
 
         Args:
-            payload (dict): The message payload to send as a dictionary (will be converted to JSON).
+            payload (dict): The message payload to send as a dictionary (encoded with the negotiated codec).
+            key (tuple, optional): Outbox key. A payload with the key of an unsent one replaces it in place;
+                ("typing",) marks typing indicators, which are not kept while offline. Defaults to a unique key.
+        """
+        if key == ("typing",) and not self._session_ready:
+            return  # Stale by the time we are back online
+        if key is None:
+            key = ("frame", next(self._outbox_keys))
+        self._outbox[key] = payload
+        if len(self._outbox) > OUTBOX_LIMIT:
+            # Chat and direct messages are capped by _send_tracked instead, so there is always another frame to drop
+            dropped_key = next(key for key in self._outbox if key[0] != "message")
+            del self._outbox[dropped_key]
+            print(f"Outbox full, dropped the oldest unsent frame {dropped_key}")
+        if self._session_ready and not self._flush_timer.isActive():
+            self._flush_timer.start(0)
+
+    def _requeue_unacked(self):
         """
-        if self.websocket.isValid(): # Check if socket is in a valid state to send
+        Moves the messages sent but not acked back to the front of the outbox, in their original order.
+
+        The server answers resends of messages it already handled with their
+        ack instead of relaying them again, also after a failed resume: the
+        connection URL still carries the old resume token, and the server
+        keeps the acks of ended sessions by token for a while.
+        """
+        if self._unacked:
+            resend = collections.OrderedDict((("message", client_id), payload) for client_id, payload in self._unacked.items())
+            resend.update(self._outbox)
+            self._outbox = resend
+            self._unacked.clear()
+
+    def _on_session_ready(self):
+        """Requeues unacked messages ahead of the outbox and flushes it, once a session is (re)established."""
+        self._session_ready = True
+        self._requeue_unacked()
+        self._flush_outbox()
+
+    def _throttle(self, retry_after_ms):
+        """
+        Pauses sending after the server refused frames for exceeding a rate limit.
+
+        Refused messages are never acked, so every unacked message is queued
+        again; the server answers the ones it did handle with their stored ack.
+        """
+        self._throttled_until = time.monotonic() + retry_after_ms / 1000
+        self._requeue_unacked()
+        self._flush_timer.start(retry_after_ms)
+
+    def _drop_ephemeral(self):
+        """Forgets unsent typing indicators, e.g. when the connection drops."""
+        self._outbox.pop(("typing",), None)
+
+    @Slot()
+    def _flush_outbox(self):
+        """
+        Sends queued frames in order, pipelined without waiting for acks, but
+        no faster than the server's rate limits allow; the rest waits for the timer.
+        """
+        self._flush_timer.stop()
+        while self._outbox and self._session_ready:
+            now = time.monotonic()
+            wait = max(self._throttled_until - now, 0.0) or self._send_budget.take(now)
+            if wait:
+                self._flush_timer.start(math.ceil(wait * 1000))
+                return
+            key, payload = self._outbox.popitem(last=False)
+            if key[0] == "message":
+                self._unacked[key[1]] = payload  # Held until acked, so a drop cannot lose it
+            self._write_frame(payload)
+
+    def _write_frame(self, payload):
+        """
+        Encodes a payload with the negotiated codec and writes it to the socket.
+        """
+        if self._is_socket_valid(): # Check if socket is in a valid state to send
             try:
-                json_message = json.dumps(payload)
-                self.websocket.sendTextMessage(json_message)
+                frame = self.codec.encode(payload)
+                if self.threaded and self.codec.subprotocol == BINARY_SUBPROTOCOL:
+                    self._send_binary_requested.emit(frame)
+                elif self.threaded:
+                    self._send_text_requested.emit(frame)
+                elif self.codec.subprotocol == BINARY_SUBPROTOCOL:
+                    self.websocket.sendBinaryMessage(QByteArray(frame))
+                else:
+                    self.websocket.sendTextMessage(frame)
             except Exception as e:
                 print(f"Error sending message: {e}")
         else:
@@ -186,12 +910,21 @@ class WebSocketClient(QObject):
         """
         return self.client_color
 
-    def get_connected_clients(self):
+    def get_connected_clients(self, room=DEFAULT_ROOM):
+        """
+        Returns the current list of clients in a room (as received from the server).
+        Returns an empty list if not connected, not in the room or list not yet received.
+
+        Args:
+            room (str, optional): The room. Defaults to the default room.
+        """
+        return list(self.room_members.get(room, {}).values()) # Return a copy to avoid direct modification
+
+    def get_rooms(self):
         """
-        Returns the current list of connected clients (as received from the server).
-        Returns an empty list if not connected or list not yet received.
+        Returns the names of the rooms this client is currently in.
         """
-        return self.connected_clients[:] # Return a copy to avoid direct modification
+        return list(self.room_members)
 
 # if __name__ == '__main__':
 #     import sys
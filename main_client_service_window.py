@@ -1,32 +1,142 @@
-from PySide6.QtWidgets import QMainWindow, QVBoxLayout, QPlainTextEdit, QLineEdit, QPushButton, QWidget, QApplication, QHBoxLayout, QLabel, QDockWidget, QListView
+from PySide6.QtWidgets import QMainWindow, QVBoxLayout, QLineEdit, QPushButton, QWidget, QApplication, QHBoxLayout, QLabel, QDockWidget, QListView, QCheckBox, QListWidget
 from PySide6.QtWebSockets import QWebSocket
 from PySide6.QtNetwork import QAbstractSocket
-from PySide6.QtCore import QUrl, Qt
+from PySide6.QtCore import QSortFilterProxyModel, QStandardPaths, QTimer, QUrl, Qt
 from main_client_service import WebSocketClient
-from PySide6.QtGui import QStandardItemModel, QStandardItem, QColor
+from message_packet import DEFAULT_ROOM, MAX_MESSAGE_LENGTH
+from chat_models import ChatLogModel, UserListModel
+from message_cache import MessageCache
+import collections
+import os
+
+LATENCY_WINDOW = 200 # Most recent samples the latency readout is computed over
+LATENCY_REFRESH_MS = 1000 # How often the latency readout is redrawn
+CACHED_MESSAGES_ON_START = 200 # Cached default room messages shown before the server is reached
+
+
+class RollingLatency:
+    """Keeps the last LATENCY_WINDOW samples of one kind of latency and reports their percentiles."""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, milliseconds):
+        self.samples.append(milliseconds)
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def describe(self, name):
+        if not self.samples:
+            return f"{name} -"
+        return f"{name} p50 {self.percentile(0.5):.0f} / p99 {self.percentile(0.99):.0f} ms"
+
 
 
 class ChatWindow(QMainWindow):
     def __init__(self):
         super().__init__()
-        self.client = WebSocketClient("wss://chat.aaf-services.uk")
+        self.client = WebSocketClient("wss://chat.aaf-services.uk", threaded=True) # Frames are decoded off the GUI thread
         self.client.connected.connect(self.on_connected)
         self.client.disconnected.connect(self.on_disconnect)
-        self.client.message_received.connect(self.incoming_text_message)
-        self.client.client_list_updated.connect(self.on_user_list_updated)
+        self.client.messages_received.connect(self.incoming_text_messages)
+        self.client.history_received.connect(self.on_history_received)
+        self.client.message_records_received.connect(self.on_message_records)
+        self.client.room_client_list_received.connect(self.on_room_client_list)
+        self.client.clients_joined.connect(self.on_clients_joined)
+        self.client.clients_left.connect(self.on_clients_left)
+        self.client.room_left.connect(self.on_room_left)
         self.client.typing_started.connect(self.add_typer)
         self.client.typing_stopped.connect(self.remove_typer)
+        self.client.error_received.connect(self.on_error)
         self.typing_users = {}
         self.typing_user_index = 0
 
         cca = self.central_chat_area()
         self.setCentralWidget(cca)
 
-        self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, self.user_list_dock())
+        user_dock = self.user_list_dock()
+        self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, user_dock)
+        search_dock = self.search_dock()
+        self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, search_dock)
+        self.tabifyDockWidget(user_dock, search_dock)
+        user_dock.raise_()
+        self.latency_status_bar()
+        self.load_cached_messages()
 
         self.setWindowTitle("AAF Chat")
         self.setFixedSize(500, 350)
     
+    def open_cache(self):
+        """Opens the local message cache in the application data directory."""
+        directory = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppDataLocation)
+        os.makedirs(directory, exist_ok=True)
+        return MessageCache(os.path.join(directory, "message_cache.sqlite3"))
+
+    def load_cached_messages(self):
+        """Shows the cached default room messages right away and asks the server only for newer ones."""
+        self.cache = self.open_cache()
+        for message in self.cache.recent(DEFAULT_ROOM, CACHED_MESSAGES_ON_START):
+            self.incoming_text_message(message["message"], message["sender_color"])
+        newest = self.cache.newest_server_time(DEFAULT_ROOM)
+        if newest is not None:
+            self.client.history_since[DEFAULT_ROOM] = newest
+
+    def on_message_records(self, messages):
+        self.cache.add_many(messages) # Written in batches on the cache's own thread; our own arrive once acked, with the server's id and time
+
+    def search_dock(self):
+        sd = QDockWidget("Search")
+        sd.setAllowedAreas(Qt.DockWidgetArea.LeftDockWidgetArea)
+        sd.setFeatures(QDockWidget.DockWidgetFeature.NoDockWidgetFeatures)
+        sd.setFixedWidth(150)
+        container = QWidget()
+        layout = QVBoxLayout()
+        container.setLayout(layout)
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search history")
+        self.search_input.returnPressed.connect(self.search_history)
+        self.search_results = QListWidget()
+        layout.addWidget(self.search_input)
+        layout.addWidget(self.search_results)
+        sd.setWidget(container)
+        return sd
+
+    def search_history(self):
+        self.search_results.clear()
+        for message in self.cache.search(self.search_input.text()):
+            where = message.get("room") or f"DM {message.get('recipient_color')}"
+            self.search_results.addItem(f"[{where}] {message.get('sender_color')}: {message['message']}")
+
+    def latency_status_bar(self):
+        """Adds an opt-in readout of rolling round-trip and delivery latencies to the status bar."""
+        self.latencies = {"round_trip": RollingLatency(), "delivery": RollingLatency()}
+        self.latency_label = QLabel()
+        latency_toggle = QCheckBox("Latency")
+        latency_toggle.toggled.connect(self.toggle_latency)
+        self.statusBar().addWidget(latency_toggle)
+        self.statusBar().addWidget(self.latency_label)
+        self.latency_timer = QTimer(self) # Redraw on a timer rather than per message
+        self.latency_timer.setInterval(LATENCY_REFRESH_MS)
+        self.latency_timer.timeout.connect(self.refresh_latency)
+        self.client.latency_measured.connect(self.on_latency_measured)
+
+    def toggle_latency(self, enabled):
+        self.client.set_latency_tracking(enabled)
+        if enabled:
+            self.latency_timer.start()
+            self.refresh_latency()
+        else:
+            self.latency_timer.stop()
+            self.latency_label.clear()
+
+    def on_latency_measured(self, kind, milliseconds):
+        self.latencies[kind].add(milliseconds)
+
+    def refresh_latency(self):
+        self.latency_label.setText(f"{self.latencies['round_trip'].describe('RTT')} · {self.latencies['delivery'].describe('delivery')}")
+
     def user_list_dock(self):
         uld = QDockWidget("Connected Users")
         uld.setAllowedAreas(Qt.DockWidgetArea.LeftDockWidgetArea)
@@ -40,36 +150,49 @@ class ChatWindow(QMainWindow):
         layout = QVBoxLayout() # Use a layout (e.g., QVBoxLayout)
         user_list_container.setLayout(layout)
 
+        self.user_search = QLineEdit()
+        self.user_search.setPlaceholderText("Search users")
         self.user_list_view = QListView()
-        self.user_list_model = QStandardItemModel() # Create the model
-        self.user_list_view.setModel(self.user_list_model) # Set the model for the view
+        self.user_list_view.setUniformItemSizes(True)
+        self.user_list_model = UserListModel(self) # Updated row by row from presence deltas
+        self.user_list_filter = QSortFilterProxyModel(self) # Search filters the view, the model is never rebuilt
+        self.user_list_filter.setSourceModel(self.user_list_model)
+        self.user_list_filter.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self.user_search.textChanged.connect(self.user_list_filter.setFilterFixedString)
+        self.user_list_view.setModel(self.user_list_filter) # Set the model for the view
 
+        layout.addWidget(self.user_search)
         layout.addWidget(self.user_list_view) # Add the QListView to the layout
 
         return user_list_container # Return the container widget
 
     def update_user_list(self, clients):
         """
-        Updates the QListView with the new list of connected clients using a QStandardItemModel.
+        Replaces the user list with a full snapshot of connected clients.
 
         Args:
             clients (list): A list of client dictionaries, e.g., [{'color': '#RRGGBB'}, ...].
         """
-        self.user_list_model.clear() # Clear the model
-
-        for client_data in clients:
-            color = client_data.get('color')
-            if color:
-                item = QStandardItem(f"User: {color}") # Create a model item
-                item.setForeground(QColor(color)) # Style the item
-                self.user_list_model.appendRow(item) # Add item to the model
-    
-    def on_user_list_updated(self, clients):
-        self.update_user_list(clients)
+        self.user_list_model.set_users(clients)
+
+    def on_room_client_list(self, room, clients):
+        if room == DEFAULT_ROOM:
+            self.update_user_list(clients)
+
+    def on_clients_joined(self, room, clients):
+        if room == DEFAULT_ROOM:
+            self.user_list_model.add_users(clients)
+
+    def on_clients_left(self, room, clients):
+        if room == DEFAULT_ROOM:
+            self.user_list_model.remove_users(clients)
+
+    def on_room_left(self, room):
+        if room == DEFAULT_ROOM:
+            self.update_user_list([])
 
     def textedit(self):
-        self.client.send_typing_start()
-        self.client.send_typing_stop()
+        self.client.notify_typing()
 
     def central_chat_area(self):
         central_widget = QWidget()
@@ -77,10 +200,17 @@ class ChatWindow(QMainWindow):
         central_widget.setLayout(layout)
 
         self.conn_label = QLabel("🔴 Disconnected")
-        self.chat_display = QPlainTextEdit()
-        self.chat_display.setReadOnly(True)
+        self.chat_log = ChatLogModel(self)
+        self.chat_display = QListView()
+        self.chat_display.setModel(self.chat_log)
+        self.chat_display.setUniformItemSizes(True) # Rows are never measured one by one, only the visible ones are painted
+        self.chat_display.setTextElideMode(Qt.TextElideMode.ElideRight)
+        self.chat_display.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
+        self.chat_display.verticalScrollBar().valueChanged.connect(self.on_chat_scrolled)
+        self.chat_log.rowsInserted.connect(self.on_chat_rows_inserted)
         self.typing_display = QHBoxLayout()
         self.chat_input = QLineEdit()
+        self.chat_input.setMaxLength(MAX_MESSAGE_LENGTH)
         self.chat_input.textEdited.connect(self.textedit)
         send_button = QPushButton("Send")
 
@@ -106,6 +236,26 @@ class ChatWindow(QMainWindow):
 
         return central_widget
 
+    def on_chat_scrolled(self, value):
+        scroll_bar = self.chat_display.verticalScrollBar()
+        self.chat_log.following = value == scroll_bar.maximum() and not self.chat_log.has_newer()
+        step = self.chat_display.sizeHintForRow(0) if self.chat_log.rowCount() else 0
+        if value == scroll_bar.minimum() and self.chat_log.has_older():
+            loaded = self.chat_log.load_older()
+            scroll_bar.setValue(loaded * step) # Keep the line the user was looking at in place
+        elif value == scroll_bar.maximum() and self.chat_log.has_newer():
+            trimmed = self.chat_log.load_newer()
+            scroll_bar.setValue(value - trimmed * step) # Rows left at the top, keep the line in place
+
+    def on_chat_rows_inserted(self, parent, first, last):
+        if self.chat_log.following and first > 0: # New lines at the bottom, not an older page at the top
+            self.chat_display.scrollToBottom()
+
+    def closeEvent(self, event):
+        self.client.shutdown() # Stops the socket thread
+        self.cache.close() # Writes what is still queued
+        super().closeEvent(event)
+
     def connect_to_server(self):
         self.client.connect_to_server()
     
@@ -113,19 +263,33 @@ class ChatWindow(QMainWindow):
         self.client.disconnect_from_server()
     
     def on_connected(self):
-        self.chat_display.appendPlainText("Connected to server")
+        self.chat_log.append("Connected to server")
         self.conn_label.setText("🟢 Connected")
     
     def on_disconnect(self):
-        self.chat_display.appendPlainText("Disconnected from server")
+        self.chat_log.append("Disconnected from server")
         self.conn_label.setText("🔴 Disconnected")
     
     def incoming_text_message(self, text, sendercolor):
-        self.chat_display.appendPlainText(f"{sendercolor}: {text}")
+        self.chat_log.append(f"{sendercolor}: {text}", sendercolor)
+
+    def incoming_text_messages(self, messages):
+        for room, text, sendercolor in messages:
+            if room == DEFAULT_ROOM:
+                self.incoming_text_message(text, sendercolor)
+
+    def on_history_received(self, room, messages):
+        self.cache.add_many(messages)
+        if room == DEFAULT_ROOM:
+            for message in messages:
+                self.incoming_text_message(message.get("message"), message.get("sender_color"))
     
+    def on_error(self, message):
+        self.chat_log.append(f"Error: {message}")
+
     def send_message(self):
-        self.chat_display.appendPlainText(f"{self.client.get_client_color()} (You): {self.chat_input.text()}")
-        self.client.send_chat_message(self.chat_input.text())
+        if self.client.send_chat_message(self.chat_input.text()) is not None: # Otherwise it was refused and on_error says why
+            self.chat_log.append(f"{self.client.get_client_color()} (You): {self.chat_input.text()}", self.client.get_client_color())
     
     def add_typer(self, uc):
         if uc not in self.typing_users:
@@ -0,0 +1,170 @@
+import queue
+import sqlite3
+import threading
+import time
+
+CACHE_BATCH_SIZE = 500 # Most messages written in one transaction
+CACHE_SEARCH_LIMIT = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE, -- Server message id
+    room TEXT, -- NULL for direct messages
+    sender_color TEXT,
+    recipient_color TEXT,
+    message TEXT NOT NULL,
+    sent_us INTEGER NOT NULL -- When the server received the message (our own clock if a record lacks the stamp)
+);
+CREATE INDEX IF NOT EXISTS messages_by_room ON messages (room, sent_us);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='messages', content_rowid='rowid');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, message) VALUES (new.rowid, new.message);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.rowid, old.message);
+END;
+"""
+
+INSERT = "INSERT OR IGNORE INTO messages (id, room, sender_color, recipient_color, message, sent_us) VALUES (?, ?, ?, ?, ?, ?)"
+COLUMNS = "m.id, m.room, m.sender_color, m.recipient_color, m.message, m.sent_us"
+
+
+def own_message_record(payload, ack, sender_color):
+    """
+    Returns the record of a chat or direct message we sent, as the server relayed it to everyone else.
+
+    Args:
+        payload (dict): The message as we sent it.
+        ack (Ack): The server's ack of it, which carries the message id and the server's time stamps.
+        sender_color (str): Our color.
+    """
+    record = {name: value for name, value in payload.items() if name not in ("client_id", "client_sent_us")}
+    record.update(id=ack.id, sender_color=sender_color, server_received_us=ack.server_received_us, server_sent_us=ack.server_sent_us)
+    return record
+
+
+class MessageCache:
+    """
+    A local SQLite cache of room and direct messages with full-text search.
+
+    The database runs in WAL mode, so reads on the caller's thread never wait
+    for the writer. add() only queues a message; a writer thread inserts
+    whatever has queued up in one transaction, so a burst of messages costs
+    one commit and never blocks the GUI thread. Messages are deduplicated by
+    their server id. Searches go through an FTS5 index of the message text
+    (or a LIKE scan where SQLite lacks FTS5).
+
+    Messages are returned as dictionaries shaped like the server's
+    message / direct_message frames, with the time in "server_received_us".
+    """
+
+    def __init__(self, path, batch_size=CACHE_BATCH_SIZE):
+        """
+        Args:
+            path (str): Database file. Created if missing.
+            batch_size (int, optional): Most messages written per transaction. Defaults to CACHE_BATCH_SIZE.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._reader = self._connect()
+        self._reader.executescript(SCHEMA)
+        try:
+            self._reader.executescript(FTS_SCHEMA)
+            self.full_text = True
+        except sqlite3.OperationalError: # SQLite built without FTS5
+            self.full_text = False
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="message-cache-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, isolation_level=None) # Transactions are explicit
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent; only the last commits may be lost on power loss
+        return connection
+
+    def add(self, message):
+        """Queues a room message or direct message dictionary (as received from the server) for writing."""
+        sent_us = message.get("server_received_us") or time.time_ns() // 1000
+        room = None if message.get("type") == "direct_message" else message.get("room")
+        self._queue.put((message.get("id"), room, message.get("sender_color"), message.get("recipient_color"), message.get("message") or "", sent_us))
+
+    def add_many(self, messages):
+        for message in messages:
+            self.add(message)
+
+    def _write_loop(self):
+        connection = self._connect()
+        try:
+            while True:
+                rows = [self._queue.get()]
+                while len(rows) < self.batch_size:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in rows
+                rows = [row for row in rows if row is not None]
+                if rows:
+                    connection.execute("BEGIN")
+                    connection.executemany(INSERT, rows)
+                    connection.execute("COMMIT")
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def _rows_to_messages(self, rows):
+        messages = []
+        for message_id, room, sender_color, recipient_color, text, sent_us in rows:
+            message = {"type": "message" if room is not None else "direct_message", "id": message_id, "sender_color": sender_color, "message": text, "server_received_us": sent_us}
+            if room is not None:
+                message["room"] = room
+            else:
+                message["recipient_color"] = recipient_color
+            messages.append(message)
+        return messages
+
+    def recent(self, room, count):
+        """Returns up to count of the newest cached messages of a room, oldest first."""
+        rows = self._reader.execute(f"SELECT {COLUMNS} FROM messages m WHERE m.room = ? ORDER BY m.sent_us DESC LIMIT ?", (room, count)).fetchall()
+        return self._rows_to_messages(reversed(rows))
+
+    def newest_server_time(self, room):
+        """Returns the server receive time of the newest cached server message of a room, or None."""
+        return self._reader.execute("SELECT MAX(sent_us) FROM messages WHERE room = ? AND id IS NOT NULL", (room,)).fetchone()[0]
+
+    def search(self, text, room=None, limit=CACHE_SEARCH_LIMIT):
+        """
+        Returns up to limit cached messages containing every word of text, newest first.
+
+        Args:
+            text (str): Words to look for.
+            room (str, optional): Only search this room. Defaults to every room and direct message.
+            limit (int, optional): Most results. Defaults to CACHE_SEARCH_LIMIT.
+        """
+        words = text.split()
+        if not words:
+            return []
+        room_filter = " AND m.room = ?" if room is not None else ""
+        room_args = (room,) if room is not None else ()
+        if self.full_text:
+            query = " ".join('"' + word.replace('"', '""') + '"' for word in words) # Quoted, so user input is never FTS syntax
+            sql = (f"SELECT {COLUMNS} FROM messages_fts f "
+                   f"JOIN messages m ON m.rowid = f.rowid WHERE messages_fts MATCH ?{room_filter} ORDER BY m.sent_us DESC LIMIT ?")
+            rows = self._reader.execute(sql, (query,) + room_args + (limit,)).fetchall()
+        else:
+            like = " AND ".join("m.message LIKE ?" for _ in words)
+            sql = f"SELECT {COLUMNS} FROM messages m WHERE {like}{room_filter} ORDER BY m.sent_us DESC LIMIT ?"
+            rows = self._reader.execute(sql, tuple(f"%{word}%" for word in words) + room_args + (limit,)).fetchall()
+        return self._rows_to_messages(rows)
+
+    def close(self):
+        """Writes everything still queued and closes the database."""
+        self._queue.put(None)
+        self._writer.join()
+        self._reader.close()
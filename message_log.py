@@ -0,0 +1,319 @@
+import asyncio
+import collections
+import hashlib
+import mmap
+import os
+import struct
+from message_packet import json_dumpb, json_loads
+
+SEGMENT_RECORDS = 65536 # Records per segment before a new segment is started
+FSYNC_INTERVAL_SECONDS = 1.0 # How often appended records are made durable
+MAX_OPEN_LOGS = 256 # Room logs a MessageStore keeps open; each holds two descriptors and a mapping per segment
+
+RECORD_HEADER = struct.Struct(">I") # Length prefix in front of every record in a .log file
+INDEX_ENTRY = struct.Struct("<Q") # End offset of a record in its .log file, one per record in the .idx file
+
+
+class LogSegment:
+    """
+    One segment of a message log: a .log file of length-prefixed JSON records
+    and a fixed-size .idx file mapped into memory.
+
+    Entry i of the index holds the end offset of record i, so any record is
+    located with two index lookups and read with one seek, without scanning
+    the segment. The index file is preallocated for SEGMENT_RECORDS entries;
+    unused entries are zero, which also tells how many records the segment
+    holds after a restart.
+    """
+
+    def __init__(self, directory, base_seq, max_records=SEGMENT_RECORDS):
+        """
+        Args:
+            directory (str): Directory holding the segment files.
+            base_seq (int): Sequence number of the segment's first record.
+            max_records (int, optional): Capacity of the segment. Defaults to SEGMENT_RECORDS.
+        """
+        self.base_seq = base_seq
+        self.max_records = max_records
+        self.log_path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_seq:020d}.idx")
+
+        index_size = max_records * INDEX_ENTRY.size
+        with open(self.index_path, "ab") as index_file:
+            if index_file.tell() < index_size:
+                index_file.truncate(index_size)
+        with open(self.index_path, "r+b") as index_file: # The mapping keeps its own descriptor
+            self.index = mmap.mmap(index_file.fileno(), index_size)
+        self._log = open(self.log_path, "a+b")
+        self.count = self._recover()
+
+    def _entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)[0]
+
+    def _recover(self):
+        """Counts the records of an existing segment, dropping index entries whose data never reached the disk."""
+        low, high = 0, self.max_records
+        while low < high: # Entries are increasing and zero after the last record
+            middle = (low + high) // 2
+            if self._entry(middle):
+                low = middle + 1
+            else:
+                high = middle
+        count = low
+
+        log_size = os.fstat(self._log.fileno()).st_size
+        while count and self._entry(count - 1) > log_size:
+            count -= 1
+            INDEX_ENTRY.pack_into(self.index, count * INDEX_ENTRY.size, 0)
+        end = self._entry(count - 1) if count else 0
+        if log_size > end:
+            self._log.truncate(end) # Partial record from an interrupted write
+        return count
+
+    def is_full(self):
+        return self.count >= self.max_records
+
+    def append(self, payload):
+        """Appends an encoded record. Returns its sequence number."""
+        self._log.seek(0, os.SEEK_END)
+        self._log.write(RECORD_HEADER.pack(len(payload)))
+        self._log.write(payload)
+        INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, self._log.tell())
+        self.count += 1
+        return self.base_seq + self.count - 1
+
+    def read(self, seq):
+        """Returns the encoded record with the given sequence number."""
+        position = seq - self.base_seq
+        start = self._entry(position - 1) if position else 0
+        end = self._entry(position)
+        self._log.flush() # Make buffered appends visible to the read below
+        self._log.seek(start + RECORD_HEADER.size)
+        return self._log.read(end - start - RECORD_HEADER.size)
+
+    def flush(self):
+        """Pushes buffered appends to the operating system."""
+        self._log.flush()
+
+    def fsync(self):
+        """Makes flushed appends durable. Safe to call from a worker thread."""
+        os.fsync(self._log.fileno())
+        self.index.flush()
+
+    def close(self):
+        self._log.close()
+        self.index.close()
+
+
+class MessageLog:
+    """
+    A durable, segmented, append-only log of messages with dense sequence numbers.
+
+    Appends go to the newest segment; when it fills up a new one is started.
+    Reading the last N messages or a range of sequence numbers only touches the
+    index entries and records involved.
+    """
+
+    def __init__(self, directory, segment_records=SEGMENT_RECORDS):
+        """
+        Args:
+            directory (str): Directory holding this log's segments. Created if missing.
+            segment_records (int, optional): Records per segment. Defaults to SEGMENT_RECORDS.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_records = segment_records
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".idx"))
+        self.segments = [LogSegment(directory, base, segment_records) for base in bases]
+        if not self.segments:
+            self.segments.append(LogSegment(directory, 0, segment_records))
+        self.dirty = False # Appended to since the last sync
+        self._sealed_unsynced = [] # Segments filled up since the last sync
+
+    @property
+    def next_seq(self):
+        """Sequence number the next appended message will get."""
+        active = self.segments[-1]
+        return active.base_seq + active.count
+
+    @property
+    def first_seq(self):
+        """Sequence number of the oldest message in the log."""
+        return self.segments[0].base_seq
+
+    def append(self, message):
+        """Appends a message. Returns its sequence number."""
+        if self.segments[-1].is_full():
+            self.segments[-1].flush()
+            self._sealed_unsynced.append(self.segments[-1])
+            self.segments.append(LogSegment(self.directory, self.next_seq, self.segment_records))
+        self.dirty = True
+        return self.segments[-1].append(json_dumpb(message))
+
+    def _segment_for(self, seq):
+        low, high = 0, len(self.segments) - 1
+        while low < high: # Last segment whose base is <= seq
+            middle = (low + high + 1) // 2
+            if self.segments[middle].base_seq <= seq:
+                low = middle
+            else:
+                high = middle - 1
+        return self.segments[low]
+
+    def read_range(self, first_seq, end_seq):
+        """
+        Returns the messages with sequence numbers in [first_seq, end_seq), oldest first.
+        """
+        first_seq = max(first_seq, self.first_seq)
+        end_seq = min(end_seq, self.next_seq)
+        messages = []
+        for seq in range(first_seq, end_seq):
+            messages.append(json_loads(self._segment_for(seq).read(seq)))
+        return messages
+
+    def tail(self, count):
+        """Returns the last count messages, oldest first."""
+        return self.read_range(self.next_seq - count, self.next_seq)
+
+    def flush(self):
+        """Pushes buffered appends to the operating system. Returns the segments that need an fsync."""
+        self.dirty = False
+        self.segments[-1].flush()
+        segments = self._sealed_unsynced + [self.segments[-1]]
+        self._sealed_unsynced = []
+        return segments
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class MessageStore:
+    """
+    Keeps one MessageLog per room under a root directory and makes appends
+    durable in batches.
+
+    append() only buffers the record, so the live broadcast path never waits
+    on the disk. A background task flushes dirty logs every fsync_interval
+    seconds and runs the fsync calls in the default executor.
+
+    A room's log is only created by its first append; reading a room that
+    was never written to opens nothing. At most max_open_logs logs are kept
+    open, least recently used first out, and release() gives up the log of a
+    room nobody is in. Either way the log is flushed at once, so reopening it
+    sees every record, and it is closed by the next sync, after its fsync.
+    """
+
+    def __init__(self, root, fsync_interval=FSYNC_INTERVAL_SECONDS, segment_records=SEGMENT_RECORDS, max_open_logs=MAX_OPEN_LOGS):
+        """
+        Args:
+            root (str): Directory holding a subdirectory per room.
+            fsync_interval (float, optional): Seconds between durability syncs. Defaults to FSYNC_INTERVAL_SECONDS.
+            segment_records (int, optional): Records per segment. Defaults to SEGMENT_RECORDS.
+            max_open_logs (int, optional): Logs kept open at once. Defaults to MAX_OPEN_LOGS.
+        """
+        self.root = root
+        self.fsync_interval = fsync_interval
+        self.segment_records = segment_records
+        self.max_open_logs = max_open_logs
+        self.logs = collections.OrderedDict() # room name -> open MessageLog, least recently used first
+        self._closing = [] # (log, segments needing an fsync) of logs given up since the last sync
+
+    def _directory(self, room_name):
+        return os.path.join(self.root, hashlib.sha256(room_name.encode("utf-8")).hexdigest()) # Room names are arbitrary text
+
+    def log_for(self, room_name, create=True):
+        """
+        Returns the log of a room, opening it if needed.
+
+        Args:
+            room_name (str): The room.
+            create (bool, optional): Whether to create a log that does not exist yet. Defaults to True.
+
+        Returns:
+            MessageLog: The log, or None if it does not exist and create is False.
+        """
+        log = self.logs.get(room_name)
+        if log is not None:
+            self.logs.move_to_end(room_name)
+            return log
+        directory = self._directory(room_name)
+        if not create and not os.path.isdir(directory):
+            return None
+        log = self.logs[room_name] = MessageLog(directory, self.segment_records)
+        while len(self.logs) > self.max_open_logs:
+            self._give_up(self.logs.popitem(last=False)[1])
+        return log
+
+    def _give_up(self, log):
+        self._closing.append((log, log.flush())) # Flushed now, fsynced and closed by the next sync
+
+    def release(self, room_name):
+        """Gives up the log of a room, e.g. when nobody is in the room any more. It is reopened when needed."""
+        log = self.logs.pop(room_name, None)
+        if log is not None:
+            self._give_up(log)
+
+    def stored_rooms(self):
+        """
+        Returns the names of the rooms with stored messages, e.g. to index
+        them after a restart. Room directories are named by hash, so each
+        room's name is read from its newest message; logs are not kept open.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        open_directories = {log.directory: room_name for room_name, log in self.logs.items()}
+        room_names = []
+        for name in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, name)
+            if directory in open_directories:
+                room_names.append(open_directories[directory])
+            elif os.path.isdir(directory):
+                log = MessageLog(directory, self.segment_records)
+                newest = log.tail(1)
+                log.close()
+                if newest and newest[0].get("room") is not None:
+                    room_names.append(newest[0]["room"])
+        return room_names
+
+    def append(self, room_name, message):
+        """Appends a message to a room's log. Returns its sequence number."""
+        return self.log_for(room_name).append(message)
+
+    def recent(self, room_name, count):
+        """Returns up to count of the most recent messages of a room, oldest first."""
+        log = self.log_for(room_name, create=False)
+        return log.tail(count) if log is not None else []
+
+    async def sync(self):
+        """Flushes every dirty log and fsyncs it without blocking the event loop, then closes the logs given up."""
+        segments = []
+        for log in self.logs.values():
+            if log.dirty:
+                segments.extend(log.flush())
+        closing, self._closing = self._closing, []
+        for log, flushed in closing:
+            segments.extend(flushed)
+        if segments or closing:
+            await asyncio.get_running_loop().run_in_executor(None, self._fsync_and_close, segments, [log for log, _ in closing])
+
+    @staticmethod
+    def _fsync_and_close(segments, logs):
+        for segment in segments:
+            segment.fsync()
+        for log in logs:
+            log.close()
+
+    async def run(self):
+        """Syncs periodically until cancelled."""
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            await self.sync()
+
+    def close(self):
+        """Syncs and closes every log. Blocks, so only use it on shutdown."""
+        for log in self.logs.values():
+            self._give_up(log)
+        self.logs.clear()
+        closing, self._closing = self._closing, []
+        self._fsync_and_close([segment for _, flushed in closing for segment in flushed], [log for log, _ in closing])
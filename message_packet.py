@@ -1,5 +1,15 @@
+import collections
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
 class MessagePacket():
     def __init__(self, typecode, text="", connected_clients=[]):
         self.typecode = typecode # string that controls they type of message t: text u: userlist n: new
@@ -29,4 +39,449 @@ class MessagePacket():
             if char == 'u':
                 self.userlist = uin[index]
                 index += 1
-    
\ No newline at end of file
+    
+
+# --- JSON backend ---
+#
+# Everything that reads or writes JSON (frames, bus envelopes, the message
+# log) goes through json_dumps/json_dumpb/json_loads, which use the fastest
+# library installed: orjson, then msgspec, then the standard library. The
+# output of all three is plain JSON, so peers using different backends
+# interoperate.
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+
+    def json_dumpb(obj):
+        """Encodes obj as UTF-8 JSON bytes."""
+        return orjson.dumps(obj)
+
+    def json_loads(data):
+        """Decodes JSON from str or bytes. Raises ValueError if it is malformed."""
+        return orjson.loads(data) # orjson.JSONDecodeError is a ValueError
+
+elif msgspec is not None:
+    JSON_BACKEND = "msgspec"
+    _msgspec_encoder = msgspec.json.Encoder()
+    _msgspec_decoder = msgspec.json.Decoder()
+
+    def json_dumpb(obj):
+        """Encodes obj as UTF-8 JSON bytes."""
+        return _msgspec_encoder.encode(obj)
+
+    def json_loads(data):
+        """Decodes JSON from str or bytes. Raises ValueError if it is malformed."""
+        try:
+            return _msgspec_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+else:
+    JSON_BACKEND = "json"
+
+    def json_dumpb(obj):
+        """Encodes obj as UTF-8 JSON bytes."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def json_loads(data):
+        """Decodes JSON from str or bytes. Raises ValueError if it is malformed."""
+        return json.loads(data)
+
+def json_dumps(obj):
+    """Encodes obj as a JSON str, e.g. for a WebSocket text frame."""
+    return json_dumpb(obj).decode("utf-8")
+
+
+# --- Binary wire protocol ---
+#
+# Every binary frame starts with a one-byte type tag followed by a varint
+# bitmap of the fields that are present, then those fields in schema order:
+#
+#   string  varint byte length + UTF-8 bytes
+#   color   3 raw bytes (a client's color is already its unique 24-bit id)
+#   colors  varint count + 3 bytes per color
+#   uint    varint (7 bits per byte, least significant group first)
+#   bool    one byte, 0 or 1
+#   frames  varint count + (varint length + binary frame) per nested message
+#
+# Messages whose type or fields are not in FRAME_SCHEMAS are sent with the
+# JSON tag, so anything the JSON protocol can carry still gets through.
+
+JSON_SUBPROTOCOL = "chat.json.v1"
+BINARY_SUBPROTOCOL = "chat.binary.v1"
+SUBPROTOCOLS = [BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL] # Offered by clients in order of preference; the server picks by its own (chat_server.PROTOCOL_PREFERENCES)
+
+JSON_TAG = 0 # The rest of the frame is a UTF-8 JSON object
+
+STRING, COLOR, COLORS, UINT, BOOL, FRAMES, CLIENTS = range(7)
+
+# type -> (tag, ((field, kind), ...)); tags and field order are part of the protocol, only append
+FRAME_SCHEMAS = {
+    "color_assignment": (1, (("color", COLOR), ("resume_token", STRING), ("resumed", BOOL))),
+    "client_list": (2, (("room", STRING), ("clients", CLIENTS), ("seq", UINT))),
+    "presence": (3, (("room", STRING), ("joined", COLORS), ("left", COLORS), ("seq", UINT))),
+    "message": (4, (("id", STRING), ("room", STRING), ("sender_color", COLOR), ("message", STRING), ("seq", UINT),
+                    ("client_sent_us", UINT), ("server_received_us", UINT), ("server_sent_us", UINT), ("client_id", STRING))),
+    "history": (5, (("room", STRING), ("messages", FRAMES))),
+    "direct_message": (6, (("id", STRING), ("sender_color", COLOR), ("message", STRING), ("recipient_color", COLOR), ("seq", UINT),
+                           ("client_sent_us", UINT), ("server_received_us", UINT), ("server_sent_us", UINT), ("client_id", STRING))),
+    "typing_start": (7, (("room", STRING), ("sender_color", COLOR))),
+    "typing_stop": (8, (("room", STRING), ("sender_color", COLOR))),
+    "room_left": (9, (("room", STRING),)),
+    "error": (10, (("message", STRING), ("retry_after_ms", UINT))),
+    "join_room": (11, (("room", STRING), ("history_since_us", UINT))),
+    "leave_room": (12, (("room", STRING),)),
+    "ack": (13, (("id", STRING), ("client_sent_us", UINT), ("server_received_us", UINT), ("server_sent_us", UINT), ("client_id", STRING))),
+    "search": (14, (("room", STRING), ("query", STRING), ("cursor", STRING), ("limit", UINT), ("request_id", STRING))),
+    "search_results": (15, (("room", STRING), ("query", STRING), ("messages", FRAMES), ("cursor", STRING), ("request_id", STRING))),
+    "ping": (16, ()),
+    "pong": (17, ()),
+}
+SCHEMAS_BY_TAG = {tag: (message_type, fields) for message_type, (tag, fields) in FRAME_SCHEMAS.items()}
+FIELD_NAMES = {message_type: {"type"} | {name for name, _ in fields} for message_type, (_, fields) in FRAME_SCHEMAS.items()}
+
+
+def _write_uint(out, value):
+    if 0 <= value < 0x80: # Most counts, lengths and flags fit in one byte
+        out.append(value)
+        return
+    if value < 0:
+        raise ValueError("Negative integers cannot be encoded.")
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_uint(data, position):
+    byte = data[position]
+    if byte < 0x80:
+        return byte, position + 1
+    value = byte & 0x7F
+    shift = 7
+    position += 1
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def _write_string(out, text):
+    body = text.encode("utf-8")
+    _write_uint(out, len(body))
+    out += body
+
+def _read_string(data, position):
+    length, position = _read_uint(data, position)
+    end = position + length
+    if end > len(data):
+        raise ValueError("Truncated string field.")
+    return data[position:end].decode("utf-8"), end
+
+def _write_color(out, color):
+    if len(color) != 7 or color[0] != "#":
+        raise ValueError(f"Not a #rrggbb color: {color!r}")
+    out += bytes.fromhex(color[1:])
+
+def _read_color(data, position):
+    end = position + 3
+    if end > len(data):
+        raise ValueError("Truncated color field.")
+    return "#" + data[position:end].hex(), end
+
+def _write_bool(out, value):
+    out.append(1 if value else 0)
+
+def _read_bool(data, position):
+    return data[position] != 0, position + 1
+
+def _write_colors(out, colors):
+    for color in colors:
+        if len(color) != 7 or color[0] != "#":
+            raise ValueError(f"Not a #rrggbb color: {color!r}")
+    _write_uint(out, len(colors))
+    out += bytes.fromhex("".join(color[1:] for color in colors)) # One conversion for the whole list
+
+def _read_colors(data, position):
+    count, position = _read_uint(data, position)
+    end = position + 3 * count
+    if end > len(data):
+        raise ValueError("Truncated color list.")
+    digits = data[position:end].hex()
+    return ["#" + digits[i:i + 6] for i in range(0, len(digits), 6)], end
+
+def _write_clients(out, clients):
+    _write_colors(out, [client["color"] for client in clients])
+
+def _read_clients(data, position):
+    colors, position = _read_colors(data, position)
+    return [{"color": color} for color in colors], position
+
+def _write_frames(out, messages):
+    _write_uint(out, len(messages))
+    for message in messages:
+        frame = encode_binary(message)
+        _write_uint(out, len(frame))
+        out += frame
+
+def _read_frames(data, position):
+    count, position = _read_uint(data, position)
+    messages = []
+    for _ in range(count):
+        length, position = _read_uint(data, position)
+        messages.append(decode_binary(data[position:position + length]))
+        position += length
+    return messages, position
+
+FIELD_WRITERS = {STRING: _write_string, COLOR: _write_color, COLORS: _write_colors, UINT: _write_uint, BOOL: _write_bool, FRAMES: _write_frames, CLIENTS: _write_clients}
+FIELD_READERS = {STRING: _read_string, COLOR: _read_color, COLORS: _read_colors, UINT: _read_uint, BOOL: _read_bool, FRAMES: _read_frames, CLIENTS: _read_clients}
+
+# Each schema with its field codecs looked up once, so encoding and decoding a field is a single call
+ENCODERS = {message_type: (tag, tuple((name, FIELD_WRITERS[kind]) for name, kind in fields), FIELD_NAMES[message_type])
+            for message_type, (tag, fields) in FRAME_SCHEMAS.items()}
+DECODERS = {tag: (message_type, tuple((name, FIELD_READERS[kind]) for name, kind in fields)) for tag, (message_type, fields) in SCHEMAS_BY_TAG.items()}
+
+def _encode_json_frame(message):
+    return bytes([JSON_TAG]) + json_dumpb(message)
+
+def encode_binary(message):
+    """
+    Encodes a message dictionary as a binary frame.
+
+    Args:
+        message (dict): The message payload, with a "type" field.
+
+    Returns:
+        bytes: The encoded frame. Messages the schemas do not cover are wrapped as JSON.
+    """
+    encoder = ENCODERS.get(message.get("type"))
+    if encoder is None:
+        return _encode_json_frame(message)
+    tag, writers, names = encoder
+    if not names.issuperset(message):
+        return _encode_json_frame(message)
+    present = 0
+    bit = 1
+    body = bytearray()
+    try:
+        for name, write in writers:
+            value = message.get(name)
+            if value is not None:
+                present |= bit
+                write(body, value)
+            bit <<= 1
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return _encode_json_frame(message) # e.g. a color that is not #rrggbb
+    out = bytearray((tag,))
+    _write_uint(out, present)
+    out += body
+    return bytes(out)
+
+def decode_binary(data):
+    """
+    Decodes a binary frame produced by encode_binary.
+
+    Raises:
+        ValueError: If the frame is malformed.
+    """
+    if not data:
+        raise ValueError("Empty binary frame.")
+    if data[0] == JSON_TAG:
+        return json_loads(bytes(data[1:]))
+    decoder = DECODERS.get(data[0])
+    if decoder is None:
+        raise ValueError(f"Unknown frame tag: {data[0]}")
+    message_type, readers = decoder
+    message = {"type": message_type}
+    try:
+        present, position = _read_uint(data, 1)
+        for name, read in readers:
+            if present & 1:
+                message[name], position = read(data, position)
+            present >>= 1
+    except IndexError:
+        raise ValueError("Truncated binary frame.")
+    if position != len(data):
+        raise ValueError("Trailing bytes after binary frame.")
+    return message
+
+
+class JsonCodec:
+    """The original protocol: one JSON text frame per message."""
+
+    subprotocol = JSON_SUBPROTOCOL
+
+    def encode(self, message):
+        return json_dumps(message)
+
+    def decode(self, frame):
+        return json_loads(frame)
+
+
+class BinaryCodec:
+    """The compact protocol: one binary frame per message, see encode_binary."""
+
+    subprotocol = BINARY_SUBPROTOCOL
+
+    def encode(self, message):
+        return encode_binary(message)
+
+    def decode(self, frame):
+        return decode_binary(frame)
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS = {JSON_SUBPROTOCOL: JSON_CODEC, BINARY_SUBPROTOCOL: BINARY_CODEC}
+
+def codec_for(subprotocol):
+    """Returns the codec of a negotiated subprotocol. Peers that negotiated nothing speak JSON."""
+    return CODECS.get(subprotocol, JSON_CODEC)
+
+def decode_frame(frame):
+    """Decodes a received frame of either protocol: binary frames arrive as bytes, JSON ones as text."""
+    if isinstance(frame, (bytes, bytearray)):
+        return decode_binary(frame)
+    return json_loads(frame)
+
+
+class EncodedMessage:
+    """
+    A message and its encoded frames, produced lazily and at most once per codec.
+
+    Keep one of these instead of the bare dictionary for anything that may be
+    sent more than once (broadcast fan-out, replay buffers, cached history).
+    """
+
+    __slots__ = ("message", "_frames")
+
+    def __init__(self, message):
+        self.message = message
+        self._frames = {} # codec -> encoded frame
+
+    def frame(self, codec):
+        """Returns the message encoded with codec."""
+        frame = self._frames.get(codec)
+        if frame is None:
+            frame = self._frames[codec] = codec.encode(self.message)
+        return frame
+
+
+class EncodeCache:
+    """A small LRU cache of EncodedMessage objects for payloads that are re-sent often."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict() # key -> EncodedMessage
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """
+        Returns the cached EncodedMessage for key, calling build() for the message on a miss.
+
+        The key must change whenever the message would, e.g. by including a version or sequence number.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self._entries[key] = EncodedMessage(build())
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+
+# --- Typed messages ---
+#
+# Received frames are decoded into immutable message objects, so dispatch
+# code reads attributes (message.room) instead of chains of data.get(...)
+# with defaults. Each class has the protocol's "type" string as its type
+# attribute; fields that may be missing from a frame have defaults.
+
+DEFAULT_ROOM = "lobby" # Room every client joins on connect; frames without a "room" field refer to it
+MAX_MESSAGE_LENGTH = 4000 # Characters of chat or direct message text the server relays; clients refuse longer text before queueing it
+
+MESSAGE_CLASSES = {} # type string -> message class
+# Fields used as dictionary keys or relayed as text, whatever the message type; message_from_dict refuses other types,
+# so a frame with e.g. a list for its room is rejected as malformed instead of failing wherever the field is used
+FIELD_TYPES = {"room": str, "recipient_color": str, "message": str, "query": str, "client_id": str, "request_id": (str, int)}
+
+def _message_class(class_name, message_type, required=(), optional=None):
+    optional = optional or {}
+    base = collections.namedtuple(class_name, tuple(required) + tuple(optional), defaults=tuple(optional.values()))
+    message_class = type(class_name, (base,), {"__slots__": (), "type": message_type})
+    MESSAGE_CLASSES[message_type] = message_class
+    return message_class
+
+ColorAssignment = _message_class("ColorAssignment", "color_assignment", ("color",), {"resume_token": None, "resumed": False})
+ClientList = _message_class("ClientList", "client_list", (), {"room": DEFAULT_ROOM, "clients": (), "seq": 0})
+Presence = _message_class("Presence", "presence", (), {"room": DEFAULT_ROOM, "joined": (), "left": (), "seq": None})
+# Latency stamps are wall-clock microseconds: client_sent_us is set by a sending client that wants an ack,
+# server_received_us and server_sent_us by the server when it receives and fans out the message.
+# client_id is a sender-chosen id the server echoes in its ack (and uses to ignore resends), never relayed.
+LATENCY_STAMPS = {"client_sent_us": None, "server_received_us": None, "server_sent_us": None, "client_id": None}
+
+ChatMessage = _message_class("ChatMessage", "message", ("message",), {"room": DEFAULT_ROOM, "id": None, "sender_color": None, "seq": None, **LATENCY_STAMPS})
+History = _message_class("History", "history", (), {"room": DEFAULT_ROOM, "messages": ()})
+DirectMessage = _message_class("DirectMessage", "direct_message", ("message", "recipient_color"), {"id": None, "sender_color": None, "seq": None, **LATENCY_STAMPS})
+TypingStart = _message_class("TypingStart", "typing_start", (), {"room": DEFAULT_ROOM, "sender_color": None})
+TypingStop = _message_class("TypingStop", "typing_stop", (), {"room": DEFAULT_ROOM, "sender_color": None})
+RoomLeft = _message_class("RoomLeft", "room_left", ("room",))
+Error = _message_class("Error", "error", (), {"message": "Unknown error", "retry_after_ms": None}) # retry_after_ms: set when a frame was refused for exceeding a rate limit
+JoinRoom = _message_class("JoinRoom", "join_room", (), {"room": DEFAULT_ROOM, "history_since_us": None}) # history_since_us: see send_room_snapshot
+LeaveRoom = _message_class("LeaveRoom", "leave_room", (), {"room": DEFAULT_ROOM})
+Ack = _message_class("Ack", "ack", (), {"client_id": None, "id": None, "client_sent_us": None, "server_received_us": None, "server_sent_us": None})
+# A search continues where the previous page ended when it passes back that page's cursor; the last page has none.
+# request_id is chosen by the client and echoed, so it can match results to its requests.
+Search = _message_class("Search", "search", ("query",), {"room": DEFAULT_ROOM, "cursor": None, "limit": None, "request_id": None})
+SearchResults = _message_class("SearchResults", "search_results", (), {"room": DEFAULT_ROOM, "query": "", "messages": (), "cursor": None, "request_id": None})
+# Heartbeat: the server pings connections that have been silent for a while and drops those that do not answer.
+# Clients may ping the server the same way.
+Ping = _message_class("Ping", "ping")
+Pong = _message_class("Pong", "pong")
+
+
+class UnknownMessage(collections.namedtuple("UnknownMessage", ("type", "data"))):
+    """A message of a type this version does not know; data holds the decoded dictionary."""
+
+    __slots__ = ()
+
+
+def message_from_dict(data):
+    """
+    Converts a decoded message dictionary into its typed message object.
+
+    Fields the class does not know are ignored and null fields take their
+    defaults.
+
+    Raises:
+        ValueError: If the message is not an object, has no string type, lacks a required field or has a field of the wrong type (see FIELD_TYPES).
+    """
+    if not isinstance(data, dict):
+        raise ValueError("A message must be an object.")
+    message_type = data.get("type")
+    if not isinstance(message_type, str): # Also keeps unhashable values away from the class lookup
+        raise ValueError(f"A message type must be a string, not {message_type!r}.")
+    message_class = MESSAGE_CLASSES.get(message_type)
+    if message_class is None:
+        return UnknownMessage(message_type, data)
+    fields = {name: data[name] for name in message_class._fields if data.get(name) is not None}
+    for name, value in fields.items():
+        expected = FIELD_TYPES.get(name)
+        if expected is not None and not isinstance(value, expected):
+            raise ValueError(f"Malformed {message_class.type} message: {name} has the wrong type.")
+    try:
+        return message_class(**fields)
+    except TypeError:
+        raise ValueError(f"Malformed {message_class.type} message: {data!r}")
+
+def decode_message(frame):
+    """Decodes a received frame of either protocol into a typed message object."""
+    return message_from_dict(decode_frame(frame))
@@ -0,0 +1,203 @@
+import asyncio
+import collections
+import websockets
+
+PRIORITY_CHAT = 0 # Chat messages, direct messages and other frames users are waiting for
+PRIORITY_PRESENCE = 1 # Client list snapshots and presence deltas
+PRIORITY_TYPING = 2 # Typing indicators; ephemeral, may be dropped under pressure
+PRIORITY_CLASSES = (PRIORITY_CHAT, PRIORITY_PRESENCE, PRIORITY_TYPING)
+
+DROP_OLDEST = "drop_oldest" # Make room by discarding the oldest frame of the lowest priority class
+DROP_EPHEMERAL = "drop_ephemeral" # Discard typing frames; disconnect if only chat and presence are left
+DISCONNECT = "disconnect" # Close the connection of a client that cannot keep up
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_EPHEMERAL, DISCONNECT)
+
+SLOW_CONSUMER_CLOSE_CODE = 1008 # Policy violation
+
+
+class OutboundStats:
+    """Counters shared by all outbound queues."""
+
+    def __init__(self):
+        self.dropped_frames = 0 # Frames discarded because a queue was full
+        self.superseded_frames = 0 # Queued frames replaced by a newer frame with the same key
+        self.evicted_clients = 0 # Connections closed because a queue was full
+        self.sent_frames = 0 # Frames written to client sockets
+        self.sent_bytes = 0 # Payload bytes of those frames
+
+
+class OutboundQueue:
+    """
+    A bounded queue of outbound frames drained by a writer task.
+
+    Producers call put(), which never blocks, so a broadcast or direct message
+    never waits on the recipient's socket. The writer task is the only thing
+    that awaits the connection, so a slow client only ever delays itself. When
+    the queue is full the overflow policy decides what gives.
+
+    Frames are kept in one FIFO per priority class and the writer always sends
+    from the most important non-empty class, so chat is never stuck behind
+    typing or presence traffic. A frame queued with a key replaces a still
+    unsent frame with the same key in place (e.g. a typing_stop superseding the
+    same sender's typing_start).
+
+    Every connection has one of these, so an idle one is kept small: the
+    FIFOs and the key index are created on first use and dropped again
+    whenever the queue drains, and the writer task is started by the first
+    put(). From then on it lives as long as the connection and parks on a
+    bare future while the queue is empty, so sending never creates a task.
+    """
+
+    __slots__ = ("websocket", "maxsize", "policy", "stats", "classes", "keyed", "size", "evicted", "closed", "_writer", "_wakeup")
+
+    def __init__(self, websocket, maxsize, policy=DROP_EPHEMERAL, stats=None):
+        """
+        Args:
+            websocket (WebSocketServerProtocol): The connection to write to.
+            maxsize (int): Maximum number of frames waiting to be written.
+            policy (str, optional): One of OVERFLOW_POLICIES. Defaults to DROP_EPHEMERAL.
+            stats (OutboundStats, optional): Counters to update on drops and evictions.
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.policy = policy
+        self.stats = stats if stats is not None else OutboundStats()
+        self.classes = [None] * len(PRIORITY_CLASSES) # One FIFO of [frame, key] entries per class, from its first frame on
+        self.keyed = None # key -> still queued [frame, key] entry, from the first keyed frame on
+        self.size = 0
+        self.evicted = False
+        self.closed = False # The connection is gone or close() was called
+        self._writer = None # Writer task, from the first frame on
+        self._wakeup = None # Future the writer waits on while the queue is empty
+
+    def put(self, frame, priority=PRIORITY_CHAT, key=None):
+        """
+        Queues a frame for sending without waiting.
+
+        Args:
+            frame (str or bytes): The encoded frame, text for JSON and bytes for binary.
+            priority (int, optional): One of PRIORITY_CLASSES. Defaults to PRIORITY_CHAT.
+            key (hashable, optional): Frames with the same key supersede each other while queued.
+
+        Returns:
+            bool: True if the frame was queued.
+        """
+        if self.evicted or self.closed:
+            return False
+        if key is not None and self.keyed is not None:
+            entry = self.keyed.get(key)
+            if entry is not None:
+                entry[0] = frame # Collapse into the queued frame, which keeps its place
+                self.stats.superseded_frames += 1
+                return True
+        if self.size >= self.maxsize and not self._make_room(priority):
+            return False
+        entry = [frame, key]
+        frames = self.classes[priority]
+        if frames is None:
+            frames = self.classes[priority] = collections.deque()
+        frames.append(entry)
+        if key is not None:
+            if self.keyed is None:
+                self.keyed = {}
+            self.keyed[key] = entry
+        self.size += 1
+        self._wake_writer()
+        return True
+
+    def _wake_writer(self):
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._run())
+        elif self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _pop(self, priority):
+        """Removes and returns the frame at the front of a priority class."""
+        frame, key = self.classes[priority].popleft()
+        if key is not None:
+            del self.keyed[key]
+        self.size -= 1
+        return frame
+
+    def _make_room(self, priority):
+        """Applies the overflow policy to a full queue. Returns True if a frame of the given priority can be appended."""
+        if self.policy == DROP_OLDEST:
+            victim = max(p for p in PRIORITY_CLASSES if self.classes[p]) # Least important non-empty class
+            if victim < priority:
+                self.stats.dropped_frames += 1 # The new frame is the least important one
+                return False
+            self._pop(victim)
+            self.stats.dropped_frames += 1
+            return True
+
+        if self.policy == DROP_EPHEMERAL:
+            if self.classes[PRIORITY_TYPING]:
+                self._pop(PRIORITY_TYPING)
+                self.stats.dropped_frames += 1
+                return True
+            if priority == PRIORITY_TYPING:
+                self.stats.dropped_frames += 1 # Nothing cheaper to drop than the new frame itself
+                return False
+
+        self.evict()
+        return False
+
+    def evict(self):
+        """Discards everything queued and has the writer close the connection."""
+        if self.evicted or self.closed:
+            return
+        self.evicted = True
+        self.stats.dropped_frames += self.size
+        self.stats.evicted_clients += 1
+        self._clear()
+        self._wake_writer()
+
+    def _clear(self):
+        for frames in self.classes:
+            if frames is not None:
+                frames.clear()
+        if self.keyed is not None:
+            self.keyed.clear()
+        self.size = 0
+
+    def _release_buffers(self):
+        """Drops the FIFOs and the key index of an empty queue, so an idle connection holds no containers."""
+        for priority in PRIORITY_CLASSES:
+            self.classes[priority] = None
+        self.keyed = None
+
+    async def _run(self):
+        """Writer task: sends queued frames in priority order until the connection closes."""
+        try:
+            while True:
+                if self.evicted:
+                    await self.websocket.close(SLOW_CONSUMER_CLOSE_CODE, "Slow consumer")
+                    return
+                if not self.size:
+                    self._release_buffers()
+                    self._wakeup = asyncio.get_running_loop().create_future()
+                    await self._wakeup # Set by the next put() or evict()
+                    self._wakeup = None
+                    continue
+                priority = next(p for p in PRIORITY_CLASSES if self.classes[p]) # Most important non-empty class
+                frame = self._pop(priority)
+                await self.websocket.send(frame)
+                self.stats.sent_frames += 1
+                self.stats.sent_bytes += len(frame) if isinstance(frame, bytes) else len(frame.encode("utf-8"))
+        except websockets.exceptions.ConnectionClosed:
+            self.closed = True # The reader side notices the closed connection and cleans up
+            self._clear()
+        finally:
+            self._wakeup = None
+
+    def close(self):
+        """Stops the writer task and discards anything still queued."""
+        self.closed = True
+        self._clear()
+        if self._writer is not None:
+            self._writer.cancel()
+
+    def __len__(self):
+        return self.size
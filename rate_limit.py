@@ -0,0 +1,150 @@
+import time
+
+# Per-connection limits as (sustained frames per second, burst) by message type; unlisted types are only
+# covered by the overall frame limit. Typing indicators are sent about every 3 seconds while typing.
+MESSAGE_RATE_LIMITS = {
+    "message": (5.0, 20),
+    "direct_message": (5.0, 20),
+    "typing_start": (4.0, 10),
+    "typing_stop": (4.0, 10),
+    "join_room": (2.0, 10),
+    "leave_room": (2.0, 10),
+    "search": (1.0, 5),
+    "ping": (1.0, 5),
+}
+FRAME_RATE = 50.0 # Frames per second a connection may send in total, whatever their type
+FRAME_BURST = 200
+HANDSHAKE_RATE = 200.0 # New connections accepted per second by one worker
+HANDSHAKE_BURST = 500
+# Open connections one worker accepts. Each needs a file descriptor (the server raises its limit as far as the
+# hard limit allows) and about 17 KiB of RSS when idle (see README), so the default fits in 1 GiB per worker.
+# Raise it with --max-connections only on a machine with the memory for it.
+MAX_CONNECTIONS = 60000
+SERVER_FULL_RETRY_SECONDS = 5.0 # Retry-After sent to connections refused because the worker is full
+
+
+class TokenBucket:
+    """
+    Allows rate events per second on average and up to burst at once.
+
+    The bucket is refilled lazily from the time elapsed since it was last
+    used, so an idle bucket costs nothing and there are no timers.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, now, cost=1):
+        """
+        Takes cost tokens if there are enough.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds until there will be enough.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class ConnectionLimiter:
+    """
+    The rate limits of one client: an overall frame budget and one budget per message type.
+
+    Buckets (and the dictionaries holding them) are created the first time a
+    type is used, so a client costs a bucket only for the types it actually
+    sends. Refusals are reported at most once per wait, so a flooding client
+    is not answered with a flood of errors.
+    """
+
+    __slots__ = ("limits", "frames", "buckets", "reported_until", "clock")
+
+    def __init__(self, limits=MESSAGE_RATE_LIMITS, frame_rate=FRAME_RATE, frame_burst=FRAME_BURST, clock=time.monotonic):
+        """
+        Args:
+            limits (dict, optional): message type -> (rate, burst). Defaults to MESSAGE_RATE_LIMITS.
+            frame_rate (float, optional): Frames per second over all types. Defaults to FRAME_RATE.
+            frame_burst (int, optional): Frames allowed at once over all types. Defaults to FRAME_BURST.
+            clock (callable, optional): Monotonic clock returning seconds. Defaults to time.monotonic.
+        """
+        self.limits = limits
+        self.clock = clock
+        self.frames = TokenBucket(frame_rate, frame_burst, clock())
+        self.buckets = None # message type -> TokenBucket
+        self.reported_until = None # message type -> time before which refusals are not reported again
+
+    def allow_frame(self):
+        """Whether the client is within its overall frame budget. Checked before a frame is even decoded."""
+        return self.frames.take(self.clock()) == 0.0
+
+    def check(self, message_type):
+        """
+        Takes a token for a message of the given type.
+
+        Returns:
+            float: 0 if the message may be handled, otherwise the seconds the client should wait.
+        """
+        limit = self.limits.get(message_type)
+        if limit is None:
+            return 0.0
+        now = self.clock()
+        if self.buckets is None:
+            self.buckets = {}
+        bucket = self.buckets.get(message_type)
+        if bucket is None:
+            bucket = self.buckets[message_type] = TokenBucket(*limit, now)
+        return bucket.take(now)
+
+    def should_report(self, message_type, retry_after):
+        """Whether a refusal should be reported; True once per wait of retry_after seconds."""
+        now = self.clock()
+        if self.reported_until is None:
+            self.reported_until = {}
+        if now < self.reported_until.get(message_type, 0.0):
+            return False
+        self.reported_until[message_type] = now + retry_after
+        return True
+
+
+class AdmissionControl:
+    """
+    Decides whether a worker accepts a new connection.
+
+    A connection is refused while the worker already has max_connections
+    open, or when handshakes arrive faster than the handshake bucket allows,
+    so a reconnect storm is spread out instead of landing on the event loop
+    at once.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, handshake_rate=HANDSHAKE_RATE, handshake_burst=HANDSHAKE_BURST, clock=time.monotonic):
+        self.max_connections = max_connections
+        self.clock = clock
+        self.handshakes = TokenBucket(handshake_rate, handshake_burst, clock())
+        self.open_connections = 0
+        self.refused = 0
+
+    def admit(self):
+        """
+        Returns:
+            float: 0 if a new connection may be accepted, otherwise the seconds after which to try again.
+        """
+        if self.open_connections >= self.max_connections:
+            self.refused += 1
+            return SERVER_FULL_RETRY_SECONDS
+        retry_after = self.handshakes.take(self.clock())
+        if retry_after:
+            self.refused += 1
+        return retry_after
+
+    def connection_opened(self):
+        self.open_connections += 1
+
+    def connection_closed(self):
+        self.open_connections -= 1
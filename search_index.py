@@ -0,0 +1,163 @@
+import bisect
+import re
+
+SEARCH_BUCKET_SECONDS = 3600 # Width of the time buckets each room's index is partitioned into
+SEARCH_RETAINED_BUCKETS = 24 * 30 # Buckets kept per room; older ones are dropped whole
+SEARCH_PAGE_SIZE = 50 # Results per page unless the request asks for fewer
+MAX_SEARCH_TERMS = 8
+MAX_TERM_LENGTH = 64 # Longer words are not indexed (and never match)
+
+WORD = re.compile(r"\w+")
+
+def tokenize(text):
+    """Returns the distinct lowercase words of a text, in order of first appearance."""
+    return list(dict.fromkeys(word for word in WORD.findall(text.lower()) if len(word) <= MAX_TERM_LENGTH))
+
+
+class IndexPartition:
+    """
+    The messages of one room in one time bucket and their inverted index.
+
+    Documents are only ever appended, so a document's position never changes
+    and every posting list is sorted. That also lets a query running on
+    another thread take len(documents) as a snapshot and ignore anything
+    appended while it runs: appending to a list or adding a key to a dict is
+    atomic under the GIL, so no lock is needed.
+    """
+
+    __slots__ = ("bucket", "documents", "postings")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.documents = [] # (id, sender color, text, server_received_us), in arrival order
+        self.postings = {} # word -> positions of the documents containing it, increasing
+
+    def add(self, document, words):
+        position = len(self.documents)
+        for word in words:
+            positions = self.postings.get(word)
+            if positions is None:
+                self.postings[word] = [position]
+            else:
+                positions.append(position)
+        self.documents.append(document) # Last, so a concurrent query never sees a position without its document
+
+    def matches(self, words, before, end):
+        """
+        Yields the positions below min(before, end) of the documents containing every word, newest first.
+
+        The shortest posting list drives the search; the others are only
+        probed with binary searches, so a rare word keeps the whole query cheap.
+        """
+        lists = []
+        for word in words:
+            positions = self.postings.get(word)
+            if not positions:
+                return
+            lists.append(positions)
+        lists.sort(key=len)
+        limit = min(before, end)
+        shortest = lists[0]
+        for index in range(bisect.bisect_left(shortest, limit) - 1, -1, -1):
+            position = shortest[index]
+            for positions in lists[1:]:
+                found = bisect.bisect_left(positions, position)
+                if found == len(positions) or positions[found] != position:
+                    break
+            else:
+                yield position
+
+
+class SearchIndex:
+    """
+    An incremental inverted index of room messages, partitioned by room and time bucket.
+
+    add() indexes one message as it is relayed; nothing is ever rebuilt or
+    rescanned. A query walks a room's buckets from the newest back and stops
+    as soon as a page is full, so recent matches cost the same however long
+    the history is, and old buckets are dropped whole once a room has more
+    than retained_buckets of them. Queries may run on a worker thread while
+    the event loop keeps adding messages (see IndexPartition).
+
+    Pages are continued with an opaque cursor naming the last result's
+    partition and position, which stays valid while messages keep arriving.
+    """
+
+    def __init__(self, bucket_seconds=SEARCH_BUCKET_SECONDS, retained_buckets=SEARCH_RETAINED_BUCKETS):
+        """
+        Args:
+            bucket_seconds (int, optional): Width of a time bucket. Defaults to SEARCH_BUCKET_SECONDS.
+            retained_buckets (int, optional): Buckets kept per room. Defaults to SEARCH_RETAINED_BUCKETS.
+        """
+        self.bucket_us = bucket_seconds * 1000000
+        self.retained_buckets = retained_buckets
+        self.rooms = {} # room name -> {bucket number -> IndexPartition}
+        self.buckets = {} # room name -> sorted bucket numbers of that room
+        self.document_count = 0
+
+    def add(self, message):
+        """Indexes a room message dictionary with a server_received_us stamp."""
+        words = tokenize(message.get("message") or "")
+        received_us = message.get("server_received_us")
+        if not words or received_us is None:
+            return
+        room_name = message["room"]
+        bucket = received_us // self.bucket_us
+        partitions = self.rooms.setdefault(room_name, {})
+        partition = partitions.get(bucket)
+        if partition is None:
+            buckets = self.buckets.setdefault(room_name, [])
+            if len(buckets) >= self.retained_buckets and bucket < buckets[0]:
+                return # Older than anything kept
+            partition = partitions[bucket] = IndexPartition(bucket)
+            # Replaced rather than changed in place, so a query iterating the old list is not disturbed
+            buckets = self.buckets[room_name] = sorted(buckets + [bucket])
+            while len(buckets) > self.retained_buckets:
+                self.document_count -= len(partitions.pop(buckets.pop(0)).documents)
+        partition.add((message.get("id"), message.get("sender_color"), message["message"], received_us), words)
+        self.document_count += 1
+
+    def search(self, room_name, text, cursor=None, limit=SEARCH_PAGE_SIZE):
+        """
+        Finds the messages of a room containing every word of text, newest first.
+
+        Safe to call from a worker thread while the event loop adds messages.
+
+        Args:
+            room_name (str): The room to search.
+            text (str): The words to look for. Only the first MAX_SEARCH_TERMS count.
+            cursor (str, optional): The cursor of the previous page. Defaults to the first page.
+            limit (int, optional): Most results. Defaults to SEARCH_PAGE_SIZE.
+
+        Returns:
+            tuple: (list of message dictionaries, cursor of the next page or None if this was the last).
+        """
+        words = tokenize(text)[:MAX_SEARCH_TERMS]
+        start_bucket, start_position = parse_cursor(cursor)
+        partitions = self.rooms.get(room_name, {})
+        results = []
+        if not words or limit <= 0:
+            return results, None
+        for bucket in reversed(self.buckets.get(room_name, ())):
+            if start_bucket is not None and bucket > start_bucket:
+                continue
+            partition = partitions.get(bucket)
+            if partition is None: # Dropped while we were searching
+                continue
+            end = len(partition.documents) # Snapshot; later appends are left for the next query
+            before = start_position if bucket == start_bucket else end
+            for position in partition.matches(words, before, end):
+                if len(results) == limit:
+                    return results, last_cursor
+                message_id, sender_color, message_text, received_us = partition.documents[position]
+                results.append({"type": "message", "id": message_id, "room": room_name, "sender_color": sender_color,
+                                "message": message_text, "server_received_us": received_us})
+                last_cursor = f"{bucket}:{position}"
+        return results, None
+
+def parse_cursor(cursor):
+    """Returns the (bucket, position) of a search cursor, or (None, None) for a missing or malformed one."""
+    bucket, _, position = (cursor or "").partition(":")
+    if bucket.isdigit() and position.isdigit():
+        return int(bucket), int(position)
+    return None, None
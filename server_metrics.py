@@ -0,0 +1,234 @@
+import asyncio
+import bisect
+import collections
+import sys
+import threading
+import urllib.parse
+
+# Upper bounds in seconds of the default histogram buckets, from 10 microseconds to 1 second
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PROFILE_INTERVAL_SECONDS = 0.005 # Default time between two stack samples of the sampling profiler
+MAX_PROFILE_SECONDS = 300
+MAX_REQUEST_LINE = 8192
+
+
+def _format_labels(label_name, value):
+    if label_name is None:
+        return ""
+    escaped = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return f'{{{label_name}="{escaped}"}}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by the value of one label."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.values = collections.defaultdict(int) # label value (None without a label) -> count
+
+    def inc(self, amount=1, label=None):
+        self.values[label] += amount
+
+    def samples(self):
+        for label, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.label_name, label)} {_format_value(value)}"
+
+
+class Gauge:
+    """A value read from a function when metrics are scraped, so the hot path never updates it."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, function):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+
+    def samples(self):
+        yield f"{self.name} {_format_value(self.function())}"
+
+
+class FunctionCounter(Gauge):
+    """A counter kept elsewhere (e.g. in a stats object) and read when metrics are scraped."""
+
+    kind = "counter"
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets.
+
+    observe() is one bisect and two additions; the cumulative bucket counts
+    Prometheus expects are only computed when metrics are scraped.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1) # The last bucket is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}} {cumulative}'
+        yield f"{self.name}_sum {_format_value(self.sum)}"
+        yield f"{self.name}_count {cumulative}"
+
+
+class MetricsRegistry:
+    """Holds a process's metrics and renders them in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_name=None):
+        return self._add(Counter(name, help_text, label_name))
+
+    def gauge(self, name, help_text, function):
+        return self._add(Gauge(name, help_text, function))
+
+    def function_counter(self, name, help_text, function):
+        return self._add(FunctionCounter(name, help_text, function))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Samples the call stack of one thread from a background thread.
+
+    While running it records the target thread's stack every interval
+    seconds and counts identical stacks, so the event loop being profiled
+    only pays for the GIL hand-offs. The result is in the collapsed-stack
+    format flame graph tools read: one "outer;...;inner count" line per stack.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling. Returns the collapsed stacks, most frequent first."""
+        self._stop.set()
+        self._thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class MetricsServer:
+    """
+    A minimal HTTP server for scraping metrics and profiling a running process.
+
+    GET /metrics returns the registry in the Prometheus text format.
+    GET /profile?seconds=N[&interval=S] samples the event loop thread for N
+    seconds and returns the collapsed stacks; only one profile runs at a time.
+    It is meant to listen on a local interface only.
+    """
+
+    def __init__(self, registry, host="127.0.0.1", port=9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.loop_thread_id = threading.get_ident() # Created on the thread running the event loop
+        self.profiling = False
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip(): # Headers are not needed
+                pass
+            status, body = await self._route(request_line[:MAX_REQUEST_LINE].decode("latin-1"))
+            payload = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        except (ConnectionError, ValueError): # ValueError: request line over the stream limit
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, request_line):
+        parts = request_line.split()
+        if len(parts) < 2 or parts[0] != "GET":
+            return "405 Method Not Allowed", "Only GET is supported.\n"
+        url = urllib.parse.urlsplit(parts[1])
+        if url.path == "/metrics":
+            return "200 OK", self.registry.render()
+        if url.path == "/profile":
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                seconds = min(float(query.get("seconds", ["10"])[0]), MAX_PROFILE_SECONDS)
+                interval = float(query.get("interval", [str(PROFILE_INTERVAL_SECONDS)])[0])
+            except ValueError:
+                return "400 Bad Request", "seconds and interval must be numbers.\n"
+            if self.profiling:
+                return "409 Conflict", "A profile is already running.\n"
+            return "200 OK", await self.profile(seconds, interval)
+        return "404 Not Found", "Try /metrics or /profile?seconds=N.\n"
+
+    async def profile(self, seconds, interval=PROFILE_INTERVAL_SECONDS):
+        """Samples the event loop thread for a number of seconds. Returns the collapsed stacks."""
+        self.profiling = True
+        profiler = SamplingProfiler(self.loop_thread_id, max(interval, 0.0005))
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.profiling = False
+            stacks = profiler.stop()
+        return stacks
@@ -0,0 +1,198 @@
+import collections
+import heapq
+import secrets
+from rate_limit import ConnectionLimiter
+
+DIRECT_BUFFER_SIZE = 256 # Direct frames remembered per session so a resuming client can catch up
+ACK_MEMORY = 256 # Acks remembered per session so a message the client sends again is not relayed twice
+ENDED_SESSION_ACKS = 256 # Ended sessions whose acks are kept for a client that comes back after its session expired
+
+
+class ColorAllocator:
+    """
+    Hands out guaranteed-unique pastel colors backed by a compact slot allocator.
+
+    Each color is derived from a small integer slot. Released slots are reused
+    lowest-first, so the slot space stays dense no matter how many clients have
+    come and gone. Slots are scrambled with an odd multiplier before being turned
+    into a color, which keeps neighbouring slots visually distinct while staying
+    a bijection (no two slots can ever map to the same color).
+
+    Several allocators can share the color space without coordination by using
+    the same stride and distinct offsets: each one only hands out the slots
+    congruent to its offset, so their colors never overlap.
+    """
+
+    CHANNEL_BITS = 7 # Each RGB channel uses the pastel range 128-255
+    SLOT_BITS = CHANNEL_BITS * 3
+    SLOT_COUNT = 1 << SLOT_BITS
+    SLOT_MASK = SLOT_COUNT - 1
+    SCRAMBLE = 0x9E3B5 # Odd, so multiplication is invertible modulo SLOT_COUNT
+    UNSCRAMBLE = pow(SCRAMBLE, -1, SLOT_COUNT)
+
+    def __init__(self, offset=0, stride=1):
+        """
+        Args:
+            offset (int, optional): First slot owned by this allocator. Defaults to 0.
+            stride (int, optional): Distance between slots owned by this allocator. Defaults to 1.
+        """
+        self.offset = offset
+        self.stride = stride
+        self._next_slot = offset
+        self._free_slots = [] # Min-heap of released slots
+
+    def allocate(self):
+        """Returns a color that is not currently in use."""
+        if self._free_slots:
+            slot = heapq.heappop(self._free_slots)
+        elif self._next_slot < self.SLOT_COUNT:
+            slot = self._next_slot
+            self._next_slot += self.stride
+        else:
+            raise RuntimeError("No free colors left to allocate.")
+        return self.color_for_slot(slot)
+
+    def release(self, color):
+        """Returns a color to the pool so it can be handed out again."""
+        heapq.heappush(self._free_slots, self.slot_for_color(color))
+
+    def color_for_slot(self, slot):
+        """Maps a slot number to its hex color code."""
+        scrambled = (slot * self.SCRAMBLE) & self.SLOT_MASK
+        channel_mask = (1 << self.CHANNEL_BITS) - 1
+        red = 128 + ((scrambled >> (2 * self.CHANNEL_BITS)) & channel_mask)
+        green = 128 + ((scrambled >> self.CHANNEL_BITS) & channel_mask)
+        blue = 128 + (scrambled & channel_mask)
+        return f"#{red:02x}{green:02x}{blue:02x}"
+
+    def slot_for_color(self, color):
+        """Maps a hex color code produced by color_for_slot back to its slot number."""
+        value = int(color.lstrip("#"), 16)
+        red, green, blue = (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
+        scrambled = ((red - 128) << (2 * self.CHANNEL_BITS)) | ((green - 128) << self.CHANNEL_BITS) | (blue - 128)
+        return (scrambled * self.UNSCRAMBLE) & self.SLOT_MASK
+
+
+class Session:
+    """
+    Everything the server knows about one chat client.
+
+    A session outlives its WebSocket connection: when the connection drops the
+    session is detached and kept for a grace period, so the client can resume
+    it with its token and keep its color, its rooms and any direct messages it
+    missed in the meantime.
+
+    One of these exists per client, so it is a __slots__ record and the
+    containers only some clients need (direct message buffer, acks) are
+    created on first use; an idle client costs little more than the object.
+    """
+
+    __slots__ = (
+        "color", "token", "websocket", "queue", "codec", "rooms", "direct_seq", "direct_buffer_size", "direct_buffer",
+        "expiry", "acks", "limiter", "last_seen", "awaiting_pong",
+    )
+
+    def __init__(self, color, token, direct_buffer_size=DIRECT_BUFFER_SIZE):
+        self.color = color
+        self.token = token # Secret the client presents to resume this session
+        self.websocket = None # Current connection, None while detached
+        self.queue = None # OutboundQueue of the current connection
+        self.codec = None # Wire protocol negotiated by the current connection
+        self.rooms = set() # Names of the rooms the session is in
+        self.direct_seq = 0 # Sequence number of the last direct frame sent to this session
+        self.direct_buffer_size = direct_buffer_size
+        self.direct_buffer = None # (seq, message) of recent direct messages, from the first one on
+        self.expiry = None # Timer handle that ends the session while it is detached
+        self.acks = None # client message id -> ack frame, for the last ACK_MEMORY acked messages, from the first one on
+        self.limiter = ConnectionLimiter() # Kept across reconnects, so reconnecting does not refill the client's budgets
+        self.last_seen = 0.0 # Monotonic time the current connection last received a frame, see HeartbeatMonitor
+        self.awaiting_pong = False # A heartbeat ping went unanswered so far
+
+    def buffer_direct(self, seq, message):
+        """Remembers a direct message, so it can be sent again if the client resumes."""
+        if self.direct_buffer is None:
+            self.direct_buffer = collections.deque(maxlen=self.direct_buffer_size)
+        self.direct_buffer.append((seq, message))
+
+    def remember_ack(self, client_id, ack):
+        """Keeps the ack of a client message, so a resend of it can be answered with the same ack."""
+        if self.acks is None:
+            self.acks = collections.OrderedDict()
+        self.acks[client_id] = ack
+        if len(self.acks) > ACK_MEMORY:
+            self.acks.popitem(last=False)
+
+    def ack_for(self, client_id):
+        """Returns the remembered ack of a client message, or None if it was not acked (or long ago)."""
+        return self.acks.get(client_id) if self.acks is not None else None
+
+    @property
+    def attached(self):
+        return self.websocket is not None
+
+
+class SessionRegistry:
+    """
+    Keeps track of sessions and their colors.
+
+    Sessions are indexed by color and by resume token, so joins, leaves,
+    resumes and direct-message routing are all constant-time dictionary
+    operations. The acks of the last ENDED_SESSION_ACKS removed sessions are
+    kept by token: a client that tries to resume an ended session starts a new
+    one, and the acks let the server recognise the messages it resends.
+    """
+
+    def __init__(self, allocator=None, direct_buffer_size=DIRECT_BUFFER_SIZE):
+        """
+        Args:
+            allocator (ColorAllocator, optional): Where colors come from. Defaults to a ColorAllocator owning every color.
+            direct_buffer_size (int, optional): Direct frames kept per session for resuming. Defaults to DIRECT_BUFFER_SIZE.
+        """
+        self.allocator = allocator if allocator is not None else ColorAllocator()
+        self.direct_buffer_size = direct_buffer_size
+        self._session_by_color = {}
+        self._session_by_token = {}
+        self._ended_acks = collections.OrderedDict() # resume token -> acks of a removed session, oldest first
+
+    def create(self):
+        """Creates a session with a unique color and a fresh resume token."""
+        session = Session(self.allocator.allocate(), secrets.token_urlsafe(18), self.direct_buffer_size)
+        self._session_by_color[session.color] = session
+        self._session_by_token[session.token] = session
+        return session
+
+    def remove(self, session):
+        """Forgets a session and frees its color. Returns False if it was already removed."""
+        if self._session_by_color.get(session.color) is not session:
+            return False
+        del self._session_by_color[session.color]
+        del self._session_by_token[session.token]
+        self.allocator.release(session.color)
+        if session.acks:
+            self._ended_acks[session.token] = session.acks
+            if len(self._ended_acks) > ENDED_SESSION_ACKS:
+                self._ended_acks.popitem(last=False)
+        return True
+
+    def take_ended_acks(self, token):
+        """Returns and forgets the acks of a removed session, or None if there are none (or they are long gone)."""
+        return self._ended_acks.pop(token, None)
+
+    def by_color(self, color):
+        """Returns the session that owns a color, or None if there is none."""
+        return self._session_by_color.get(color)
+
+    def by_token(self, token):
+        """Returns the session with the given resume token, or None if there is none."""
+        return self._session_by_token.get(token)
+
+    def sessions(self):
+        """Returns a live view of the registered sessions."""
+        return self._session_by_color.values()
+
+    def colors(self):
+        """Returns a live view of the colors currently in use."""
+        return self._session_by_color.keys()
+
+    def __len__(self):
+        return len(self._session_by_color)
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The modules live in the repository root
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """chat_server with fresh module state, so tests do not see each other's sessions and rooms."""
+    import chat_server
+    from heartbeat import HeartbeatMonitor
+    from rate_limit import AdmissionControl
+    from search_index import SearchIndex
+    from session_registry import SessionRegistry
+
+    monkeypatch.setattr(chat_server, "registry", SessionRegistry())
+    monkeypatch.setattr(chat_server, "rooms", {})
+    monkeypatch.setattr(chat_server, "remote_clients", {})
+    monkeypatch.setattr(chat_server, "typing_tracker", chat_server.TypingTracker())
+    monkeypatch.setattr(chat_server, "heartbeat", HeartbeatMonitor(chat_server.send_ping, chat_server.reap_dead_sessions))
+    monkeypatch.setattr(chat_server, "admission", AdmissionControl())
+    monkeypatch.setattr(chat_server, "search_index", SearchIndex())
+    monkeypatch.setattr(chat_server, "search_tasks", set())
+    monkeypatch.setattr(chat_server, "message_store", None)
+    monkeypatch.setattr(chat_server, "bus", None)
+    monkeypatch.setattr(chat_server, "capture", None)
+    return chat_server
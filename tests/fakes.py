@@ -0,0 +1,103 @@
+import asyncio
+
+import websockets.exceptions
+
+from message_packet import JSON_SUBPROTOCOL, decode_frame
+
+
+class FakeTransport:
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    def abort(self):
+        self.websocket.drop()
+
+
+class FakeWebSocket:
+    """
+    Stands in for a websockets server connection.
+
+    Frames passed to receive() come out of the async iterator handle_client
+    reads, and frames the server sends are kept in sent. While paused is
+    set, send() blocks like a socket whose peer stopped reading.
+    """
+
+    def __init__(self, path="/", subprotocol=JSON_SUBPROTOCOL):
+        self.path = path
+        self.subprotocol = subprotocol
+        self.sent = []
+        self.close_code = None
+        self.close_reason = None
+        self.transport = FakeTransport(self)
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self._incoming = asyncio.Queue()
+
+    def receive(self, frame):
+        self._incoming.put_nowait(frame)
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def drop(self, code=1006):
+        """Ends the connection without a closing handshake, as if the peer vanished."""
+        if self.close_code is None:
+            self.close_code = code
+            self._incoming.put_nowait(None)
+        self.resumed.set()
+
+    async def send(self, frame):
+        await self.resumed.wait()
+        if self.close_code is not None:
+            raise websockets.exceptions.ConnectionClosedError(None, None)
+        self.sent.append(frame)
+
+    async def close(self, code=1000, reason=""):
+        if self.close_code is None:
+            self.close_code = code
+            self.close_reason = reason
+            self._incoming.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await self._incoming.get()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    def messages(self, *types):
+        """Returns the messages sent so far, decoded, optionally only those of the given types."""
+        messages = [decode_frame(frame) for frame in self.sent]
+        return [message for message in messages if not types or message["type"] in types]
+
+
+async def settle(rounds=20):
+    """Lets writer tasks and other scheduled callbacks run."""
+    for _ in range(rounds):
+        await asyncio.sleep(0)
+
+
+class FakeClock:
+    """A monotonic clock that only moves when told to."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def record_changes(model):
+    """Returns a list that collects ("insert" or "remove", first, last) for every row change of model."""
+    changes = []
+    model.rowsInserted.connect(lambda parent, first, last: changes.append(("insert", first, last)))
+    model.rowsRemoved.connect(lambda parent, first, last: changes.append(("remove", first, last)))
+    return changes
@@ -0,0 +1,87 @@
+import pytest
+
+QtCore = pytest.importorskip("PySide6.QtCore")
+
+from chat_models import ChatLogModel
+from fakes import record_changes
+
+app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([]) # Models and timers need an application, not a display
+
+
+def texts(rows):
+    return [text for _, text in rows]
+
+def chat_log(rows, max_rows=3, archive_rows=100):
+    """A ChatLogModel holding the given lines, as if the view had followed them."""
+    model = ChatLogModel(max_rows=max_rows, archive_rows=archive_rows)
+    for text in rows:
+        model.append(text)
+    model.flush()
+    return model
+
+
+def test_queued_lines_are_inserted_at_once_and_the_top_is_archived():
+    model = ChatLogModel(max_rows=3, archive_rows=100)
+    changes = record_changes(model)
+    for number in range(5):
+        model.append(str(number), "#a1b2c3")
+    assert model.rowCount() == 0 # Nothing is inserted before the flush
+    model.flush()
+    assert changes == [("insert", 0, 4), ("remove", 0, 1)]
+    assert texts(model.rows) == ["2", "3", "4"]
+    assert texts(model.archive) == ["0", "1"]
+    assert model.data(model.index(0)) == "2"
+    assert model.data(model.index(0), QtCore.Qt.ItemDataRole.DecorationRole).name() == "#a1b2c3"
+
+def test_the_archive_is_bounded():
+    model = chat_log(map(str, range(10)), max_rows=3, archive_rows=4)
+    assert texts(model.archive) == ["3", "4", "5", "6"]
+
+def test_lines_arriving_while_scrolled_up_wait_below_the_model():
+    model = chat_log(["0", "1"], max_rows=3)
+    model.following = False
+    changes = record_changes(model)
+    for text in ("2", "3", "4"):
+        model.append(text)
+    model.flush()
+    assert changes == [("insert", 2, 2)] # Only up to the cap, and nothing is trimmed from the top the user is reading
+    assert texts(model.rows) == ["0", "1", "2"]
+    assert texts(model.newer) == ["3", "4"]
+
+    model.append("5") # Lines keep their order behind the ones already waiting, even if rows leave the model
+    model.flush()
+    assert texts(model.newer) == ["3", "4", "5"]
+
+def test_lines_waiting_below_the_model_are_bounded():
+    model = chat_log(["0"], max_rows=1, archive_rows=2)
+    model.following = False
+    for text in ("1", "2", "3"):
+        model.append(text)
+    model.flush()
+    assert texts(model.newer) == ["2", "3"]
+
+def test_load_newer_pages_in_from_below_and_archives_the_top():
+    model = chat_log(["0", "1", "2"], max_rows=3)
+    model.following = False
+    for text in ("3", "4", "5"):
+        model.append(text)
+    model.flush()
+    changes = record_changes(model)
+    assert model.load_newer(2) == 2
+    assert changes == [("insert", 3, 4), ("remove", 0, 1)]
+    assert texts(model.rows) == ["2", "3", "4"]
+    assert texts(model.archive) == ["0", "1"]
+    assert texts(model.newer) == ["5"]
+    assert model.has_newer()
+
+def test_load_older_pages_in_from_the_archive_and_moves_the_bottom_below():
+    model = chat_log(map(str, range(6)), max_rows=3)
+    model.following = False
+    changes = record_changes(model)
+    assert model.load_older(2) == 2
+    assert changes == [("insert", 0, 1), ("remove", 3, 4)]
+    assert texts(model.rows) == ["1", "2", "3"]
+    assert texts(model.archive) == ["0"]
+    assert texts(model.newer) == ["4", "5"]
+    assert model.load_older(5) == 1
+    assert not model.has_older()
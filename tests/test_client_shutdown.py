@@ -0,0 +1,65 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PySide6.QtWebSockets")
+import websockets
+from PySide6.QtCore import QCoreApplication
+
+from main_client_service import SHUTDOWN_TIMEOUT_MS, WebSocketClient
+
+app = QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.fixture
+def close_codes():
+    """Runs a WebSocket server on its own thread. Yields (url, future of the close code of the first connection)."""
+    close_code = concurrent.futures.Future()
+    address = concurrent.futures.Future()
+    stopped = threading.Event()
+
+    async def handler(websocket, path):
+        async for _ in websocket:
+            pass
+        close_code.set_result(websocket.close_code)
+
+    async def serve():
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            address.set_result(server.sockets[0].getsockname())
+            while not stopped.is_set():
+                await asyncio.sleep(0.01)
+
+    thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+    thread.start()
+    host, port = address.result(timeout=5)
+    yield f"ws://{host}:{port}", close_code
+    stopped.set()
+    thread.join()
+
+def process_events_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.005)
+    return condition()
+
+def test_threaded_shutdown_finishes_the_close_handshake(close_codes):
+    url, close_code = close_codes
+    client = WebSocketClient(url, threaded=True)
+    client.connect_to_server()
+    assert process_events_until(lambda: client._socket_open)
+    started = time.monotonic()
+    client.shutdown()
+    assert client._thread.isFinished()
+    assert time.monotonic() - started < SHUTDOWN_TIMEOUT_MS / 1000 # Returned on the server's answer, not the timeout
+    assert close_code.result(timeout=5) == 1000 # A clean close, not a dropped connection
+
+def test_threaded_shutdown_without_a_connection_returns_at_once():
+    client = WebSocketClient("ws://127.0.0.1:1", threaded=True)
+    started = time.monotonic()
+    client.shutdown()
+    assert client._thread.isFinished()
+    assert time.monotonic() - started < SHUTDOWN_TIMEOUT_MS / 1000
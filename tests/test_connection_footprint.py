@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeWebSocket, settle
+
+
+class FakeResource:
+    """Stands in for the resource module with a given open file limit."""
+
+    RLIMIT_NOFILE = 7
+    RLIM_INFINITY = -1
+
+    def __init__(self, soft, hard):
+        self.limit = (soft, hard)
+        self.set_calls = []
+
+    def getrlimit(self, which):
+        assert which == self.RLIMIT_NOFILE
+        return self.limit
+
+    def setrlimit(self, which, limit):
+        if self.limit[1] != self.RLIM_INFINITY and limit[0] > self.limit[1]:
+            raise ValueError("not allowed to raise maximum limit")
+        self.set_calls.append(limit)
+        self.limit = limit
+
+@pytest.mark.parametrize("soft, hard, fitting, raised_to", [
+    (200000, 200000, 60000, None), # Already enough
+    (1024, 200000, 60000, 61024), # Raised as far as needed, not to the hard limit
+    (1024, -1, 60000, 61024), # No hard limit
+    (1024, 11024, 10000, 11024), # Raised to the hard limit, and the cap lowered to fit
+    (900, 1000, 0, 1000), # Not even room for the reserved descriptors
+    (-1, -1, 60000, None), # No limit at all
+])
+def test_fit_file_limit_raises_the_limit_or_lowers_the_cap(server, monkeypatch, soft, hard, fitting, raised_to):
+    monkeypatch.setattr(server, "RESERVED_FILE_DESCRIPTORS", 1024)
+    resource = FakeResource(soft, hard)
+    monkeypatch.setattr(server, "resource", resource)
+    assert server.fit_file_limit(60000) == fitting
+    assert resource.set_calls == ([(raised_to, hard)] if raised_to is not None else [])
+
+def test_fit_file_limit_trusts_the_cap_without_the_resource_module(server, monkeypatch):
+    monkeypatch.setattr(server, "resource", None)
+    assert server.fit_file_limit(60000) == 60000
+
+
+@pytest.mark.parametrize("drop", [True, False])
+def test_handshake_headers_are_dropped_only_where_known_to_be_unused(server, monkeypatch, drop):
+    monkeypatch.setattr(server, "DROP_HANDSHAKE_HEADERS", drop)
+
+    async def scenario():
+        websocket = FakeWebSocket()
+        websocket.request_headers = websocket.response_headers = {"Host": "example.org"}
+        task = asyncio.create_task(server.handle_client(websocket))
+        await settle()
+        assert (websocket.request_headers is server.NO_HEADERS, websocket.response_headers is server.NO_HEADERS) == (drop, drop)
+        websocket.receive(None)
+        await task
+    asyncio.run(scenario())
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+from fakes import FakeClock, FakeWebSocket, settle
+from heartbeat import HeartbeatMonitor
+
+
+class Peer:
+    """The part of a Session the monitor uses."""
+
+    last_seen = 0.0
+    awaiting_pong = False
+
+
+def monitor(clock):
+    pinged, reaped = [], []
+    heartbeat = HeartbeatMonitor(pinged.append, reaped.append, interval=30.0, timeout=15.0, clock=clock)
+    return heartbeat, pinged, reaped
+
+def test_silent_sessions_are_pinged_and_active_ones_are_not():
+    clock = FakeClock()
+    heartbeat, pinged, reaped = monitor(clock)
+    silent, active = Peer(), Peer()
+    heartbeat.watch(silent)
+    heartbeat.watch(active)
+    clock.advance(20.0)
+    heartbeat.seen(active)
+    clock.advance(11.0)
+    heartbeat.check()
+    assert pinged == [silent]
+    assert silent.awaiting_pong and not active.awaiting_pong
+
+def test_sessions_that_answer_are_kept_and_the_rest_reaped_together():
+    clock = FakeClock()
+    heartbeat, pinged, reaped = monitor(clock)
+    first, answering, second = Peer(), Peer(), Peer()
+    for peer in (first, answering, second):
+        heartbeat.watch(peer)
+    clock.advance(31.0)
+    heartbeat.check()
+    assert set(pinged) == {first, answering, second}
+    heartbeat.seen(answering) # Its pong
+    clock.advance(16.0)
+    assert heartbeat.check() == 2
+    assert [set(batch) for batch in reaped] == [{first, second}] # One call for the whole batch
+    assert not answering.awaiting_pong and len(heartbeat) == 1
+    clock.advance(31.0)
+    heartbeat.check()
+    assert pinged[-1] is answering # Still watched, and pinged again once silent
+
+def test_the_server_reaps_dead_clients_with_one_presence_update(server, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server, "heartbeat", HeartbeatMonitor(server.send_ping, server.reap_dead_sessions, clock=clock))
+    directory_updates = []
+    monkeypatch.setattr(server, "publish_directory", lambda joined=(), left=(): directory_updates.append((list(joined), list(left))))
+
+    async def scenario():
+        connections = []
+        for _ in range(3):
+            websocket = FakeWebSocket()
+            connections.append((websocket, asyncio.create_task(server.handle_client(websocket))))
+            await settle()
+        await asyncio.sleep(0.1) # Let the joins' presence go out
+        (watcher, watcher_task), *dead = connections
+        del directory_updates[:]
+        presence_before = len(watcher.messages("presence"))
+
+        clock.advance(server.heartbeat.interval + 1)
+        server.heartbeat.check()
+        await settle()
+        assert all(websocket.messages("ping") for websocket, _ in connections)
+        watcher.receive(json.dumps({"type": "pong"}))
+        await settle()
+        clock.advance(server.heartbeat.timeout + 1)
+        server.heartbeat.check()
+        for websocket, task in dead:
+            await task
+            assert websocket.close_code == 1006 # Aborted, nobody would answer a closing handshake
+        await asyncio.sleep(0.1)
+
+        dead_colors = {websocket.messages("color_assignment")[0]["color"] for websocket, _ in dead}
+        assert [(joined, set(left)) for joined, left in directory_updates] == [([], dead_colors)]
+        presence = watcher.messages("presence")[presence_before:]
+        assert [set(update.get("left", ())) for update in presence] == [dead_colors]
+        assert watcher.close_code is None
+        watcher.receive(None)
+        await watcher_task
+    asyncio.run(scenario())
@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+from fakes import FakeWebSocket, settle
+
+
+async def connect(server):
+    websocket = FakeWebSocket()
+    task = asyncio.create_task(server.handle_client(websocket))
+    await settle()
+    return websocket, task
+
+async def disconnect(*connections):
+    for websocket, task in connections:
+        websocket.receive(None)
+        await task
+
+def test_relayed_messages_are_stamped_and_acked_with_the_stamps(server):
+    async def scenario():
+        sender, sender_task = await connect(server)
+        receiver, receiver_task = await connect(server)
+        sender.receive(json.dumps({"type": "message", "message": "hi", "client_sent_us": 123, "client_id": "c1"}))
+        await settle()
+        [relayed] = receiver.messages("message")
+        assert relayed["server_received_us"] <= relayed["server_sent_us"]
+        assert "client_sent_us" not in relayed and "client_id" not in relayed # Only the sender needs them
+        [ack] = sender.messages("ack")
+        assert ack == {"type": "ack", "client_id": "c1", "client_sent_us": 123, "id": relayed["id"],
+                       "server_received_us": relayed["server_received_us"], "server_sent_us": relayed["server_sent_us"]}
+        await disconnect((sender, sender_task), (receiver, receiver_task))
+    asyncio.run(scenario())
+
+def test_direct_messages_are_acked_with_the_stamps(server):
+    async def scenario():
+        sender, sender_task = await connect(server)
+        receiver, receiver_task = await connect(server)
+        recipient_color = receiver.messages("color_assignment")[0]["color"]
+        sender.receive(json.dumps({"type": "direct_message", "message": "psst", "recipient_color": recipient_color, "client_sent_us": 5}))
+        await settle()
+        [relayed] = receiver.messages("direct_message")
+        [ack] = sender.messages("ack")
+        assert (ack["client_sent_us"], ack["id"], ack["server_sent_us"]) == (5, relayed["id"], relayed["server_sent_us"])
+        assert "client_id" not in ack
+        await disconnect((sender, sender_task), (receiver, receiver_task))
+    asyncio.run(scenario())
+
+def test_rejected_messages_are_acked_without_stamps(server):
+    async def scenario():
+        sender, sender_task = await connect(server)
+        sender.receive(json.dumps({"type": "message", "message": "x" * (server.MAX_MESSAGE_LENGTH + 1), "client_id": "c1"}))
+        await settle()
+        assert sender.messages("ack") == [{"type": "ack", "client_id": "c1"}]
+        await disconnect((sender, sender_task))
+    asyncio.run(scenario())
+
+def test_a_resent_message_gets_the_same_ack_and_is_not_relayed_again(server):
+    async def scenario():
+        sender, sender_task = await connect(server)
+        receiver, receiver_task = await connect(server)
+        frame = json.dumps({"type": "message", "message": "once", "client_sent_us": 1, "client_id": "c1"})
+        sender.receive(frame)
+        sender.receive(frame)
+        await settle()
+        assert len(receiver.messages("message")) == 1
+        first, second = sender.messages("ack")
+        assert first == second
+        await disconnect((sender, sender_task), (receiver, receiver_task))
+    asyncio.run(scenario())
@@ -0,0 +1,60 @@
+import pytest
+
+from message_cache import MessageCache, own_message_record
+from message_packet import Ack
+
+
+@pytest.fixture(params=[True, False], ids=["fts5", "like"])
+def cache(request, tmp_path):
+    """Yields a function that writes messages to a fresh cache and returns it open for reading, searching with FTS5 or LIKE."""
+    path = str(tmp_path / "cache.sqlite3")
+    caches = []
+
+    def written(*messages):
+        writer = MessageCache(path)
+        writer.add_many(messages)
+        writer.close() # Waits for the writer thread
+        reader = MessageCache(path)
+        if reader.full_text is False and request.param:
+            pytest.skip("SQLite lacks FTS5")
+        reader.full_text = request.param
+        caches.append(reader)
+        return reader
+
+    yield written
+    for reader in caches:
+        reader.close()
+
+def room_message(message_id, text, sent_us, room="lobby", sender_color="#a1b2c3"):
+    return {"type": "message", "id": message_id, "room": room, "sender_color": sender_color, "message": text, "server_received_us": sent_us}
+
+
+def test_messages_are_kept_per_room_in_time_order_and_deduplicated(cache):
+    reader = cache(room_message("m2", "second", 20), room_message("m1", "first", 10), room_message("m1", "first again", 30),
+                   room_message("m3", "elsewhere", 40, room="other"),
+                   {"type": "direct_message", "id": "d1", "sender_color": "#a1b2c3", "recipient_color": "#808080", "message": "psst", "server_received_us": 50})
+    assert [m["message"] for m in reader.recent("lobby", 10)] == ["first", "second"]
+    assert [m["message"] for m in reader.recent("lobby", 1)] == ["second"]
+    assert reader.newest_server_time("lobby") == 20
+    assert reader.newest_server_time("nowhere") is None
+    [direct] = reader.search("psst")
+    assert direct == {"type": "direct_message", "id": "d1", "sender_color": "#a1b2c3", "message": "psst", "server_received_us": 50, "recipient_color": "#808080"}
+
+def test_search_needs_every_word_and_returns_the_newest_first(cache):
+    reader = cache(room_message("m1", "lunch at noon", 10), room_message("m2", "no lunch today", 20), room_message("m3", "noon meeting", 30),
+                   room_message("m4", "lunch at noon?", 40, room="other"))
+    assert [m["id"] for m in reader.search("lunch noon")] == ["m4", "m1"]
+    assert [m["id"] for m in reader.search("noon lunch", room="lobby")] == ["m1"]
+    assert [m["id"] for m in reader.search("lunch", limit=2)] == ["m4", "m2"]
+    assert reader.search("   ") == []
+    assert reader.search('"lunch" OR *') == [] # Quotes and operators are searched for, not interpreted
+
+def test_own_messages_are_cached_as_the_server_relayed_them(cache):
+    payload = {"type": "message", "room": "lobby", "message": "mine", "client_id": "7", "client_sent_us": 1}
+    ack = Ack(client_id="7", id="m9", client_sent_us=1, server_received_us=100, server_sent_us=101)
+    record = own_message_record(payload, ack, "#a1b2c3")
+    assert record == {"type": "message", "room": "lobby", "message": "mine", "id": "m9", "sender_color": "#a1b2c3",
+                      "server_received_us": 100, "server_sent_us": 101}
+    reader = cache(record, room_message("m9", "mine", 100)) # The same message arriving again, e.g. in history, is not cached twice
+    assert reader.recent("lobby", 10) == [room_message("m9", "mine", 100)]
+    assert reader.newest_server_time("lobby") == 100
@@ -0,0 +1,72 @@
+import asyncio
+import os
+
+from message_log import INDEX_ENTRY, MessageLog, MessageStore
+
+def message(seq):
+    return {"type": "message", "room": "lobby", "message": f"message {seq}"}
+
+def write_log(directory, count, segment_records=4):
+    log = MessageLog(str(directory), segment_records)
+    for seq in range(count):
+        assert log.append(message(seq)) == seq
+    for segment in log.flush():
+        segment.fsync()
+    log.close()
+
+
+def test_reads_span_segments_and_survive_a_reopen(tmp_path):
+    write_log(tmp_path, 10)
+    log = MessageLog(str(tmp_path), 4)
+    assert len(log.segments) == 3
+    assert log.next_seq == 10
+    assert log.read_range(2, 7) == [message(seq) for seq in range(2, 7)]
+    assert log.tail(3) == [message(seq) for seq in range(7, 10)]
+    assert log.append(message(10)) == 10
+    log.close()
+
+def test_recovery_truncates_a_partial_record(tmp_path):
+    write_log(tmp_path, 6)
+    newest_log = os.path.join(tmp_path, f"{4:020d}.log")
+    with open(newest_log, "ab") as log_file:
+        log_file.write(b"\x00\x00\x01\x00{\"type\":") # An append cut short before its index entry was written
+    size_with_garbage = os.path.getsize(newest_log)
+
+    log = MessageLog(str(tmp_path), 4)
+    assert log.next_seq == 6
+    assert os.path.getsize(newest_log) < size_with_garbage
+    assert log.tail(6) == [message(seq) for seq in range(6)]
+    assert log.append(message(6)) == 6
+    assert log.tail(1) == [message(6)]
+    log.close()
+
+def test_recovery_drops_index_entries_past_the_end_of_the_log(tmp_path):
+    write_log(tmp_path, 7)
+    newest_log = os.path.join(tmp_path, f"{4:020d}.log")
+    newest_index = os.path.join(tmp_path, f"{4:020d}.idx")
+    with open(newest_index, "rb") as index_file:
+        second_end = INDEX_ENTRY.unpack_from(index_file.read(), INDEX_ENTRY.size)[0]
+    with open(newest_log, "r+b") as log_file:
+        log_file.truncate(second_end + 2) # The index reached the disk, the last record's data did not
+
+    log = MessageLog(str(tmp_path), 4)
+    assert log.next_seq == 6
+    assert os.path.getsize(newest_log) == second_end
+    assert log.tail(10) == [message(seq) for seq in range(6)]
+    log.close()
+
+    reopened = MessageLog(str(tmp_path), 4) # The dropped entries were cleared, so a second recovery agrees
+    assert reopened.next_seq == 6
+    reopened.close()
+
+def test_store_reopens_given_up_logs(tmp_path):
+    store = MessageStore(str(tmp_path), segment_records=4, max_open_logs=2)
+    for room_name in ("a", "b", "c"):
+        store.append(room_name, {"type": "message", "room": room_name, "message": room_name})
+    assert list(store.logs) == ["b", "c"]
+    assert store.recent("a", 5) == [{"type": "message", "room": "a", "message": "a"}]
+    assert store.recent("never written", 5) == []
+    assert "never written" not in store.logs
+    asyncio.run(store.sync())
+    assert sorted(store.stored_rooms()) == ["a", "b", "c"]
+    store.close()
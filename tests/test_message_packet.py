@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import pytest
+
+from fakes import FakeWebSocket, settle
+from message_packet import (BINARY_CODEC, BINARY_SUBPROTOCOL, CLIENTS, COLOR, COLORS, FRAME_SCHEMAS, FRAMES, JSON_CODEC, JSON_SUBPROTOCOL, JSON_TAG, STRING, UINT,
+                            ChatMessage, UnknownMessage, decode_binary, decode_frame, decode_message, encode_binary, message_from_dict)
+
+SAMPLE_VALUES = {
+    STRING: "héllo, wörld",
+    COLOR: "#a1b2c3",
+    COLORS: ["#a1b2c3", "#ffffff"],
+    UINT: 1700000000123456,
+    CLIENTS: [{"color": "#a1b2c3"}, {"color": "#808080"}],
+    FRAMES: [{"type": "message", "id": "m1", "room": "lobby", "sender_color": "#a1b2c3", "message": "hi", "seq": 7}],
+}
+
+def full_message(message_type):
+    """Returns a message of the given type with every schema field set."""
+    _, fields = FRAME_SCHEMAS[message_type]
+    return {"type": message_type, **{name: SAMPLE_VALUES.get(kind, True) for name, kind in fields}}
+
+
+@pytest.mark.parametrize("message_type", sorted(FRAME_SCHEMAS))
+def test_binary_round_trip_with_every_field(message_type):
+    message = full_message(message_type)
+    frame = encode_binary(message)
+    assert frame[0] == FRAME_SCHEMAS[message_type][0]
+    assert decode_binary(frame) == message
+
+@pytest.mark.parametrize("message_type", sorted(FRAME_SCHEMAS))
+def test_binary_round_trip_with_only_the_type(message_type):
+    message = {"type": message_type}
+    assert decode_binary(encode_binary(message)) == message
+
+@pytest.mark.parametrize("codec", [JSON_CODEC, BINARY_CODEC])
+def test_codecs_round_trip_through_decode_frame(codec):
+    message = full_message("message")
+    assert decode_frame(codec.encode(message)) == message
+
+def test_unknown_fields_fall_back_to_json():
+    message = {"type": "message", "message": "hi", "extra": [1, 2]}
+    frame = encode_binary(message)
+    assert frame[0] == JSON_TAG
+    assert decode_binary(frame) == message
+
+def test_values_the_schema_cannot_carry_fall_back_to_json():
+    message = {"type": "message", "message": "hi", "sender_color": "red"}
+    frame = encode_binary(message)
+    assert frame[0] == JSON_TAG
+    assert decode_binary(frame) == message
+
+def test_truncated_binary_frames_are_rejected():
+    frame = encode_binary(full_message("message"))
+    for end in range(1, len(frame)):
+        with pytest.raises(ValueError):
+            decode_binary(frame[:end])
+
+def test_trailing_bytes_are_rejected():
+    with pytest.raises(ValueError):
+        decode_binary(encode_binary({"type": "ping"}) + b"\x00")
+
+def test_decode_message_returns_typed_messages():
+    message = decode_message(BINARY_CODEC.encode({"type": "message", "message": "hi", "seq": 3}))
+    assert isinstance(message, ChatMessage)
+    assert (message.message, message.seq, message.room) == ("hi", 3, "lobby")
+
+def test_unknown_types_are_kept_and_bad_types_raise():
+    assert message_from_dict({"type": "from_the_future", "x": 1}) == UnknownMessage("from_the_future", {"type": "from_the_future", "x": 1})
+    for data in ({"type": ["list"]}, {"type": None}, ["not", "an", "object"], {"type": "direct_message", "message": "hi"}):
+        with pytest.raises(ValueError):
+            message_from_dict(data)
+
+def test_fields_of_the_wrong_type_raise():
+    for data in ({"type": "message", "message": "hi", "room": ["lobby"]}, {"type": "direct_message", "message": "hi", "recipient_color": {"c": 1}},
+                 {"type": "message", "message": 5}, {"type": "message", "message": "hi", "client_id": []},
+                 {"type": "search", "query": "hi", "request_id": {}}):
+        with pytest.raises(ValueError):
+            message_from_dict(data)
+    assert message_from_dict({"type": "search", "query": "hi", "request_id": 3}).request_id == 3
+
+def test_malformed_frames_get_an_error_and_the_connection_keeps_reading(server):
+    async def scenario():
+        websocket = FakeWebSocket()
+        task = asyncio.create_task(server.handle_client(websocket))
+        await settle()
+        for frame in ("{not json", json.dumps({"type": "message", "message": "hi", "room": ["lobby"]}),
+                      json.dumps({"type": "direct_message", "message": "hi", "recipient_color": {"c": 1}}), b"\xff\x01"):
+            websocket.receive(frame)
+        websocket.receive(json.dumps({"type": "message", "message": "still here", "client_id": "c1"}))
+        await settle()
+        assert [error["message"] for error in websocket.messages("error")] == ["Malformed frame."] * 4
+        assert websocket.messages("ack")[0]["client_id"] == "c1"
+        assert websocket.close_code is None
+        websocket.receive(None)
+        await task
+    asyncio.run(scenario())
+
+def test_server_preference_decides_between_offered_protocols(server):
+    both = [JSON_SUBPROTOCOL, BINARY_SUBPROTOCOL]
+    assert server.select_subprotocol(both, server.PROTOCOL_PREFERENCES["binary"]) == BINARY_SUBPROTOCOL
+    assert server.select_subprotocol(both, server.PROTOCOL_PREFERENCES["json"]) == JSON_SUBPROTOCOL
+    assert server.select_subprotocol([BINARY_SUBPROTOCOL], server.PROTOCOL_PREFERENCES["json"]) == BINARY_SUBPROTOCOL
+    assert server.select_subprotocol(["chat.other"], server.PROTOCOL_PREFERENCES["binary"]) is None
@@ -0,0 +1,134 @@
+import asyncio
+
+from fakes import FakeWebSocket, settle
+from outbound_queue import (DISCONNECT, DROP_EPHEMERAL, DROP_OLDEST, PRIORITY_CHAT, PRIORITY_PRESENCE, PRIORITY_TYPING,
+                            SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, OutboundStats)
+
+
+async def stalled_queue(policy, maxsize=3):
+    """Returns a queue whose client stopped reading, with one chat frame stuck in the socket."""
+    websocket = FakeWebSocket()
+    websocket.pause()
+    queue = OutboundQueue(websocket, maxsize, policy, OutboundStats())
+    queue.put("stuck")
+    await settle()
+    assert len(queue) == 0 # Taken by the writer, which now waits on the socket
+    return websocket, queue
+
+
+def test_a_stalled_client_never_blocks_put():
+    async def scenario():
+        websocket, queue = await stalled_queue(DROP_OLDEST, maxsize=100)
+        for number in range(100):
+            assert queue.put(f"chat {number}")
+        assert len(queue) == 100 and websocket.sent == []
+        websocket.resume()
+        await settle(200)
+        assert websocket.sent == ["stuck"] + [f"chat {number}" for number in range(100)]
+        assert queue.stats.sent_frames == 101
+        queue.close()
+    asyncio.run(scenario())
+
+def test_drop_oldest_discards_the_least_important_frame():
+    async def scenario():
+        websocket, queue = await stalled_queue(DROP_OLDEST)
+        queue.put("typing", PRIORITY_TYPING)
+        queue.put("presence", PRIORITY_PRESENCE)
+        queue.put("chat 1")
+        assert queue.put("chat 2") # Full: the typing frame makes room
+        assert not queue.put("typing 2", PRIORITY_TYPING) # Full of more important frames: the new one goes
+        assert queue.put("chat 3") # Presence is now the least important class
+        assert queue.stats.dropped_frames == 3
+        websocket.resume()
+        await settle()
+        assert websocket.sent == ["stuck", "chat 1", "chat 2", "chat 3"]
+        assert not queue.evicted and websocket.close_code is None
+        queue.close()
+    asyncio.run(scenario())
+
+def test_drop_ephemeral_drops_typing_then_evicts():
+    async def scenario():
+        websocket, queue = await stalled_queue(DROP_EPHEMERAL)
+        queue.put("chat 1")
+        queue.put("typing", PRIORITY_TYPING)
+        queue.put("presence", PRIORITY_PRESENCE)
+        assert queue.put("chat 2") # The typing frame makes room
+        assert not queue.put("typing 2", PRIORITY_TYPING) # Nothing cheaper to drop than itself
+        assert queue.stats.dropped_frames == 2 and not queue.evicted
+
+        assert not queue.put("chat 3") # Only chat and presence left: the client cannot keep up
+        assert queue.evicted and len(queue) == 0
+        assert queue.stats.evicted_clients == 1
+        assert queue.stats.dropped_frames == 5 # Plus the three frames still queued at eviction
+        assert not queue.put("chat 4")
+        websocket.resume()
+        await settle()
+        assert websocket.sent == ["stuck"]
+        assert (websocket.close_code, websocket.close_reason) == (SLOW_CONSUMER_CLOSE_CODE, "Slow consumer")
+    asyncio.run(scenario())
+
+def test_disconnect_evicts_as_soon_as_the_queue_is_full():
+    async def scenario():
+        websocket, queue = await stalled_queue(DISCONNECT, maxsize=2)
+        queue.put("typing", PRIORITY_TYPING)
+        queue.put("chat 1")
+        assert not queue.put("chat 2")
+        assert queue.evicted and queue.stats.evicted_clients == 1 and queue.stats.dropped_frames == 2
+        queue.evict() # Already evicted: counted once
+        assert queue.stats.evicted_clients == 1
+        websocket.resume()
+        await settle()
+        assert websocket.close_code == SLOW_CONSUMER_CLOSE_CODE
+    asyncio.run(scenario())
+
+def test_a_closed_connection_stops_the_writer():
+    async def scenario():
+        websocket = FakeWebSocket()
+        queue = OutboundQueue(websocket, 10)
+        queue.put("first")
+        await settle()
+        websocket.drop()
+        assert queue.put("second")
+        await settle()
+        assert queue.closed and len(queue) == 0
+        assert not queue.put("third")
+        assert websocket.sent == ["first"]
+    asyncio.run(scenario())
+
+def test_chat_goes_before_presence_before_typing():
+    async def scenario():
+        websocket, queue = await stalled_queue(DROP_OLDEST, maxsize=10)
+        queue.put("typing 1", PRIORITY_TYPING)
+        queue.put("presence 1", PRIORITY_PRESENCE)
+        queue.put("chat 1")
+        queue.put("typing 2", PRIORITY_TYPING)
+        queue.put("chat 2", PRIORITY_CHAT)
+        queue.put("presence 2", PRIORITY_PRESENCE)
+        websocket.resume()
+        await settle()
+        assert websocket.sent == ["stuck", "chat 1", "chat 2", "presence 1", "presence 2", "typing 1", "typing 2"]
+        queue.close()
+    asyncio.run(scenario())
+
+def test_a_keyed_frame_replaces_the_queued_one_in_place():
+    async def scenario():
+        websocket, queue = await stalled_queue(DROP_OLDEST, maxsize=10)
+        queue.put("start a", PRIORITY_TYPING, ("typing", "lobby", "#aaaaaa"))
+        queue.put("start b", PRIORITY_TYPING, ("typing", "lobby", "#bbbbbb"))
+        assert queue.put("stop a", PRIORITY_TYPING, ("typing", "lobby", "#aaaaaa"))
+        assert len(queue) == 2 and queue.stats.superseded_frames == 1
+        websocket.resume()
+        await settle()
+        assert websocket.sent == ["stuck", "stop a", "start b"]
+        queue.put("start a", PRIORITY_TYPING, ("typing", "lobby", "#aaaaaa")) # Sent already, so queued anew
+        await settle()
+        assert websocket.sent[-1] == "start a" and queue.stats.superseded_frames == 1
+        queue.close()
+    asyncio.run(scenario())
+
+def test_server_keys_typing_by_sender_and_snapshots_by_room(server):
+    assert server.frame_class({"type": "typing_stop", "room": "lobby", "sender_color": "#aaaaaa"}) == \
+        server.frame_class({"type": "typing_start", "room": "lobby", "sender_color": "#aaaaaa"}) == (PRIORITY_TYPING, ("typing", "lobby", "#aaaaaa"))
+    assert server.frame_class({"type": "client_list", "room": "games"}) == (PRIORITY_PRESENCE, ("client_list", "games"))
+    assert server.frame_class({"type": "presence", "room": "games"}) == (PRIORITY_PRESENCE, None) # Deltas must all arrive
+    assert server.frame_class({"type": "message", "room": "games"}) == (PRIORITY_CHAT, None)
@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+pytest.importorskip("PySide6.QtWebSockets")
+from PySide6.QtCore import QCoreApplication
+
+import main_client_service
+from message_packet import Ping
+from rate_limit import TokenBucket
+
+app = QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.fixture
+def client():
+    """An offline WebSocketClient."""
+    return main_client_service.WebSocketClient("ws://127.0.0.1:1")
+
+def test_messages_are_refused_rather_than_dropped_when_the_outbox_is_full(client, monkeypatch):
+    monkeypatch.setattr(main_client_service, "OUTBOX_LIMIT", 3)
+    errors = []
+    client.error_received.connect(errors.append)
+    client.join_room("first")
+    sent = [client.send_direct_message("#a1b2c3", "hi"), client.send_chat_message("one")]
+    assert client.send_chat_message("two") is None
+    assert len(errors) == 1
+    client.leave_room("first") # Past the limit, so the oldest frame that is not a message makes room
+    assert [payload["type"] for payload in client._outbox.values()] == ["direct_message", "message", "leave_room"]
+    assert [payload["client_id"] for payload in list(client._outbox.values())[:2]] == sent
+
+def test_pongs_are_not_held_back_by_the_send_budget(client):
+    written = []
+    client._write_frame = written.append
+    client._send_budget = TokenBucket(main_client_service.SEND_RATE, 1, time.monotonic())
+    client._session_ready = True
+    client.join_room("first")
+    client.join_room("second")
+    client._flush_outbox()
+    client._dispatch(Ping(), 0)
+    assert [payload["type"] for payload in written] == ["join_room", "pong"]
+    assert [payload["room"] for payload in client._outbox.values()] == ["second"] # Still waiting for a token
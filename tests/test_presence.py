@@ -0,0 +1,71 @@
+import asyncio
+
+from fakes import FakeWebSocket, settle
+
+WINDOW = 0.05
+
+
+async def connect(server, path="/"):
+    websocket = FakeWebSocket(path)
+    task = asyncio.create_task(server.handle_client(websocket))
+    await settle()
+    return websocket, task
+
+async def disconnect(websocket, task):
+    await websocket.close(1000)
+    await task
+
+
+def test_joins_in_one_window_go_out_as_one_frame(server):
+    async def scenario():
+        watcher, watcher_task = await connect(server)
+        await asyncio.sleep(WINDOW * 2)
+        watcher.sent.clear()
+        others = [await connect(server) for _ in range(3)]
+        await asyncio.sleep(WINDOW * 2)
+        presence = watcher.messages("presence")
+        assert len(presence) == 1
+        assert presence[0]["joined"] == [websocket.messages("color_assignment")[0]["color"] for websocket, _ in others]
+        assert presence[0]["left"] == []
+        for websocket, task in others + [(watcher, watcher_task)]:
+            await disconnect(websocket, task)
+    asyncio.run(scenario())
+
+def test_join_and_leave_in_one_window_cancel_out(server):
+    async def scenario():
+        watcher, watcher_task = await connect(server)
+        await asyncio.sleep(WINDOW * 2)
+        watcher.sent.clear()
+        visitor, visitor_task = await connect(server)
+        await disconnect(visitor, visitor_task)
+        await asyncio.sleep(WINDOW * 2)
+        assert watcher.messages("presence") == []
+        await disconnect(watcher, watcher_task)
+    asyncio.run(scenario())
+
+def test_batcher_cancels_a_join_and_leave_of_the_same_color(server):
+    async def scenario():
+        batcher = server.PresenceBatcher("lobby", window=WINDOW)
+        batcher.client_joined("#aaaaaa")
+        batcher.client_left("#aaaaaa")
+        batcher.client_left("#bbbbbb")
+        assert (list(batcher.joined), list(batcher.left)) == ([], ["#bbbbbb"])
+        assert batcher.announced(["#cccccc"]) == ["#cccccc", "#bbbbbb"]
+        batcher.flush()
+        await asyncio.sleep(WINDOW * 2) # The scheduled flush finds nothing left to send
+    asyncio.run(scenario())
+
+def test_snapshot_of_a_client_joining_inside_a_window_excludes_pending_joins(server):
+    async def scenario():
+        first, first_task = await connect(server)
+        second, second_task = await connect(server) # Same window as the first
+        first_color = first.messages("color_assignment")[0]["color"]
+        second_color = second.messages("color_assignment")[0]["color"]
+        assert second.messages("client_list")[0]["clients"] == [{"color": second_color}] # Itself, but not the pending join
+        await asyncio.sleep(WINDOW * 2)
+        # Both get the one delta naming both, so their lists end up the same
+        assert second.messages("presence")[0]["joined"] == [first_color, second_color]
+        assert first.messages("presence")[0]["joined"] == [first_color, second_color]
+        await disconnect(first, first_task)
+        await disconnect(second, second_task)
+    asyncio.run(scenario())
@@ -0,0 +1,89 @@
+import asyncio
+import http
+import json
+
+from fakes import FakeClock, FakeWebSocket, settle
+from rate_limit import SERVER_FULL_RETRY_SECONDS, AdmissionControl, ConnectionLimiter, TokenBucket
+
+
+def test_token_bucket_refills_at_its_rate_up_to_its_burst():
+    bucket = TokenBucket(2.0, 3, 0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(0.0) == 0.5
+    assert bucket.take(0.25) == 0.25 # Half a token came back
+    assert bucket.take(0.5) == 0.0
+    bucket.take(100.0)
+    assert [bucket.take(100.0) for _ in range(3)] == [0.0, 0.0, 0.5] # A long idle refills the burst, not more
+
+def test_limiter_budgets_types_separately_and_reports_once_per_wait():
+    clock = FakeClock()
+    limiter = ConnectionLimiter({"message": (1.0, 1)}, clock=clock)
+    assert limiter.check("message") == 0.0
+    assert limiter.check("message") == 1.0
+    assert limiter.check("pong") == 0.0 # Types without a limit only count towards the frame budget
+    assert limiter.should_report("message", 1.0)
+    assert not limiter.should_report("message", 1.0)
+    clock.advance(1.0)
+    assert limiter.should_report("message", 1.0)
+
+
+async def connect(server, limiter):
+    websocket = FakeWebSocket()
+    task = asyncio.create_task(server.handle_client(websocket))
+    await settle()
+    server.registry.by_color(websocket.messages("color_assignment")[0]["color"]).limiter = limiter
+    return websocket, task
+
+def chat(websocket, count):
+    for number in range(count):
+        websocket.receive(json.dumps({"type": "message", "message": str(number), "client_id": f"{len(websocket.sent)}-{number}"}))
+
+def test_refused_messages_get_one_error_per_wait_with_the_wait(server):
+    async def scenario():
+        clock = FakeClock()
+        websocket, task = await connect(server, ConnectionLimiter({"message": (2.0, 2)}, clock=clock))
+        chat(websocket, 5)
+        await settle()
+        assert len(websocket.messages("ack")) == 2 # Refused messages are not acked, so the client sends them again
+        assert [error["retry_after_ms"] for error in websocket.messages("error")] == [500]
+
+        clock.advance(0.5)
+        chat(websocket, 2)
+        await settle()
+        assert len(websocket.messages("ack")) == 3
+        assert [error["retry_after_ms"] for error in websocket.messages("error")] == [500, 500] # A new wait, reported again
+        websocket.receive(None)
+        await task
+    asyncio.run(scenario())
+
+def test_exceeding_the_frame_budget_closes_the_connection(server):
+    async def scenario():
+        websocket, task = await connect(server, ConnectionLimiter(frame_rate=1.0, frame_burst=3, clock=FakeClock()))
+        for _ in range(5):
+            websocket.receive(json.dumps({"type": "ping"}))
+        await task
+        assert (websocket.close_code, websocket.close_reason) == (server.RATE_LIMIT_CLOSE_CODE, "Rate limit exceeded")
+    asyncio.run(scenario())
+
+
+def test_admission_refuses_at_the_cap_and_during_a_handshake_burst():
+    clock = FakeClock()
+    admission = AdmissionControl(max_connections=3, handshake_rate=1.0, handshake_burst=2, clock=clock)
+    assert [admission.admit(), admission.admit()] == [0.0, 0.0]
+    assert admission.admit() == 1.0 # The burst is spent
+    clock.advance(1.0)
+    assert admission.admit() == 0.0
+    for _ in range(3):
+        admission.connection_opened()
+    clock.advance(10.0)
+    assert admission.admit() == SERVER_FULL_RETRY_SECONDS
+    admission.connection_closed()
+    assert admission.admit() == 0.0
+    assert admission.refused == 2
+
+def test_refused_handshakes_get_503_with_retry_after(server, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server, "admission", AdmissionControl(max_connections=10, handshake_rate=0.4, handshake_burst=1, clock=clock))
+    assert asyncio.run(server.admit_connection("/", {})) is None
+    status, headers, _ = asyncio.run(server.admit_connection("/", {}))
+    assert (status, headers) == (http.HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", "3")]) # 2.5 seconds, rounded up
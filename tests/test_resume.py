@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+from fakes import FakeWebSocket, settle
+from message_log import MessageStore
+
+
+def test_frames_since_returns_later_frames_or_none_when_they_are_gone(server):
+    room = server.Room("lobby")
+    room.ring = server.collections.deque(maxlen=3)
+    for seq in range(1, 6):
+        room.seq = seq
+        room.ring.append((seq, None, 0, None))
+    assert [entry[0] for entry in room.frames_since(3)] == [4, 5]
+    assert [entry[0] for entry in room.frames_since(2)] == [3, 4, 5]
+    assert room.frames_since(5) == []
+    assert room.frames_since(1) is None # Frame 2 has left the ring
+    assert room.frames_since(9) is None # Numbered by an earlier incarnation of the room
+
+def test_malformed_resume_queries_are_ignored(server):
+    assert server.parse_resume_request("/?resume=abc&since=lobby:4&since=a:b:7&direct=3") == ("abc", {"lobby": 4, "a:b": 7}, 3)
+    assert server.parse_resume_request("/?since=lobby:x&since=:5&since=nocolon&since=lobby:-1&direct=-2") == (None, {}, 0)
+    assert server.parse_resume_request("/") == (None, {}, 0)
+    assert server.parse_resume_request("/?%zz=1&since=%ff:1") == (None, {"�": 1}, 0)
+
+
+async def connect(server, path="/"):
+    websocket = FakeWebSocket(path)
+    task = asyncio.create_task(server.handle_client(websocket))
+    await settle()
+    return websocket, task
+
+async def chat(websocket, *texts):
+    for text in texts:
+        websocket.receive(json.dumps({"type": "message", "message": text}))
+    await settle()
+
+def test_resume_replays_only_the_messages_after_since(server):
+    async def scenario():
+        sender, sender_task = await connect(server)
+        reader, reader_task = await connect(server)
+        token = reader.messages("color_assignment")[0]["resume_token"]
+        await chat(sender, "one", "two")
+        last_seen = reader.messages("message")[-1]["seq"]
+        reader.drop()
+        await reader_task
+        await chat(sender, "three", "four")
+
+        resumed, resumed_task = await connect(server, f"/?resume={token}&since=lobby:{last_seen}")
+        assert resumed.messages("color_assignment")[0]["resumed"]
+        assert len(resumed.messages("client_list")) == 1 # Presence deltas are not replayed, a snapshot replaces them
+        assert [m["message"] for m in resumed.messages("message")] == ["three", "four"]
+        assert resumed.messages("history") == []
+        for websocket, task in ((sender, sender_task), (resumed, resumed_task)):
+            await websocket.close(1000)
+            await task
+    asyncio.run(scenario())
+
+def test_resume_from_before_the_ring_falls_back_to_full_history(server, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "ROOM_RING_SIZE", 2)
+    monkeypatch.setattr(server, "message_store", MessageStore(str(tmp_path)))
+    monkeypatch.setattr(server, "history_cache", server.EncodeCache(8))
+
+    async def scenario():
+        sender, sender_task = await connect(server)
+        reader, reader_task = await connect(server)
+        token = reader.messages("color_assignment")[0]["resume_token"]
+        await chat(sender, "one")
+        reader.drop()
+        await reader_task
+        await chat(sender, "two", "three", "four")
+
+        resumed, resumed_task = await connect(server, f"/?resume={token}&since=lobby:1")
+        assert resumed.messages("message") == []
+        history = resumed.messages("history")
+        assert [m["message"] for m in history[0]["messages"]] == ["one", "two", "three", "four"]
+        for websocket, task in ((sender, sender_task), (resumed, resumed_task)):
+            await websocket.close(1000)
+            await task
+        server.message_store.close()
+    asyncio.run(scenario())
+
+def test_resends_after_an_expired_session_get_their_old_acks(server):
+    async def scenario():
+        sender, sender_task = await connect(server)
+        reader, reader_task = await connect(server)
+        token = sender.messages("color_assignment")[0]["resume_token"]
+        frame = json.dumps({"type": "message", "message": "once", "client_id": "c1"})
+        sender.receive(frame)
+        await settle()
+        [ack] = sender.messages("ack")
+        sender.drop()
+        await sender_task
+        server.end_session(server.registry.by_token(token)) # The grace period ran out
+
+        resent, resent_task = await connect(server, f"/?resume={token}&since=lobby:0")
+        assert not resent.messages("color_assignment")[0]["resumed"]
+        resent.receive(frame)
+        await settle()
+        assert resent.messages("ack") == [ack]
+        assert [m["message"] for m in reader.messages("message")] == ["once"]
+        for websocket, task in ((resent, resent_task), (reader, reader_task)):
+            await websocket.close(1000)
+            await task
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import random
+
+from fakes import FakeWebSocket, settle
+from search_index import SearchIndex, parse_cursor, tokenize
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon"]
+BUCKET_US = 60 * 1000000
+
+def build_index(count=500, seed=1):
+    """Returns an index of count random messages spread over several buckets, and the messages newest first."""
+    rng = random.Random(seed)
+    index = SearchIndex(bucket_seconds=60)
+    messages = []
+    for number in range(count):
+        text = " ".join(rng.sample(WORDS, rng.randint(1, 3)))
+        message = {"type": "message", "id": str(number), "room": "lobby", "sender_color": "#a1b2c3",
+                   "message": text, "server_received_us": number * BUCKET_US // 40}
+        index.add(message)
+        messages.append(message)
+    return index, messages[::-1]
+
+def brute_force(messages, query):
+    words = set(tokenize(query))
+    return [message["id"] for message in messages if words <= set(tokenize(message["message"]))]
+
+def all_pages(index, query, limit):
+    ids, cursor, pages = [], None, 0
+    while True:
+        results, cursor = index.search("lobby", query, cursor, limit)
+        ids.extend(result["id"] for result in results)
+        pages += 1
+        if cursor is None:
+            return ids, pages
+        assert len(results) == limit
+
+
+def test_pages_match_a_brute_force_search():
+    index, messages = build_index()
+    for query in ("alpha", "beta gamma", "GAMMA, alpha delta", "epsilon"):
+        expected = brute_force(messages, query)
+        assert expected
+        for limit in (1, 7, 50, len(expected), 1000):
+            ids, pages = all_pages(index, query, limit)
+            assert ids == expected
+            assert pages == max(1, -(-len(expected) // limit))
+
+def test_cursor_stays_valid_while_messages_arrive():
+    index, messages = build_index()
+    first_page, cursor = index.search("lobby", "alpha", None, 10)
+    index.add({"type": "message", "id": "new", "room": "lobby", "message": "alpha", "server_received_us": 10**12})
+    rest, _ = all_pages_from(index, "alpha", cursor)
+    assert [result["id"] for result in first_page] + rest == brute_force(messages, "alpha")
+
+def all_pages_from(index, query, cursor):
+    ids = []
+    while cursor is not None:
+        results, cursor = index.search("lobby", query, cursor, 25)
+        ids.extend(result["id"] for result in results)
+    return ids, cursor
+
+def test_queries_without_matches_or_words():
+    index, _ = build_index(50)
+    assert index.search("lobby", "zeta") == ([], None)
+    assert index.search("lobby", "!!!") == ([], None)
+    assert index.search("elsewhere", "alpha") == ([], None)
+
+def test_old_buckets_are_dropped():
+    index = SearchIndex(bucket_seconds=60, retained_buckets=2)
+    for bucket in range(4):
+        index.add({"room": "lobby", "id": str(bucket), "message": "alpha", "server_received_us": bucket * BUCKET_US})
+    assert index.document_count == 2
+    assert [result["id"] for result in index.search("lobby", "alpha")[0]] == ["3", "2"]
+    index.add({"room": "lobby", "id": "old", "message": "alpha", "server_received_us": 0})
+    assert index.document_count == 2
+
+def test_malformed_cursors_start_from_the_newest_page():
+    assert parse_cursor(None) == (None, None)
+    assert parse_cursor("12:x") == (None, None)
+    assert parse_cursor("12:3") == (12, 3)
+
+def test_the_server_answers_searches_page_by_page(server):
+    async def scenario():
+        websocket = FakeWebSocket()
+        task = asyncio.create_task(server.handle_client(websocket))
+        await settle()
+        for text in ("lunch at noon", "no lunch", "dinner"):
+            websocket.receive(json.dumps({"type": "message", "message": text}))
+        websocket.receive(json.dumps({"type": "search", "query": "lunch", "limit": 1, "request_id": "r1"}))
+        websocket.receive(json.dumps({"type": "search", "query": "lunch", "room": "elsewhere"}))
+        for _ in range(50): # The query runs on a search thread
+            await asyncio.sleep(0.01)
+            if websocket.messages("search_results"):
+                break
+        [first] = websocket.messages("search_results")
+        assert (first["request_id"], [m["message"] for m in first["messages"]]) == ("r1", ["no lunch"])
+        assert websocket.messages("error")[0]["message"] == "You are not in room elsewhere."
+
+        websocket.receive(json.dumps({"type": "search", "query": "lunch", "limit": 1, "cursor": first["cursor"]}))
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if len(websocket.messages("search_results")) == 2:
+                break
+        second = websocket.messages("search_results")[1]
+        assert [m["message"] for m in second["messages"]] == ["lunch at noon"]
+        websocket.receive(None)
+        await task
+    asyncio.run(scenario())
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+
+from fakes import FakeWebSocket, settle
+from server_metrics import MetricsRegistry, MetricsServer
+
+
+def test_registry_renders_the_prometheus_text_format():
+    registry = MetricsRegistry()
+    frames = registry.counter("frames_total", "Frames received.", "type")
+    frames.inc(label="message")
+    frames.inc(2, label='say "hi"\n')
+    registry.gauge("sessions", "Open sessions.", lambda: 3)
+    registry.function_counter("dropped_total", "Frames dropped.", lambda: 1.5)
+    assert registry.render().splitlines() == [
+        "# HELP frames_total Frames received.",
+        "# TYPE frames_total counter",
+        'frames_total{type="message"} 1',
+        'frames_total{type="say \\"hi\\"\\n"} 2',
+        "# HELP sessions Open sessions.",
+        "# TYPE sessions gauge",
+        "sessions 3",
+        "# HELP dropped_total Frames dropped.",
+        "# TYPE dropped_total counter",
+        "dropped_total 1.5",
+    ]
+
+def test_histogram_buckets_are_cumulative_and_inclusive():
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        latency.observe(value)
+    assert list(latency.samples()) == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 2.65",
+        "latency_seconds_count 4",
+    ]
+
+def spin(seconds):
+    """Keeps the event loop thread busy without yielding, so the profiler samples this frame rather than the selector."""
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode("latin-1"))
+    response = (await reader.read()).decode("utf-8")
+    writer.close()
+    head, _, body = response.partition("\r\n\r\n")
+    return head.split("\r\n")[0], body
+
+def test_metrics_server_serves_metrics_and_profiles():
+    async def scenario():
+        registry = MetricsRegistry()
+        registry.counter("requests_total", "Requests.").inc()
+        server = MetricsServer(registry, port=0)
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            assert await get(port, "/metrics") == ("HTTP/1.1 200 OK", registry.render())
+            assert (await get(port, "/nowhere"))[0] == "HTTP/1.1 404 Not Found"
+            assert (await get(port, "/profile?seconds=soon"))[0] == "HTTP/1.1 400 Bad Request"
+
+            profile = asyncio.create_task(get(port, "/profile?seconds=0.2&interval=0.001"))
+            await asyncio.sleep(0.05) # Sampling has started
+            spin(0.1)
+            status, stacks = await profile
+            assert status == "HTTP/1.1 200 OK"
+            assert "test_server_metrics.py:spin" in stacks # Samples the event loop thread, not the profiler's own
+        finally:
+            server.close()
+    asyncio.run(scenario())
+
+def test_received_frames_of_unknown_types_share_one_label(server):
+    async def scenario():
+        before = dict(server.frames_received.values)
+        websocket = FakeWebSocket()
+        task = asyncio.create_task(server.handle_client(websocket))
+        await settle()
+        for message_type in ("from_the_future", "another_one"):
+            websocket.receive(json.dumps({"type": message_type}))
+        await settle()
+        websocket.receive(None)
+        await task
+        assert server.frames_received.values["unknown"] - before.get("unknown", 0) == 2
+        assert "from_the_future" not in server.frames_received.values
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+from session_registry import ColorAllocator, SessionRegistry
+
+
+def test_colors_are_unique_and_reused_lowest_first():
+    allocator = ColorAllocator()
+    colors = [allocator.allocate() for _ in range(1000)]
+    assert len(set(colors)) == len(colors)
+    assert all(int(channel, 16) >= 128 for color in colors for channel in (color[1:3], color[3:5], color[5:7]))
+    allocator.release(colors[500])
+    allocator.release(colors[10])
+    assert allocator.allocate() == colors[10]
+    assert allocator.allocate() == colors[500]
+
+def test_slots_and_colors_are_a_bijection():
+    allocator = ColorAllocator()
+    for slot in (0, 1, 12345, ColorAllocator.SLOT_COUNT - 1):
+        assert allocator.slot_for_color(allocator.color_for_slot(slot)) == slot
+
+def test_allocators_with_distinct_offsets_never_collide():
+    first, second = ColorAllocator(offset=0, stride=2), ColorAllocator(offset=1, stride=2)
+    assert not {first.allocate() for _ in range(500)} & {second.allocate() for _ in range(500)}
+
+def test_registry_indexes_sessions_by_color_and_token():
+    registry = SessionRegistry()
+    first, second = registry.create(), registry.create()
+    assert registry.by_color(first.color) is first and registry.by_token(second.token) is second
+    assert registry.remove(first)
+    assert not registry.remove(first)
+    assert registry.by_color(first.color) is None and registry.by_token(first.token) is None
+    assert registry.create().color == first.color # The freed color is handed out again
+    assert len(registry) == 2
+
+def test_acks_of_removed_sessions_are_kept_by_token_once():
+    registry = SessionRegistry()
+    session, quiet = registry.create(), registry.create()
+    session.remember_ack("c1", {"type": "ack", "client_id": "c1"})
+    registry.remove(session)
+    registry.remove(quiet)
+    assert registry.take_ended_acks(session.token) == {"c1": {"type": "ack", "client_id": "c1"}}
+    assert registry.take_ended_acks(session.token) is None
+    assert registry.take_ended_acks(quiet.token) is None
@@ -0,0 +1,26 @@
+from fakes import FakeClock
+from timer_wheel import TimerWheel
+
+def test_keys_expire_once_their_deadline_passes():
+    clock = FakeClock()
+    wheel = TimerWheel(1.0, slot_count=8, clock=clock)
+    wheel.schedule("a", 2)
+    wheel.schedule("b", 20) # More than one lap of the wheel away
+    clock.now += 3
+    assert wheel.advance() == ["a"]
+    assert "b" in wheel and len(wheel) == 1
+    clock.now += 18
+    assert wheel.advance() == ["b"]
+    assert len(wheel) == 0
+
+def test_rescheduling_and_cancelling():
+    clock = FakeClock()
+    wheel = TimerWheel(1.0, slot_count=8, clock=clock)
+    wheel.schedule("a", 2)
+    wheel.schedule("b", 2)
+    wheel.schedule("a", 5)
+    wheel.cancel("b")
+    clock.now += 3
+    assert wheel.advance() == []
+    clock.now += 100 # A long stall still fires everything that is due
+    assert wheel.advance() == ["a"]
@@ -0,0 +1,64 @@
+import asyncio
+
+from fakes import FakeClock, FakeWebSocket, settle
+
+
+def test_typing_is_coalesced_rate_limited_and_expired(server, monkeypatch):
+    clock = FakeClock()
+    tracker = server.TypingTracker(clock=clock)
+    monkeypatch.setattr(server, "typing_tracker", tracker)
+
+    def tick(seconds):
+        clock.advance(seconds)
+        tracker._on_tick()
+
+    async def scenario():
+        typist, watcher = FakeWebSocket(), FakeWebSocket()
+        tasks = [asyncio.create_task(server.handle_client(websocket)) for websocket in (typist, watcher)]
+        await settle()
+        typist_color = typist.messages("color_assignment")[0]["color"]
+
+        for _ in range(3): # Repeated starts only push the expiry back
+            typist.receive('{"type": "typing_start"}')
+        await settle()
+        assert [(m["type"], m["sender_color"]) for m in watcher.messages("typing_start", "typing_stop")] == [("typing_start", typist_color)]
+        assert typist.messages("typing_start", "typing_stop") == []
+
+        typist.receive('{"type": "typing_stop"}') # Too soon after the start: held back until the interval ends
+        await settle()
+        assert len(watcher.messages("typing_stop")) == 0
+        tick(tracker.min_interval + tracker.wheel.tick_seconds)
+        await settle()
+        assert len(watcher.messages("typing_stop")) == 1
+
+        tick(tracker.min_interval)
+        typist.receive('{"type": "typing_start"}')
+        await settle()
+        assert len(watcher.messages("typing_start")) == 2
+        tick(tracker.timeout / 2)
+        assert len(watcher.messages("typing_stop")) == 1
+        tick(tracker.timeout) # The typist went quiet without a typing_stop
+        await settle()
+        assert len(watcher.messages("typing_stop")) == 2
+        assert len(tracker.wheel) == 0
+
+        for websocket in (typist, watcher):
+            await websocket.close(1000)
+        await asyncio.gather(*tasks)
+    asyncio.run(scenario())
+
+def test_leaving_while_typing_tells_the_room(server, monkeypatch):
+    monkeypatch.setattr(server, "typing_tracker", server.TypingTracker(clock=FakeClock()))
+
+    async def scenario():
+        typist, watcher = FakeWebSocket(), FakeWebSocket()
+        tasks = [asyncio.create_task(server.handle_client(websocket)) for websocket in (typist, watcher)]
+        await settle()
+        typist.receive('{"type": "typing_start"}')
+        await settle()
+        await typist.close(1000)
+        await settle()
+        assert [m["type"] for m in watcher.messages("typing_start", "typing_stop")] == ["typing_start", "typing_stop"]
+        await watcher.close(1000)
+        await asyncio.gather(*tasks)
+    asyncio.run(scenario())
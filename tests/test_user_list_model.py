@@ -0,0 +1,35 @@
+import pytest
+
+QtCore = pytest.importorskip("PySide6.QtCore")
+
+from chat_models import UserListModel
+from fakes import record_changes
+
+app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([]) # Models and timers need an application, not a display
+
+
+def colors(*numbers):
+    return [{"color": f"#0000{number:02x}"} for number in numbers]
+
+def test_snapshots_are_sorted_and_deduplicated():
+    model = UserListModel()
+    model.set_users(colors(5, 1, 3, 1) + [{"color": None}, {}])
+    assert model.colors == ["#000001", "#000003", "#000005"]
+    assert model.data(model.index(0)) == "User: #000001"
+    assert model.data(model.index(0), QtCore.Qt.ItemDataRole.UserRole) == "#000001"
+
+def test_joins_are_inserted_as_ranges_in_sorted_order():
+    model = UserListModel()
+    model.set_users(colors(2, 5))
+    changes = record_changes(model)
+    model.add_users(colors(6, 4, 1, 3, 2))
+    assert model.colors == [entry["color"] for entry in colors(1, 2, 3, 4, 5, 6)]
+    assert changes == [("insert", 2, 2), ("insert", 1, 2), ("insert", 0, 0)] # #6; #3 and #4 together; #1
+
+def test_leaves_are_removed_as_ranges_from_the_bottom_up():
+    model = UserListModel()
+    model.set_users(colors(*range(1, 8)))
+    changes = record_changes(model)
+    model.remove_users(colors(2, 3, 5, 6, 7, 9) + [{}])
+    assert model.colors == [entry["color"] for entry in colors(1, 4)]
+    assert changes == [("remove", 4, 6), ("remove", 1, 2)]
@@ -0,0 +1,82 @@
+import time
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel for tracking many deadlines cheaply.
+
+    Deadlines are rounded up to a tick and hashed into one of slot_count buckets.
+    Scheduling, rescheduling and cancelling are O(1), and advancing the wheel only
+    looks at the buckets for the ticks that have elapsed, so the cost of a check
+    grows with the number of expired (or colliding) keys rather than with the
+    total number of keys being tracked.
+    """
+
+    def __init__(self, tick_seconds, slot_count=512, clock=time.monotonic):
+        """
+        Args:
+            tick_seconds (float): Resolution of the wheel. Deadlines fire up to one tick late.
+            slot_count (int, optional): Number of buckets. Defaults to 512.
+            clock (callable, optional): Monotonic clock returning seconds. Defaults to time.monotonic.
+        """
+        self.tick_seconds = tick_seconds
+        self.clock = clock
+        self._slots = [set() for _ in range(slot_count)]
+        self._deadlines = {} # key -> absolute tick number at which the key expires
+        self._current_tick = self._tick_for(clock())
+
+    def _tick_for(self, timestamp):
+        return int(timestamp / self.tick_seconds)
+
+    def schedule(self, key, delay):
+        """Schedules (or reschedules) key to expire after delay seconds."""
+        tick = max(self._tick_for(self.clock() + delay) + 1, self._current_tick + 1) # Round up, never into the past
+        old_tick = self._deadlines.get(key)
+        if old_tick == tick:
+            return
+        if old_tick is not None:
+            self._slots[old_tick % len(self._slots)].discard(key)
+        self._deadlines[key] = tick
+        self._slots[tick % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        """Removes key from the wheel. Does nothing if it is not scheduled."""
+        tick = self._deadlines.pop(key, None)
+        if tick is not None:
+            self._slots[tick % len(self._slots)].discard(key)
+
+    def advance(self):
+        """
+        Moves the wheel up to the current time.
+
+        Returns:
+            list: The keys whose deadlines have passed.
+        """
+        now_tick = self._tick_for(self.clock())
+        expired = []
+        if now_tick <= self._current_tick:
+            return expired
+
+        # After a long stall every bucket is due, so visiting each one once is enough
+        ticks = range(self._current_tick + 1, now_tick + 1)
+        if len(ticks) > len(self._slots):
+            ticks = range(now_tick - len(self._slots) + 1, now_tick + 1)
+
+        for tick in ticks:
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            due = [key for key in slot if self._deadlines[key] <= now_tick] # Keys further out stay for a later lap
+            for key in due:
+                slot.discard(key)
+                del self._deadlines[key]
+            expired.extend(due)
+
+        self._current_tick = now_tick
+        return expired
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import heapq
+import struct
+import time
+from message_packet import json_dumpb, json_loads
+
+CAPTURE_MAGIC = b"QTCHATCAP1\n"
+CAPTURE_HEADER = struct.Struct(">Q") # Wall-clock start of the capture in nanoseconds, after the magic
+RECORD_HEADER = struct.Struct(">BIQI") # kind, connection id, nanoseconds since the start, payload length
+CLOSE_PAYLOAD = struct.Struct(">H") # Close code of a CLOSED record, 0 if there was none
+CAPTURE_FLUSH_INTERVAL_SECONDS = 1.0 # How often buffered records are pushed to the operating system
+CAPTURE_BUFFER_SIZE = 1 << 20
+
+OPENED = 1 # Payload: JSON {"path", "subprotocol", "color"}
+TEXT_FRAME = 2 # Payload: the UTF-8 text of a JSON frame
+BINARY_FRAME = 3 # Payload: the bytes of a binary frame
+CLOSED = 4 # Payload: CLOSE_PAYLOAD
+
+CaptureEvent = collections.namedtuple("CaptureEvent", ("time_ns", "connection", "kind", "data"))
+CaptureEvent.__doc__ = """
+One captured event. time_ns is wall-clock nanoseconds; data is the info dict
+of OPENED, the frame (str or bytes) of TEXT_FRAME and BINARY_FRAME and the
+close code of CLOSED.
+"""
+
+
+class TrafficCapture:
+    """
+    Records the inbound traffic of a server to a compact binary file for replay.
+
+    Every connection opened, every frame received and every connection closed
+    is written as one length-prefixed record tagged with the connection id and
+    its offset from the start of the capture, so a replayer can reproduce the
+    exact interleaving of connections. Frames are stored as they arrived,
+    without re-encoding. Writes only go to a large buffer; a background task
+    flushes it every flush_interval seconds, so capturing never waits on the
+    disk in the receive path.
+    """
+
+    def __init__(self, path, flush_interval=CAPTURE_FLUSH_INTERVAL_SECONDS):
+        """
+        Args:
+            path (str): File to write. Overwritten if it exists.
+            flush_interval (float, optional): Seconds between flushes. Defaults to CAPTURE_FLUSH_INTERVAL_SECONDS.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, "wb", buffering=CAPTURE_BUFFER_SIZE)
+        self._file.write(CAPTURE_MAGIC)
+        self._file.write(CAPTURE_HEADER.pack(time.time_ns()))
+        self._started = time.perf_counter_ns()
+        self.records = 0
+
+    def _write(self, kind, connection, payload):
+        self._file.write(RECORD_HEADER.pack(kind, connection, time.perf_counter_ns() - self._started, len(payload)))
+        self._file.write(payload)
+        self.records += 1
+
+    def connection_opened(self, connection, path, subprotocol, color):
+        """Records a new connection, with the color its session got so replays can map direct message recipients."""
+        self._write(OPENED, connection, json_dumpb({"path": path, "subprotocol": subprotocol, "color": color}))
+
+    def frame_received(self, connection, frame):
+        """Records a frame received on a connection."""
+        if isinstance(frame, str):
+            self._write(TEXT_FRAME, connection, frame.encode("utf-8"))
+        else:
+            self._write(BINARY_FRAME, connection, bytes(frame))
+
+    def connection_closed(self, connection, close_code):
+        """Records the end of a connection."""
+        self._write(CLOSED, connection, CLOSE_PAYLOAD.pack(close_code or 0))
+
+    async def run(self):
+        """Flushes periodically until cancelled."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    Yields the CaptureEvents of a capture file in the order they were recorded.
+
+    A record cut short by a crash ends the capture.
+    """
+    with open(path, "rb") as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a traffic capture.")
+        started, = CAPTURE_HEADER.unpack(capture_file.read(CAPTURE_HEADER.size))
+        while True:
+            header = capture_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            kind, connection, offset, length = RECORD_HEADER.unpack(header)
+            payload = capture_file.read(length)
+            if len(payload) < length:
+                return
+            if kind == OPENED:
+                data = json_loads(payload)
+            elif kind == TEXT_FRAME:
+                data = payload.decode("utf-8")
+            elif kind == BINARY_FRAME:
+                data = payload
+            elif kind == CLOSED:
+                data, = CLOSE_PAYLOAD.unpack(payload)
+            else:
+                raise ValueError(f"Unknown capture record kind {kind} in {path}.")
+            yield CaptureEvent(started + offset, connection, kind, data)
+
+def merge_captures(paths):
+    """
+    Yields the events of several capture files, e.g. one per worker, in wall-clock order.
+
+    Connection ids are only unique within a file, so they are replaced by
+    (file index, connection id) pairs.
+    """
+    def events_of(index, path):
+        for event in read_capture(path):
+            yield event._replace(connection=(index, event.connection))
+    return heapq.merge(*(events_of(index, path) for index, path in enumerate(paths)), key=lambda event: event.time_ns)